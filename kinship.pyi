@@ -1,22 +1,180 @@
-from typing import Tuple, Dict, Set
+from typing import Tuple, Dict, Set, List, Optional, Iterator
 import numpy as np
+import scipy.sparse
 
 class TimeSparseMatrix:
     def get_kinship(self, key1: int, key2: int) -> float: ...
+    def get_peak_frontier_size(self) -> int: ...
+    def get_memory_usage(self) -> int: ...
+    def get_error_bound(self) -> float: ...
+    def get_drop_threshold(self) -> float: ...
     def to_numpy_and_free(self) -> Tuple[Dict[int, int], np.ndarray]: ...
+    def to_packed(self, vertices: Optional[List[int]] = None,
+                  free: bool = False) -> Tuple[np.ndarray, np.ndarray]: ...
+    def to_sparse(self, vertices: Optional[List[int]] = None, sparse_format: str = "csr",
+                  symmetric: bool = False, free: bool = False) -> Tuple[np.ndarray, scipy.sparse.spmatrix]: ...
+    def get_kinships(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray: ...
+    def get_kinship_rows(self, ids: np.ndarray,
+                         columns: Optional[List[int]] = None) -> Tuple[np.ndarray, np.ndarray]: ...
+    def iter_pairs(self, chunk_size: int = 1048576) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]: ...
+    def write_pairs(self, filepath: str, file_format: str = "csv", compression: str = "infer",
+                    threshold: Optional[float] = None, vertices: Optional[List[int]] = None,
+                    include_self: bool = False, column_names: Optional[List[str]] = ("id1", "id2", "kinship"),
+                    separator: str = ",", buffer_size: int = 16777216) -> int: ...
+    def save(self, filepath: str) -> None: ...
+    @staticmethod
+    def load(filepath: str) -> "TimeSparseMatrix": ...
 
 class MemorySparseMatrix:
     def get_kinship(self, key1: int, key2: int) -> float: ...
+    def get_peak_frontier_size(self) -> int: ...
+    def get_memory_usage(self) -> int: ...
+    def get_error_bound(self) -> float: ...
+    def get_drop_threshold(self) -> float: ...
     def to_numpy_and_free(self) -> Tuple[Dict[int, int], np.ndarray]: ...
+    def to_packed(self, vertices: Optional[List[int]] = None,
+                  free: bool = False) -> Tuple[np.ndarray, np.ndarray]: ...
+    def to_sparse(self, vertices: Optional[List[int]] = None, sparse_format: str = "csr",
+                  symmetric: bool = False, free: bool = False) -> Tuple[np.ndarray, scipy.sparse.spmatrix]: ...
+    def get_kinships(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray: ...
+    def get_kinship_rows(self, ids: np.ndarray,
+                         columns: Optional[List[int]] = None) -> Tuple[np.ndarray, np.ndarray]: ...
+    def iter_pairs(self, chunk_size: int = 1048576) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]: ...
+    def write_pairs(self, filepath: str, file_format: str = "csv", compression: str = "infer",
+                    threshold: Optional[float] = None, vertices: Optional[List[int]] = None,
+                    include_self: bool = False, column_names: Optional[List[str]] = ("id1", "id2", "kinship"),
+                    separator: str = ",", buffer_size: int = 16777216) -> int: ...
+    def save(self, filepath: str) -> None: ...
+    @staticmethod
+    def load(filepath: str) -> "MemorySparseMatrix": ...
+
+class Compact16SparseMatrix:
+    def get_kinship(self, key1: int, key2: int) -> float: ...
+    def get_peak_frontier_size(self) -> int: ...
+    def get_memory_usage(self) -> int: ...
+    def get_error_bound(self) -> float: ...
+    def get_drop_threshold(self) -> float: ...
+    def to_numpy_and_free(self) -> Tuple[Dict[int, int], np.ndarray]: ...
+    def to_packed(self, vertices: Optional[List[int]] = None,
+                  free: bool = False) -> Tuple[np.ndarray, np.ndarray]: ...
+    def to_sparse(self, vertices: Optional[List[int]] = None, sparse_format: str = "csr",
+                  symmetric: bool = False, free: bool = False) -> Tuple[np.ndarray, scipy.sparse.spmatrix]: ...
+    def get_kinships(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray: ...
+    def get_kinship_rows(self, ids: np.ndarray,
+                         columns: Optional[List[int]] = None) -> Tuple[np.ndarray, np.ndarray]: ...
+    def iter_pairs(self, chunk_size: int = 1048576) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]: ...
+    def write_pairs(self, filepath: str, file_format: str = "csv", compression: str = "infer",
+                    threshold: Optional[float] = None, vertices: Optional[List[int]] = None,
+                    include_self: bool = False, column_names: Optional[List[str]] = ("id1", "id2", "kinship"),
+                    separator: str = ",", buffer_size: int = 16777216) -> int: ...
+    def save(self, filepath: str) -> None: ...
+    @staticmethod
+    def load(filepath: str) -> "Compact16SparseMatrix": ...
+
+class Compact32SparseMatrix:
+    def get_kinship(self, key1: int, key2: int) -> float: ...
+    def get_peak_frontier_size(self) -> int: ...
+    def get_memory_usage(self) -> int: ...
+    def get_error_bound(self) -> float: ...
+    def get_drop_threshold(self) -> float: ...
+    def to_numpy_and_free(self) -> Tuple[Dict[int, int], np.ndarray]: ...
+    def to_packed(self, vertices: Optional[List[int]] = None,
+                  free: bool = False) -> Tuple[np.ndarray, np.ndarray]: ...
+    def to_sparse(self, vertices: Optional[List[int]] = None, sparse_format: str = "csr",
+                  symmetric: bool = False, free: bool = False) -> Tuple[np.ndarray, scipy.sparse.spmatrix]: ...
+    def get_kinships(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray: ...
+    def get_kinship_rows(self, ids: np.ndarray,
+                         columns: Optional[List[int]] = None) -> Tuple[np.ndarray, np.ndarray]: ...
+    def iter_pairs(self, chunk_size: int = 1048576) -> Iterator[Tuple[np.ndarray, np.ndarray, np.ndarray]]: ...
+    def write_pairs(self, filepath: str, file_format: str = "csv", compression: str = "infer",
+                    threshold: Optional[float] = None, vertices: Optional[List[int]] = None,
+                    include_self: bool = False, column_names: Optional[List[str]] = ("id1", "id2", "kinship"),
+                    separator: str = ",", buffer_size: int = 16777216) -> int: ...
+    def save(self, filepath: str) -> None: ...
+    @staticmethod
+    def load(filepath: str) -> "Compact32SparseMatrix": ...
+
+class PairwiseKinshipCalculator:
+    def __init__(self, vertices: List[int], first_parents: List[int], second_parents: List[int],
+                 levels: List[int], cache_size: int) -> None: ...
+    def get_kinship(self, key1: int, key2: int) -> float: ...
+    def get_kinships(self, ids1: np.ndarray, ids2: np.ndarray) -> np.ndarray: ...
+    def set_parents(self, vertex: int, parents: List[int]) -> None: ...
+    def clear_cache(self, vertices: Optional[List[int]] = None) -> None: ...
+    def get_cached_values_number(self) -> int: ...
+
+def calculate_inbreeding_coefficients(first_parents: List[int], second_parents: List[int]) -> np.ndarray: ...
+
+def plan_kinship_sparse(
+    children: Dict[int, int],
+    parents: Dict[int, int],
+    sink_vertices: Set[int],
+    ordering: str = "additional_space",
+    vertex_order: Optional[List[int]] = None,
+    column_vertices: Optional[Set[int]] = None
+) -> Tuple[int, int, int, Dict[str, int]]: ...
 
 def calculate_kinship_sparse_speed(
     children: Dict[int, int],
     parents: Dict[int, int],
-    sink_vertices: Set[int]
+    sink_vertices: Set[int],
+    ordering: str = "additional_space",
+    vertex_order: Optional[List[int]] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: float = 3600.0,
+    column_vertices: Optional[Set[int]] = None,
+    drop_threshold: float = 0.0,
+    frontier_vertices: Optional[List[int]] = None,
+    frontier_kinships: Optional[np.ndarray] = None,
+    hemizygous_vertices: Optional[Set[int]] = None
 ) -> TimeSparseMatrix: ...
 
 def calculate_kinship_sparse_memory(
     children: Dict[int, int],
     parents: Dict[int, int],
-    sink_vertices: Set[int]
+    sink_vertices: Set[int],
+    ordering: str = "additional_space",
+    vertex_order: Optional[List[int]] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: float = 3600.0,
+    column_vertices: Optional[Set[int]] = None,
+    frontier_vertices: Optional[List[int]] = None,
+    frontier_kinships: Optional[np.ndarray] = None,
+    hemizygous_vertices: Optional[Set[int]] = None
 ) -> MemorySparseMatrix: ...
+
+def calculate_kinship_sparse_compact16(
+    children: Dict[int, int],
+    parents: Dict[int, int],
+    sink_vertices: Set[int],
+    ordering: str = "additional_space",
+    vertex_order: Optional[List[int]] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: float = 3600.0,
+    column_vertices: Optional[Set[int]] = None,
+    hemizygous_vertices: Optional[Set[int]] = None
+) -> Compact16SparseMatrix: ...
+
+def calculate_kinship_sparse_compact32(
+    children: Dict[int, int],
+    parents: Dict[int, int],
+    sink_vertices: Set[int],
+    ordering: str = "additional_space",
+    vertex_order: Optional[List[int]] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: float = 3600.0,
+    column_vertices: Optional[Set[int]] = None,
+    hemizygous_vertices: Optional[Set[int]] = None
+) -> Compact32SparseMatrix: ...
+
+def calculate_group_kinship_sums(
+    children: Dict[int, int],
+    parents: Dict[int, int],
+    proband_groups: Dict[int, int],
+    groups_number: int,
+    storage: str = "speed",
+    ordering: str = "additional_space",
+    vertex_order: Optional[List[int]] = None,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_interval: float = 3600.0
+) -> Tuple[np.ndarray, np.ndarray, int]: ...
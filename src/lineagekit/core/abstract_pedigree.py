@@ -1,9 +1,11 @@
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
 from enum import Enum
 from typing import Iterable
 
 from lineagekit import kinship
 import numpy as np
+from scipy import sparse
 
 from lineagekit.core.gen_graph import GenGraph
 
@@ -14,6 +16,80 @@ import random
 class KinshipMode(Enum):
     SPEED = 0
     MEMORY = 1
+    COMPACT = 2
+
+
+class KinshipOrdering(Enum):
+    ADDITIONAL_SPACE = "additional_space"
+    GENERATION = "generation"
+    MIN_FILL = "min_fill"
+
+
+class KinshipChromosome(Enum):
+    AUTOSOMAL = "autosomal"
+    X = "x"
+
+
+class Sex(Enum):
+    MALE = "male"
+    FEMALE = "female"
+
+
+# The sex codes accepted in the pedigree files (case-insensitive). The other values mean that the sex is unknown
+_SEX_CODES = {"1": Sex.MALE, "m": Sex.MALE, "male": Sex.MALE, "2": Sex.FEMALE, "f": Sex.FEMALE, "female": Sex.FEMALE}
+
+
+# The genealogy arrays shared by the processes calculating the genetic contributions
+_contribution_arguments = None
+
+
+def _initialize_contribution_worker(arguments):
+    global _contribution_arguments
+    _contribution_arguments = arguments
+
+
+def _propagate_contributions_in_worker(founder_range: (int, int)) -> sparse.csr_matrix:
+    return _propagate_contributions(*_contribution_arguments, founder_range=founder_range)
+
+
+def _propagate_contributions(level_bounds: np.ndarray, first_parents: np.ndarray, second_parents: np.ndarray,
+                             founder_indices: np.ndarray, proband_indices: np.ndarray,
+                             founder_range: (int, int)) -> sparse.csr_matrix:
+    """
+    Propagates the contributions of a block of founders down the genealogy. The vertices are sorted so that every
+    parent precedes its children, and the sparse rows of every level are half the sum of the rows of the parents
+    plus the unit vectors of the founders of the block. The rows of the parents are multiplied level by level, so
+    that the kept rows are never copied.
+
+    Returns:
+        The contributions of the founders of the block (the rows) to the probands (the columns).
+    """
+    first, last = founder_range
+    block_indices = founder_indices[first:last]
+    in_genealogy = block_indices >= 0
+    seeds = sparse.csr_matrix((np.ones(np.count_nonzero(in_genealogy)),
+                               (block_indices[in_genealogy], np.flatnonzero(in_genealogy))),
+                              shape=(level_bounds[-1], last - first))
+    vertex_levels = np.repeat(np.arange(len(level_bounds) - 1), np.diff(level_bounds))
+    level_rows = []
+    for start, end in zip(level_bounds[:-1], level_bounds[1:]):
+        level_children = np.tile(np.arange(end - start), 2)
+        level_parents = np.concatenate((first_parents[start:end], second_parents[start:end]))
+        known = level_parents >= 0
+        level_children = level_children[known]
+        level_parents = level_parents[known]
+        parent_levels = vertex_levels[level_parents]
+        rows = seeds[start:end]
+        for parent_level in np.unique(parent_levels):
+            selected = parent_levels == parent_level
+            parent_start, parent_end = level_bounds[parent_level], level_bounds[parent_level + 1]
+            halves = sparse.csr_matrix((np.full(np.count_nonzero(selected), 0.5),
+                                        (level_children[selected], level_parents[selected] - parent_start)),
+                                       shape=(end - start, parent_end - parent_start))
+            rows = rows + halves @ level_rows[parent_level]
+        level_rows.append(sparse.csr_matrix(rows))
+    contributions = sparse.vstack(level_rows, format="csr") if level_rows else seeds
+    return sparse.csr_matrix(contributions[proband_indices].T)
 
 
 class AbstractPedigree(GenGraph, ABC):
@@ -72,50 +148,149 @@ class AbstractPedigree(GenGraph, ABC):
 
     def calculate_vertex_contribution_factor(self, vertex: int) -> float:
         """
-        Contributes the contribution factor of a vertex by summing the contribution factors between its
+        Calculates the contribution factor of a vertex by summing the contribution factors between its
         proband descendants and the vertex itself.
+
         Args:
             vertex: The vertex id.
 
         Returns:
             The sum of the contribution factors.
         """
+        return float(self.calculate_vertices_contribution_factors([vertex])[0])
 
-        def dfs(node, contribution):
-            node_children = self.get_children(node)
-            if len(node_children) == 0:  # Leaf node
-                leaf_contributions[node] += contribution
-                return
-            for child in node_children:
-                dfs(child, contribution / 2)
-
-        leaf_contributions = defaultdict(float)
-        dfs(vertex, 1.0)
-        return sum(leaf_contributions.values())
-
-    def calculate_contribution_factors(self, vertices: Iterable[int] = None):
-        def calculate_contribution_factor(node):
-            contribution_factor = contribution_factor_dict.get(node, None)
-            if contribution_factor:
-                return contribution_factor
-            children = self.get_children(node)
-            contribution_factor = 0
-            for child in children:
-                contribution_factor += calculate_contribution_factor(child)
-            contribution_factor /= 2
-            contribution_factor_dict[node] = contribution_factor
-            return contribution_factor
+    def calculate_vertices_contribution_factors(self, vertices: Iterable[int]) -> np.ndarray:
+        """
+        Calculates the contribution factors of the given vertices. The contribution factor of a vertex is the sum of
+        2^-n over all the paths from the vertex to the sink vertices, where n is the length of the path. In other
+        words, the contribution factor of a sink vertex is 1, and the contribution factor of any other vertex is
+        half of the sum of its children's contribution factors.
+
+        The descendants of the vertices are swept level by level, starting from the sink vertices, so that every
+        vertex and edge of the descending genealogy is processed once.
+
+        Args:
+            vertices (Iterable[int]): The vertices.
+
+        Returns:
+            The contribution factors of the vertices in the given order.
+
+        Example:
+            >>> founders = pedigree.get_founders()
+            >>> founder_factors = pedigree.calculate_vertices_contribution_factors(founders)
+        """
+        vertices = list(vertices)
+        descendants = set(vertices)
+        stack = list(descendants)
+        while stack:
+            for child in self.get_children(stack.pop()):
+                if child not in descendants:
+                    descendants.add(child)
+                    stack.append(child)
+        # The children of a vertex are at the lower levels, so they precede the vertex
+        sorted_vertices = sorted(descendants, key=self.get_vertex_level)
+        vertex_to_index = {vertex: index for index, vertex in enumerate(sorted_vertices)}
+        levels = np.fromiter(map(self.get_vertex_level, sorted_vertices), dtype=np.int64, count=len(sorted_vertices))
+        level_bounds = np.append(np.flatnonzero(np.diff(levels)) + 1, len(sorted_vertices))
+        children_offsets = np.zeros(len(sorted_vertices) + 1, dtype=np.int64)
+        children_offsets[1:] = np.cumsum([len(self.get_children(vertex)) for vertex in sorted_vertices])
+        children_indices = np.fromiter((vertex_to_index[child] for vertex in sorted_vertices
+                                        for child in self.get_children(vertex)),
+                                       dtype=np.int64, count=children_offsets[-1])
+        # The vertices at the level 0 are the sink vertices. Every vertex at a higher level has at least one child
+        contribution_factors = np.ones(len(sorted_vertices))
+        for start, end in zip(level_bounds[:-1], level_bounds[1:]):
+            level_offsets = children_offsets[start:end + 1]
+            level_children = children_indices[level_offsets[0]:level_offsets[-1]]
+            contribution_factors[start:end] = np.add.reduceat(contribution_factors[level_children],
+                                                              level_offsets[:-1] - level_offsets[0]) / 2
+        return contribution_factors[[vertex_to_index[vertex] for vertex in vertices]]
 
+    def calculate_contribution_factors(self, vertices: Iterable[int] = None) -> dict[int, float]:
+        """
+        Calculates the contribution factors (as in :meth:`calculate_vertices_contribution_factors`) of the given
+        vertices.
+
+        Args:
+            vertices (Iterable[int]): The vertices. If not specified, the founders are used.
+
+        Returns:
+            The dictionary mapping every vertex to its contribution factor.
+        """
         if vertices is None:
             vertices = self.get_founders()
-        vertices = frozenset(vertices)
-        sink_vertices = self.get_sink_vertices()
-        contribution_factor_dict = defaultdict(float)
-        for sink_vertex in sink_vertices:
-            contribution_factor_dict[sink_vertex] = 1.0
-        for vertex in vertices:
-            calculate_contribution_factor(vertex)
-        return {x: y for x, y in contribution_factor_dict.items() if x in vertices}
+        vertices = list(dict.fromkeys(vertices))
+        return dict(zip(vertices, self.calculate_vertices_contribution_factors(vertices).tolist()))
+
+    def calculate_genetic_contributions(self, founders: Iterable[int] = None, probands: Iterable[int] = None,
+                                       block_size: int = 1000,
+                                       processes: int = 1) -> (np.ndarray, np.ndarray, sparse.csr_matrix):
+        """
+        Calculates the expected genetic contribution of every founder to every proband, that is, the sum of 2^-n
+        over all the paths from the founder to the proband, where n is the length of the path. The sum of
+        the contributions of a founder to all the sink vertices is its contribution factor
+        (see :meth:`calculate_vertices_contribution_factors`).
+
+        The contributions are propagated down the ascending genealogy of the probands as sparse vectors: the vector
+        of a vertex is half the sum of its parents' vectors, and the vertices of a level are processed together.
+        The founders are split into blocks that are processed independently, and the blocks can be processed in
+        parallel processes.
+
+        Args:
+            founders (Iterable[int]): The founders. If not specified, all the founders of the pedigree are used.
+                                      Any other vertex can be specified as well, in which case its contributions
+                                      through its descendants are calculated.
+            probands (Iterable[int]): The probands. If not specified, the sink vertices are used.
+            block_size (int): The number of founders processed at once. The memory usage is proportional to
+                              the number of the non-zero contributions of a block to the genealogy.
+            processes (int): The number of the processes calculating the blocks in parallel.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, scipy.sparse.csr_matrix]: A tuple containing:
+                1. The sorted founder ids.
+                2. The sorted proband ids.
+                3. The contribution matrix, where the i-th row corresponds to the i-th founder and the j-th column
+                   corresponds to the j-th proband.
+
+        Raises:
+            ValueError: If the block size is not positive.
+
+        Example:
+            >>> founders, probands, contributions = pedigree.calculate_genetic_contributions()
+            >>> founder_contributions = contributions[founder_index].toarray().ravel()
+        """
+        if block_size < 1:
+            raise ValueError("The block size must be positive")
+        founders = np.array(sorted(self.get_founders() if founders is None else set(founders)), dtype=np.int64)
+        probands = np.array(sorted(self.get_sink_vertices() if probands is None else set(probands)), dtype=np.int64)
+        genealogy = self.get_ascending_vertices_from_probands(probands.tolist())
+        levels = [[vertex for vertex in level if vertex in genealogy] for level in reversed(self.get_levels())]
+        vertices = [vertex for level in levels for vertex in level]
+        vertex_to_index = {vertex: index for index, vertex in enumerate(vertices)}
+        level_bounds = np.zeros(len(levels) + 1, dtype=np.int64)
+        level_bounds[1:] = np.cumsum([len(level) for level in levels])
+        first_parents = np.full(len(vertices), -1, dtype=np.int64)
+        second_parents = np.full(len(vertices), -1, dtype=np.int64)
+        for index, vertex in enumerate(vertices):
+            for parents, parent in zip((first_parents, second_parents), self.get_parents(vertex)):
+                parents[index] = vertex_to_index[parent]
+        # The founders outside the genealogy don't contribute to the probands
+        founder_indices = np.array([vertex_to_index.get(founder, -1) for founder in founders.tolist()],
+                                   dtype=np.int64)
+        proband_indices = np.array([vertex_to_index[proband] for proband in probands.tolist()], dtype=np.int64)
+        arguments = (level_bounds, first_parents, second_parents, founder_indices, proband_indices)
+        founder_ranges = [(start, min(start + block_size, len(founders)))
+                          for start in range(0, len(founders), block_size)]
+        if processes > 1 and len(founder_ranges) > 1:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_initialize_contribution_worker,
+                                     initargs=(arguments,)) as executor:
+                blocks = list(executor.map(_propagate_contributions_in_worker, founder_ranges))
+        else:
+            blocks = [_propagate_contributions(*arguments, founder_range=founder_range)
+                      for founder_range in founder_ranges]
+        contributions = sparse.vstack(blocks, format="csr") if blocks else \
+            sparse.csr_matrix((0, len(probands)))
+        return founders, probands, contributions
 
     def calculate_kinship(self):
         """
@@ -149,7 +324,282 @@ class AbstractPedigree(GenGraph, ABC):
                 current_index += 1
         return vertex_to_index, kinship_matrix
 
-    def calculate_probands_kinship(self, probands: set[int] = None, mode: KinshipMode = KinshipMode.SPEED):
+    def get_vertex_sex(self, vertex: int):
+        """
+        Args:
+            vertex (int): The vertex id.
+
+        Returns:
+            The sex of the vertex, or None if it is unknown.
+        """
+        return self.nodes[vertex].get("sex")
+
+    def set_vertex_sex(self, vertex: int, sex: Sex):
+        """
+        Sets the sex of the vertex, which is used by the X chromosome kinship calculation.
+
+        Args:
+            vertex (int): The vertex id.
+            sex (Sex): The sex of the vertex. If None, the sex becomes unknown.
+        """
+        if sex is None:
+            self.nodes[vertex].pop("sex", None)
+        else:
+            self.nodes[vertex]["sex"] = Sex(sex)
+
+    def _read_sexes_from_file(self, filepath: str, sex_column: int, separation_symbol: str = ' ',
+                              skip_first_line: bool = False):
+        """
+        Helper function that reads the sexes of the vertices from the metadata column of the pedigree file.
+        The codes 1, M and male (2, F and female) stand for a male (female), and the other values mean that the sex
+        is unknown.
+
+        Args:
+            filepath (str): The path to the pedigree file.
+            sex_column (int): The index of the column containing the sex (the vertex id is in the column 0).
+            separation_symbol (str): The symbol used to separate the values in a line.
+            skip_first_line (bool): Specifies whether the first line in the file should be skipped.
+        """
+        def read_sex(file_line: str):
+            columns = file_line.strip('\n').split(separation_symbol)
+            if len(columns) <= sex_column:
+                return
+            vertex = int(columns[0])
+            sex = _SEX_CODES.get(columns[sex_column].strip().lower())
+            if vertex in self and sex is not None:
+                self.set_vertex_sex(vertex, sex)
+
+        self._read_file_and_parse_lines(filepath=filepath, skip_first_line=skip_first_line, parse_operation=read_sex)
+
+    @staticmethod
+    def _prune_kinship_genealogy(children_map: dict[int, list[int]], parents_map: dict[int, list[int]],
+                                 probands: Iterable[int]):
+        """
+        Helper function that removes the vertices that don't affect the kinship between the probands. The maps are
+        modified in place. The following non-proband vertices are removed until there are no such vertices left:
+
+        1. The vertices without children.
+        2. The founders with only one child. Such a founder is unrelated to everyone except its descendants, so
+           removing it doesn't change the kinships of its child (which then has only one parent, or becomes a founder
+           itself). This way, the chains of single-child ancestors above the founders collapse entirely.
+
+        Args:
+            children_map: The dictionary that maps every vertex to its children.
+            parents_map: The dictionary that maps every vertex to its parents.
+            probands: The probands.
+        """
+        if not isinstance(probands, (set, frozenset)):
+            probands = frozenset(probands)
+        candidates = list(children_map)
+        while candidates:
+            vertex = candidates.pop()
+            if vertex in probands or vertex not in children_map:
+                continue
+            vertex_children = children_map[vertex]
+            vertex_parents = parents_map[vertex]
+            if vertex_children and (vertex_parents or len(vertex_children) > 1):
+                continue
+            for child in vertex_children:
+                parents_map[child].remove(vertex)
+                candidates.append(child)
+            for parent in vertex_parents:
+                children_map[parent].remove(vertex)
+                candidates.append(parent)
+            del children_map[vertex]
+            del parents_map[vertex]
+
+    def _get_kinship_genealogy(self, probands: set[int] = None, prune: bool = True, max_generations: int = None):
+        """
+        Helper function that builds the children and parents maps for the kinship calculation.
+
+        Args:
+            probands (set[int]): The probands. If not specified, the sink vertices are used.
+            prune (bool): Specifies whether the genealogy should be pruned. Refer to
+                          :meth:`_prune_kinship_genealogy` for the details.
+            max_generations (int): If specified, only the ancestors that are at most this number of generations above
+                                   at least one proband are kept, and the ancestors at the boundary become founders.
+
+        Returns:
+            A tuple containing the probands, the children map and the parents map.
+        """
+        if probands is None and max_generations is None:
+            probands = frozenset(self.get_sink_vertices())
+            children_map = {x: self.get_children(x) for x in self}
+            parents_map = {x: self.get_parents(x) for x in self}
+        else:
+            # Calculate the ascending genealogy if the proband list is custom or the genealogy is truncated
+            # Converting the probands once, since they are checked for membership for every vertex
+            probands = frozenset(self.get_sink_vertices() if probands is None else probands)
+            ascending_genealogy: set[int] = self.get_ascending_vertices_from_probands(probands,
+                                                                                      generations=max_generations)
+            children_map = {x: list(ascending_genealogy.intersection(self.get_children(x))) for x in
+                            ascending_genealogy}
+            # The parents of the vertices at the truncation boundary are outside the genealogy
+            parents_map = {x: [parent for parent in self.get_parents(x) if parent in ascending_genealogy]
+                           for x in ascending_genealogy}
+        if prune:
+            self._prune_kinship_genealogy(children_map=children_map, parents_map=parents_map, probands=probands)
+        return probands, children_map, parents_map
+
+    def _convert_to_x_linked_genealogy(self, children_map: dict[int, list[int]],
+                                       parents_map: dict[int, list[int]]) -> set[int]:
+        """
+        Helper function that converts the kinship genealogy to the inheritance of the X chromosome. A male only
+        inherits the X chromosome from his mother, so the edges between the fathers and their sons are removed.
+        The maps are modified in place. If the sex of a vertex is unknown, it is inferred from the sex of the other
+        parent of its children.
+
+        Args:
+            children_map: The dictionary that maps every vertex to its children.
+            parents_map: The dictionary that maps every vertex to its parents.
+
+        Returns:
+            The males of the genealogy, which carry a single copy of the X chromosome.
+
+        Raises:
+            ValueError: If the sex of a vertex can't be determined, or if a male has more than one mother.
+        """
+        sexes = dict()
+        for vertex in parents_map:
+            sex = self.get_vertex_sex(vertex)
+            if sex is None:
+                partner_sexes = {self.get_vertex_sex(partner) for child in self.get_children(vertex)
+                                 for partner in self.get_parents(child) if partner != vertex}
+                partner_sexes.discard(None)
+                if len(partner_sexes) == 1:
+                    sex = Sex.FEMALE if partner_sexes.pop() == Sex.MALE else Sex.MALE
+            if sex is None:
+                raise ValueError(f"The sex of vertex {vertex} is unknown")
+            sexes[vertex] = sex
+        males = {vertex for vertex, sex in sexes.items() if sex == Sex.MALE}
+        for male in males:
+            mothers = [parent for parent in parents_map[male] if sexes[parent] == Sex.FEMALE]
+            if len(mothers) > 1:
+                raise ValueError(f"Vertex {male} has more than one mother")
+            for parent in parents_map[male]:
+                if sexes[parent] == Sex.MALE:
+                    children_map[parent].remove(male)
+            parents_map[male] = mothers
+        return males
+
+    def _get_compact_value_size(self, max_error: float) -> int:
+        """
+        Helper function that chooses the size of the fixed-point values used in the COMPACT mode.
+
+        Args:
+            max_error (float): The maximum absolute error of the kinships.
+
+        Returns:
+            The size of a value in bytes (2 or 4).
+
+        Raises:
+            ValueError: If even the 32-bit values can't guarantee the given error bound.
+        """
+        # Every generation adds at most half a unit in the last place to the error bound of a vertex, and
+        # the error of a pair is bounded by the sum of the vertices' bounds
+        generations = len(self.get_levels())
+        if generations * 2 ** -15 <= max_error:
+            return 2
+        if generations * 2 ** -31 <= max_error:
+            return 4
+        raise ValueError(f"The error bound {max_error} is too small for {generations} generations")
+
+    @staticmethod
+    def _get_ordering_arguments(ordering: KinshipOrdering, vertex_order: Iterable[int] = None) -> dict:
+        """
+        Helper function that converts the ordering of the kinship calculation into the native module arguments.
+        """
+        if vertex_order is not None:
+            return {"ordering": "explicit", "vertex_order": list(vertex_order)}
+        return {"ordering": ordering.value, "vertex_order": None}
+
+    def _plan_kinship_calculation(self, probands: set[int], children_map: dict[int, list[int]],
+                                  parents_map: dict[int, list[int]], max_error: float,
+                                  ordering: KinshipOrdering, vertex_order: Iterable[int] = None,
+                                  column_probands: set[int] = None) -> dict:
+        """
+        Helper function that replays the kinship calculation on the given genealogy. Refer to
+        :meth:`plan_probands_kinship` for the details.
+        """
+        peak_frontier, pair_updates, processed_vertices, storage_estimates = kinship.plan_kinship_sparse(
+            sink_vertices=probands, children=children_map, parents=parents_map,
+            **self._get_ordering_arguments(ordering=ordering, vertex_order=vertex_order),
+            column_vertices=None if column_probands is None else set(column_probands)
+        )
+        memory_estimates = {KinshipMode.SPEED: storage_estimates["speed"],
+                            KinshipMode.MEMORY: storage_estimates["memory"]}
+        try:
+            compact_storage = f"compact{8 * self._get_compact_value_size(max_error)}"
+            memory_estimates[KinshipMode.COMPACT] = storage_estimates[compact_storage]
+        except ValueError:
+            pass
+        return {
+            "peak_frontier": peak_frontier,
+            "pair_updates": pair_updates,
+            "processed_vertices": processed_vertices,
+            "memory_estimates": memory_estimates
+        }
+
+    def plan_probands_kinship(self, probands: set[int] = None, prune: bool = True, max_error: float = 1e-3,
+                              ordering: KinshipOrdering = KinshipOrdering.ADDITIONAL_SPACE,
+                              vertex_order: Iterable[int] = None, max_generations: int = None,
+                              column_probands: set[int] = None) -> dict:
+        """
+        Replays the order in which :meth:`calculate_probands_kinship` processes the vertices without calculating
+        the kinships and estimates the resources needed for the calculation. The replay takes a small fraction of
+        the calculation time, and its memory usage is linear in the size of the genealogy.
+
+        Args:
+            probands (set[int]): The probands. If not specified, the sink vertices are used.
+            prune (bool): Specifies whether the genealogy should be pruned (as in :meth:`calculate_probands_kinship`).
+            max_error (float): The maximum absolute error in the COMPACT mode, which determines the value size.
+            ordering (KinshipOrdering): The order in which the vertices are processed
+                                        (as in :meth:`calculate_probands_kinship`).
+            vertex_order (Iterable[int]): The explicit order in which the vertices are processed
+                                          (as in :meth:`calculate_probands_kinship`).
+            max_generations (int): The number of generations above the probands that are taken into account
+                                   (as in :meth:`calculate_probands_kinship`).
+            column_probands (set[int]): If specified, only the kinships between the probands and the column probands
+                                        are planned (as in :meth:`calculate_probands_kinship`).
+
+        Returns:
+            A dictionary containing:
+                1. "peak_frontier" - the maximum number of vertices kept in the kinship matrix at the same time.
+                2. "pair_updates" - the total number of calculated kinship values. The running time of
+                   the calculation is proportional to this number.
+                3. "processed_vertices" - the number of processed vertices.
+                4. "memory_estimates" - the dictionary mapping every :class:`KinshipMode` to the estimated peak
+                   memory usage of the kinship matrix in bytes. The estimates are derived from the sizes of
+                   the entries and the rows of the native storages and the lowest load of their hash maps, so they
+                   are upper bounds on the memory taken by the matrix itself (the dead entries of the MEMORY mode
+                   aside). The actual usage of a returned matrix can be obtained by calling get_memory_usage on it.
+                   With the column probands, only the needed pairs are counted in the SPEED and the MEMORY modes,
+                   while the COMPACT mode keeps all the pairs of the frontier. The COMPACT mode is missing if
+                   the error bound can't be satisfied.
+
+        Example:
+            >>> plan = pedigree.plan_probands_kinship()
+            >>> speed_mode_bytes = plan["memory_estimates"][KinshipMode.SPEED]
+        """
+        if column_probands is not None:
+            row_probands = frozenset(self.get_sink_vertices()) if probands is None else frozenset(probands)
+            probands = row_probands.union(column_probands)
+        probands, children_map, parents_map = self._get_kinship_genealogy(probands=probands, prune=prune,
+                                                                           max_generations=max_generations)
+        if column_probands is not None:
+            probands = row_probands
+        return self._plan_kinship_calculation(probands=probands, children_map=children_map,
+                                              parents_map=parents_map, max_error=max_error,
+                                              ordering=ordering, vertex_order=vertex_order,
+                                              column_probands=column_probands)
+
+    def calculate_probands_kinship(self, probands: set[int] = None, mode: KinshipMode = KinshipMode.SPEED,
+                                   prune: bool = True, max_error: float = 1e-3, memory_budget: int = None,
+                                   ordering: KinshipOrdering = KinshipOrdering.ADDITIONAL_SPACE,
+                                   vertex_order: Iterable[int] = None, checkpoint_path: str = None,
+                                   checkpoint_interval: float = 3600, column_probands: set[int] = None,
+                                   max_generations: int = None, epsilon: float = 0,
+                                   chromosome: KinshipChromosome = KinshipChromosome.AUTOSOMAL):
         """
         Calculates the all-pairwise kinship coefficients for the given list of vertices.
 
@@ -162,36 +612,459 @@ class AbstractPedigree(GenGraph, ABC):
                                 Alternatively, the MEMORY option is available for cases where memory usage is a concern.
                                 On average, the MEMORY option reduces memory usage by approximately 25% but results in
                                 about 40% additional running time.
+                                The COMPACT option stores the kinships of the processed vertices in a dense
+                                triangular matrix of 16-bit (or 32-bit) fixed-point numbers, which takes 2 (or 4)
+                                bytes per pair. The results are approximate, but their error is bounded by max_error.
+            prune (bool): Specifies whether the vertices that can't affect the probands' kinships should be removed
+                          before the calculation. These are the non-proband vertices without children and
+                          the non-proband founders with a single child (including the chains of such ancestors).
+                          The pruning doesn't change the result, but reduces the running time and
+                          the memory usage. By default, the pruning is enabled.
+            max_error (float): The maximum absolute error of the kinships allowed in the COMPACT mode. The 16-bit
+                               values are used if their error bound (2^-15 per generation) satisfies this limit,
+                               otherwise the 32-bit values are used. The actual error bound of the result can be
+                               obtained by calling get_error_bound on the returned matrix.
+            memory_budget (int): If specified, the mode argument is ignored, and the mode is chosen automatically.
+                                 The calculation is planned with :meth:`plan_probands_kinship`, and the first mode
+                                 among SPEED, MEMORY and COMPACT whose estimated memory usage (in bytes) fits
+                                 the budget is used.
+            ordering (KinshipOrdering): The order in which the vertices whose parents have been processed are
+                                        processed. The order determines the peak number of vertices kept in
+                                        the matrix (the peak frontier), which determines the memory usage and
+                                        the running time. The following options are available:
+                                        ADDITIONAL_SPACE (default) - the children that become ready together are
+                                        processed as a batch, and the batches that increase the frontier the least
+                                        go first.
+                                        GENERATION - the vertices are processed generation by generation, starting
+                                        from the vertices with the greatest level.
+                                        MIN_FILL - the vertex whose processing increases the frontier the least
+                                        goes first.
+            vertex_order (Iterable[int]): If specified, the ordering argument is ignored, and the vertices are
+                                          processed in the given order (as soon as their parents have been
+                                          processed). The order must contain all the vertices of the genealogy.
+            checkpoint_path (str): If specified, the state of the calculation (the kept kinships, the counters of
+                                   the unprocessed children and parents and the queue) is periodically saved to
+                                   this file. If the file already exists, the calculation is resumed from it.
+                                   The file is removed after the calculation finishes. A checkpoint can only be
+                                   resumed with the same genealogy, probands, mode and ordering.
+            checkpoint_interval (float): The number of seconds between the checkpoints.
+            column_probands (set[int]): If specified, only the kinships between the probands (the rows) and
+                                        the column probands are calculated. The pairs that can't contribute to
+                                        these kinships are neither calculated nor stored, and the pairs between
+                                        two rows (or two columns) are removed as soon as all the children of
+                                        the vertices have been processed, so that the memory usage scales with
+                                        the row-column block. The other pairs of the returned matrix are
+                                        unavailable. In the COMPACT mode, the dense matrix still keeps all
+                                        the pairs of the frontier.
+            max_generations (int): If specified, only the ancestors that are at most this number of generations above
+                                   at least one of the probands are taken into account. The more distant ancestors
+                                   are not traversed at all, and the ancestors at the boundary are treated as
+                                   unrelated founders, so the result only reflects the relatedness through the recent
+                                   generations. Zero generations make all the probands unrelated. The cut is shared by
+                                   all the probands: an ancestor within this number of generations of one proband is
+                                   traversed for the other probands as well, so the kinship of a pair can depend on
+                                   the other probands in the set.
+            epsilon (float): If positive, the kinships below this threshold are not stored and are treated as zeros
+                             in the further calculation, so that the matrix only keeps the non-negligible pairs of
+                             weakly related populations. Every vertex accumulates the bound of the error caused by
+                             the dropped entries (the maximum of its parents' bounds plus epsilon if any of its
+                             kinships has been dropped), and the error of a pair is at most the sum of the bounds of
+                             its vertices. The resulting bound can be obtained by calling get_error_bound on
+                             the returned matrix, and the missing pairs of the returned matrix are zeros.
+                             Only supported in the SPEED mode without the column probands.
+            chromosome (KinshipChromosome): The chromosome for which the kinships are calculated. By default,
+                                            the autosomal kinships are calculated. For the X chromosome, the sexes
+                                            of the vertices are taken into account: a male inherits his only X
+                                            chromosome from his mother, so his self-kinship is 1 and his kinships
+                                            are the kinships of his mother, while the father-son relationships are
+                                            ignored. The sexes are set by :meth:`set_vertex_sex` (or read from
+                                            the pedigree file), and an unknown sex is inferred from the other parent
+                                            of the vertex's children.
 
         Returns:
-            The kinship matrix for the probands.
+            The kinship matrix for the probands. The peak frontier reached during the calculation can be obtained by
+            calling get_peak_frontier_size on the returned matrix.
+
+        Raises:
+            ValueError: If the memory budget is specified and no mode fits it, if the checkpoint has been
+                        created for a different calculation, or if epsilon is negative or is used with a mode other
+                        than SPEED or with the column probands, or if the X chromosome kinships are calculated and
+                        the sex of a vertex can't be determined.
 
         Example:
             >>> kinship_matrix = pedigree.calculate_probands_kinship()
             >>> probands_kinship = kinship_matrix.get_kinship(proband, other_proband)
         """
-        if probands is None:
-            probands = frozenset(self.get_sink_vertices())
-            children_map = {x: self.get_children(x) for x in self}
-            parents_map = {x: self.get_parents(x) for x in self}
-        else:
-            # Calculate the ascending genealogy if the proband list is custom
-            ascending_genealogy: set[int] = self.get_ascending_vertices_from_probands(probands)
-            children_map = {x: list(ascending_genealogy.intersection(self.get_children(x))) for x in
-                            ascending_genealogy}
-            parents_map = {x: self.get_parents(x) for x in ascending_genealogy}
+        if epsilon < 0:
+            raise ValueError("Epsilon must be non-negative")
+        if epsilon and (memory_budget is not None or mode != KinshipMode.SPEED or column_probands is not None):
+            raise ValueError("Dropping the negligible kinships is only supported in the SPEED mode without "
+                             "the memory budget and the column probands")
+        additional_arguments = {}
+        if column_probands is not None:
+            row_probands = frozenset(self.get_sink_vertices()) if probands is None else frozenset(probands)
+            additional_arguments["column_vertices"] = set(column_probands)
+            probands = row_probands.union(column_probands)
+        is_x_linked = chromosome == KinshipChromosome.X
+        # The X chromosome genealogy is pruned after the father-son edges have been removed
+        probands, children_map, parents_map = self._get_kinship_genealogy(probands=probands,
+                                                                           prune=prune and not is_x_linked,
+                                                                           max_generations=max_generations)
+        if is_x_linked:
+            males = self._convert_to_x_linked_genealogy(children_map=children_map, parents_map=parents_map)
+            if prune:
+                self._prune_kinship_genealogy(children_map=children_map, parents_map=parents_map, probands=probands)
+            additional_arguments["hemizygous_vertices"] = males.intersection(parents_map)
+        if column_probands is not None:
+            probands = row_probands
+        if memory_budget is not None:
+            memory_estimates = self._plan_kinship_calculation(probands=probands, children_map=children_map,
+                                                              parents_map=parents_map,
+                                                              max_error=max_error, ordering=ordering,
+                                                              vertex_order=vertex_order,
+                                                              column_probands=column_probands)["memory_estimates"]
+            fitting_modes = [x for x in (KinshipMode.SPEED, KinshipMode.MEMORY, KinshipMode.COMPACT)
+                             if memory_estimates.get(x, memory_budget + 1) <= memory_budget]
+            if not fitting_modes:
+                raise ValueError(f"The kinship calculation requires at least {min(memory_estimates.values())} bytes, "
+                                 f"which exceeds the memory budget of {memory_budget} bytes")
+            mode = fitting_modes[0]
         if mode == KinshipMode.SPEED:
-            kinship_sparse_matrix = kinship.calculate_kinship_sparse_speed(
-                sink_vertices=probands, children=children_map,
-                parents=parents_map
-            )
+            calculate_kinship_sparse = kinship.calculate_kinship_sparse_speed
+            additional_arguments["drop_threshold"] = epsilon
+        elif mode == KinshipMode.MEMORY:
+            calculate_kinship_sparse = kinship.calculate_kinship_sparse_memory
+        elif self._get_compact_value_size(max_error) == 2:
+            calculate_kinship_sparse = kinship.calculate_kinship_sparse_compact16
         else:
-            kinship_sparse_matrix = kinship.calculate_kinship_sparse_memory(
-                sink_vertices=probands, children=children_map,
-                parents=parents_map
-            )
+            calculate_kinship_sparse = kinship.calculate_kinship_sparse_compact32
+        kinship_sparse_matrix = calculate_kinship_sparse(
+            sink_vertices=probands, children=children_map,
+            parents=parents_map, **self._get_ordering_arguments(ordering=ordering, vertex_order=vertex_order),
+            checkpoint_path=None if checkpoint_path is None else str(checkpoint_path),
+            checkpoint_interval=checkpoint_interval, **additional_arguments
+        )
         return kinship_sparse_matrix
 
+    def calculate_group_mean_kinship(self, proband_groups: dict, mode: KinshipMode = KinshipMode.SPEED,
+                                     prune: bool = True, max_error: float = 1e-3, include_self: bool = False,
+                                     ordering: KinshipOrdering = KinshipOrdering.ADDITIONAL_SPACE,
+                                     vertex_order: Iterable[int] = None, checkpoint_path: str = None,
+                                     checkpoint_interval: float = 3600,
+                                     max_generations: int = None) -> (list, np.ndarray):
+        """
+        Calculates the mean kinship within and between the groups of probands (for example, regions or cohorts)
+        without calculating the proband kinship matrix.
+
+        The sums of the kinships are accumulated by the native calculation: the probands are not retained, and every
+        vertex of the frontier keeps the sums of its kinships with the probands of every group that have already left
+        the frontier. The memory usage is therefore determined by the peak frontier and the number of groups rather
+        than by the number of probands.
+
+        Args:
+            proband_groups (dict): The dictionary mapping every proband to the label of its group.
+            mode (KinshipMode): The running mode of the kinship calculation (as in :meth:`calculate_probands_kinship`).
+            prune (bool): Specifies whether the genealogy should be pruned (as in :meth:`calculate_probands_kinship`).
+            max_error (float): The maximum absolute error of the kinships in the COMPACT mode.
+            include_self (bool): Specifies whether the self-kinships of the probands are included in the mean kinship
+                                 within a group. By default, only the pairs of different probands are averaged.
+            ordering (KinshipOrdering): The order in which the vertices are processed
+                                        (as in :meth:`calculate_probands_kinship`).
+            vertex_order (Iterable[int]): The explicit order in which the vertices are processed
+                                          (as in :meth:`calculate_probands_kinship`).
+            checkpoint_path (str): The checkpoint file (as in :meth:`calculate_probands_kinship`).
+            checkpoint_interval (float): The number of seconds between the checkpoints.
+            max_generations (int): The number of generations above the probands that are taken into account
+                                   (as in :meth:`calculate_probands_kinship`).
+
+        Returns:
+            Tuple[list, np.ndarray]: A tuple containing:
+                1. The sorted group labels.
+                2. The symmetric matrix with the mean kinships, where the i-th row (column) corresponds to
+                   the i-th group. The mean kinship within a group consisting of a single proband is NaN unless
+                   the self-kinships are included.
+
+        Example:
+            >>> groups, mean_kinships = pedigree.calculate_group_mean_kinship({1: "north", 2: "north", 3: "south"})
+        """
+        groups = sorted(set(proband_groups.values()))
+        group_to_index = {group: index for index, group in enumerate(groups)}
+        probands, children_map, parents_map = self._get_kinship_genealogy(probands=set(proband_groups), prune=prune,
+                                                                           max_generations=max_generations)
+        if mode == KinshipMode.SPEED:
+            storage = "speed"
+        elif mode == KinshipMode.MEMORY:
+            storage = "memory"
+        else:
+            storage = f"compact{8 * self._get_compact_value_size(max_error)}"
+        pair_sums, self_sums, _ = kinship.calculate_group_kinship_sums(
+            children=children_map, parents=parents_map,
+            proband_groups={proband: group_to_index[group] for proband, group in proband_groups.items()},
+            groups_number=len(groups), storage=storage,
+            **self._get_ordering_arguments(ordering=ordering, vertex_order=vertex_order),
+            checkpoint_path=None if checkpoint_path is None else str(checkpoint_path),
+            checkpoint_interval=checkpoint_interval
+        )
+        group_sizes = np.bincount([group_to_index[group] for group in proband_groups.values()],
+                                  minlength=len(groups)).astype(np.float64)
+        pair_counts = np.outer(group_sizes, group_sizes)
+        if include_self:
+            pair_sums[np.diag_indices(len(groups))] += self_sums
+        else:
+            pair_counts[np.diag_indices(len(groups))] -= group_sizes
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return groups, pair_sums / pair_counts
+
+    def _get_topologically_sorted_parent_indices(self) -> (list[int], list[int], list[int]):
+        """
+        Helper function that sorts the vertices so that every parent precedes its children (the top level goes
+        first) and returns the parents of every vertex as indices in this order.
+
+        Returns:
+            A tuple containing the sorted vertices, the indices of the first parents and the indices of
+            the second parents. A missing parent is represented by -1.
+        """
+        vertices = [vertex for level in reversed(self.get_levels()) for vertex in level]
+        vertex_to_index = {vertex: index for index, vertex in enumerate(vertices)}
+        first_parents = [-1] * len(vertices)
+        second_parents = [-1] * len(vertices)
+        for index, vertex in enumerate(vertices):
+            vertex_parents = self.get_parents(vertex)
+            if vertex_parents:
+                first_parents[index] = vertex_to_index[vertex_parents[0]]
+                if len(vertex_parents) > 1:
+                    second_parents[index] = vertex_to_index[vertex_parents[1]]
+        return vertices, first_parents, second_parents
+
+    def calculate_inbreeding(self) -> (np.ndarray, np.ndarray):
+        """
+        Calculates the inbreeding coefficients (that is, 2 * self-kinship - 1) for all the vertices in the pedigree
+        using the Meuwissen and Luo algorithm. Unlike :meth:`calculate_kinship`, the memory usage is linear in
+        the size of the pedigree.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: A tuple containing:
+                1. A numpy array with the vertex ids.
+                2. A numpy array with the inbreeding coefficients, where the i-th value corresponds to
+                   the i-th vertex id.
+
+        Example:
+            >>> vertices, inbreeding_coefficients = pedigree.calculate_inbreeding()
+            >>> vertex_inbreeding = dict(zip(vertices, inbreeding_coefficients))[vertex]
+        """
+        vertices, first_parents, second_parents = self._get_topologically_sorted_parent_indices()
+        inbreeding_coefficients = kinship.calculate_inbreeding_coefficients(first_parents=first_parents,
+                                                                           second_parents=second_parents)
+        return np.array(vertices), inbreeding_coefficients
+
+    def calculate_inverse_relationship_matrix(self) -> (np.ndarray, sparse.csr_matrix):
+        """
+        Builds the inverse of the numerator relationship matrix A (that is, 2 * kinship) directly from the parents
+        using Henderson's rules with Quaas' adjustment for the inbreeding of the parents. The running time and
+        the number of non-zero values are linear in the size of the pedigree, so the inverse can be used in
+        the mixed model equations without calculating and inverting the dense matrix.
+
+        Every vertex i contributes alpha = 1 / d_i to its own diagonal entry, -alpha / 2 to the entries between
+        itself and each of its parents and alpha / 4 to the entries between every pair of its parents, where d_i
+        (the Mendelian sampling variance) is 1 for the founders, 3/4 - F_p / 4 if only parent p is known and
+        1/2 - (F_p + F_q) / 4 if both parents are known.
+
+        Returns:
+            Tuple[np.ndarray, scipy.sparse.csr_matrix]: A tuple containing:
+                1. A numpy array with the vertex ids.
+                2. The inverse relationship matrix, where the i-th row (column) corresponds to the i-th vertex id.
+
+        Example:
+            >>> vertices, inverse_matrix = pedigree.calculate_inverse_relationship_matrix()
+            >>> vertex_to_index = {vertex: index for index, vertex in enumerate(vertices)}
+        """
+        vertices, first_parents, second_parents = self._get_topologically_sorted_parent_indices()
+        inbreeding_coefficients = kinship.calculate_inbreeding_coefficients(first_parents=first_parents,
+                                                                           second_parents=second_parents)
+        first_parents = np.array(first_parents, dtype=np.int64)
+        second_parents = np.array(second_parents, dtype=np.int64)
+        # Making the first parent the known one if only one parent is known
+        only_second_known = (first_parents < 0) & (second_parents >= 0)
+        first_parents[only_second_known] = second_parents[only_second_known]
+        second_parents[only_second_known] = -1
+        first_known = first_parents >= 0
+        second_known = second_parents >= 0
+        mendelian_variances = np.ones(len(vertices))
+        mendelian_variances[first_known] = 0.75 - 0.25 * inbreeding_coefficients[first_parents[first_known]]
+        mendelian_variances[second_known] -= 0.25 + 0.25 * inbreeding_coefficients[second_parents[second_known]]
+        alphas = 1.0 / mendelian_variances
+        indices = np.arange(len(vertices), dtype=np.int64)
+        rows = [indices]
+        columns = [indices]
+        values = [alphas]
+        for parents, known in ((first_parents, first_known), (second_parents, second_known)):
+            children = indices[known]
+            known_parents = parents[known]
+            rows.extend((children, known_parents, known_parents))
+            columns.extend((known_parents, children, known_parents))
+            values.extend((-alphas[known] / 2, -alphas[known] / 2, alphas[known] / 4))
+        children = indices[second_known]
+        for first, second in ((first_parents, second_parents), (second_parents, first_parents)):
+            rows.append(first[children])
+            columns.append(second[children])
+            values.append(alphas[children] / 4)
+        size = len(vertices)
+        # The duplicate entries are summed during the conversion
+        inverse_matrix = sparse.coo_matrix((np.concatenate(values), (np.concatenate(rows), np.concatenate(columns))),
+                                           shape=(size, size)).tocsr()
+        return np.array(vertices), inverse_matrix
+
+    def get_pairwise_kinship_calculator(self, vertices: Iterable[int] = None,
+                                        cache_size: int = 10_000_000) -> kinship.PairwiseKinshipCalculator:
+        """
+        Builds an object that calculates the kinship for individual pairs of vertices on demand. Unlike
+        :meth:`calculate_probands_kinship`, it doesn't sweep the whole ascending genealogy. Instead, it uses the
+        recursive definition of kinship, so the running time depends only on the joint ancestry of the queried pairs.
+        The intermediate values are kept in a memo table that is shared between all the queries.
+
+        Args:
+            vertices (Iterable[int]): The vertices that will be queried. Only their ascending genealogy is passed to
+                                      the calculator. If not specified, the whole pedigree is used.
+            cache_size (int): The maximum number of intermediate values kept in the memo table. When the table is full,
+                              the least recently used values are evicted.
+
+        Returns:
+            The pairwise kinship calculator.
+
+        Example:
+            >>> calculator = pedigree.get_pairwise_kinship_calculator()
+            >>> pair_kinship = calculator.get_kinship(vertex_1, vertex_2)
+            >>> kinships = calculator.get_kinships(np.array([vertex_1, vertex_2]), np.array([vertex_3, vertex_4]))
+        """
+        if vertices is None:
+            genealogy_vertices = list(self)
+        else:
+            genealogy_vertices = list(self.get_ascending_vertices_from_probands(vertices))
+        vertex_to_index = {vertex: index for index, vertex in enumerate(genealogy_vertices)}
+        parent_indices = [[-1, -1] for _ in genealogy_vertices]
+        for index, vertex in enumerate(genealogy_vertices):
+            for parent_number, parent in enumerate(self.get_parents(vertex)):
+                parent_indices[index][parent_number] = vertex_to_index[parent]
+        first_parents, second_parents = zip(*parent_indices) if parent_indices else ((), ())
+        levels = [self.get_vertex_level(vertex) for vertex in genealogy_vertices]
+        return kinship.PairwiseKinshipCalculator(vertices=genealogy_vertices, first_parents=list(first_parents),
+                                                 second_parents=list(second_parents), levels=levels,
+                                                 cache_size=cache_size)
+
+    def calculate_pairs_kinship(self, first_vertices: Iterable[int], second_vertices: Iterable[int],
+                                cache_size: int = 10_000_000) -> np.ndarray:
+        """
+        Calculates the kinship coefficients for the given list of pairs without building the kinship matrix. This
+        method is preferable to :meth:`calculate_probands_kinship` when only a small number of pairs is needed
+        in a large pedigree. Refer to :meth:`get_pairwise_kinship_calculator` for the details.
+
+        Args:
+            first_vertices (Iterable[int]): The first vertices of the pairs.
+            second_vertices (Iterable[int]): The second vertices of the pairs.
+            cache_size (int): The maximum number of intermediate values kept in the memo table.
+
+        Returns:
+            The numpy array with the kinship coefficients for the pairs.
+
+        Example:
+            >>> kinships = pedigree.calculate_pairs_kinship([vertex_1, vertex_2], [vertex_3, vertex_4])
+        """
+        first_vertices = np.asarray(list(first_vertices), dtype=np.int32)
+        second_vertices = np.asarray(list(second_vertices), dtype=np.int32)
+        calculator = self.get_pairwise_kinship_calculator(
+            vertices=set(first_vertices.tolist()).union(second_vertices.tolist()), cache_size=cache_size
+        )
+        return calculator.get_kinships(first_vertices, second_vertices)
+
+    def find_related_pairs(self, threshold: float, max_generations: int, probands: Iterable[int] = None,
+                           cache_size: int = 10_000_000,
+                           batch_size: int = 1_000_000) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Finds the pairs of probands whose kinship is at least the given threshold (for example, the close relatives)
+        without calculating the proband kinship matrix.
+
+        The search is heuristic: only the pairs of probands sharing an ancestor within max_generations generations
+        of both of them (a proband is its own ancestor at distance 0) are considered, and the kinships of these
+        candidate pairs are calculated exactly (by the pairwise kinship calculator, refer to
+        :meth:`get_pairwise_kinship_calculator`). A single path through a more distant common ancestor contributes at
+        most 2^-(max_generations + 1), but many such paths can add up to the threshold (for example, when the probands
+        descend from the same couple through several lines), so the pairs related only through the distant ancestors
+        are missed. The search is exact if max_generations is at least the number of levels of the pedigree.
+
+        Args:
+            threshold (float): The minimum kinship of the returned pairs.
+            max_generations (int): The number of generations in which the probands must share an ancestor to be
+                                   considered.
+            probands (Iterable[int]): The probands. If not specified, the sink vertices are used.
+            cache_size (int): The maximum number of intermediate values kept by the pairwise kinship calculator.
+            batch_size (int): The number of candidate pairs whose kinships are calculated at once. The candidate pairs
+                              are never kept all together, so the memory usage doesn't depend on their number.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: A tuple containing the first probands, the second probands
+            (every pair is returned once, with the smaller proband first) and the kinships of the found pairs.
+
+        Raises:
+            ValueError: If the threshold is not positive or the number of generations is negative.
+
+        Example:
+            >>> first_probands, second_probands, kinships = pedigree.find_related_pairs(threshold=0.0625,
+            ...                                                                         max_generations=5)
+        """
+        if threshold <= 0:
+            raise ValueError("The threshold must be positive")
+        if max_generations < 0:
+            raise ValueError("The number of generations must be non-negative")
+        if probands is None:
+            probands = self.get_sink_vertices()
+        probands = np.array(sorted(probands), dtype=np.int32)
+        # Every ancestor is mapped to the sorted indices of the probands that have it within max_generations
+        # generations
+        proband_ancestors = [list(self.get_ancestors_within_generations(vertex=proband, generations=max_generations))
+                             for proband in probands.tolist()]
+        ancestor_to_probands = defaultdict(list)
+        for index, ancestors in enumerate(proband_ancestors):
+            for ancestor in ancestors:
+                ancestor_to_probands[ancestor].append(index)
+        ancestor_to_probands = {ancestor: np.array(indices, dtype=np.int64)
+                                for ancestor, indices in ancestor_to_probands.items() if len(indices) > 1}
+        calculator = self.get_pairwise_kinship_calculator(vertices=probands.tolist(), cache_size=cache_size)
+        found_pairs = []
+        candidate_batch = []
+        candidates_number = 0
+
+        def process_candidate_batch():
+            first_probands = np.concatenate([np.full(len(partners), first) for first, partners in candidate_batch])
+            second_probands = probands[np.concatenate([partners for _, partners in candidate_batch])]
+            kinships = calculator.get_kinships(first_probands, second_probands)
+            is_related = kinships >= threshold
+            found_pairs.append((first_probands[is_related], second_probands[is_related], kinships[is_related]))
+            candidate_batch.clear()
+
+        # The partners of every proband are deduplicated on their own, so that only the distinct candidate pairs
+        # are materialized
+        for index, ancestors in enumerate(proband_ancestors):
+            partner_arrays = []
+            for ancestor in ancestors:
+                ancestor_probands = ancestor_to_probands.get(ancestor)
+                if ancestor_probands is not None:
+                    partner_arrays.append(ancestor_probands[np.searchsorted(ancestor_probands, index, side="right"):])
+            if not partner_arrays:
+                continue
+            partners = np.unique(np.concatenate(partner_arrays))
+            if not len(partners):
+                continue
+            candidate_batch.append((probands[index], partners))
+            candidates_number += len(partners)
+            if candidates_number >= batch_size:
+                process_candidate_batch()
+                candidates_number = 0
+        if candidate_batch:
+            process_candidate_batch()
+        if not found_pairs:
+            return np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int32), np.empty(0, dtype=np.float32)
+        return tuple(np.concatenate(arrays) for arrays in zip(*found_pairs))
+
     def _select_new_parent_from_level(self, level_index: int, vertex_parents: Iterable[int]):
         # We need to select a vertex from the level_index level.
         # The obvious solution would be to take all the vertices from that level and remove all the parent vertices.
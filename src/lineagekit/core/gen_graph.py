@@ -329,16 +329,28 @@ class GenGraph(nx.DiGraph):
         """
         return len(self.nodes)
 
-    def get_ascending_vertices_from_probands(self, probands: Iterable[int]) -> {int}:
+    def get_ascending_vertices_from_probands(self, probands: Iterable[int], generations: int = None) -> {int}:
         """
         This method returns all the vertices in the ascending graph for the given list of vertices.
 
         Args:
             probands (Iterable[int]): The vertices for which the ascending graph should be calculated.
+            generations (int): If specified, only the ancestors that are at most this number of generations above
+                               at least one of the vertices are included, and the traversal stops there.
 
         Returns:
             The vertices in the ascending graph.
         """
+        if generations is not None:
+            result = {vertex for vertex in probands if vertex in self.nodes}
+            current_generation = result
+            for _ in range(generations):
+                current_generation = {parent for child in current_generation for parent in self.get_parents(child)
+                                      if parent not in result}
+                if not current_generation:
+                    break
+                result.update(current_generation)
+            return result
         result = set()
         for vertex in probands:
             if vertex in self.nodes:
@@ -346,6 +358,29 @@ class GenGraph(nx.DiGraph):
                 result.update(nx.ancestors(self, vertex))
         return result
 
+    def get_ancestors_within_generations(self, vertex: int, generations: int, include_self: bool = True) -> {int}:
+        """
+        Returns the ancestors of the vertex that are at most the given number of generations above it.
+
+        Args:
+            vertex (int): The vertex.
+            generations (int): The maximum number of generations between the vertex and its ancestors.
+            include_self (bool): Specifies whether the vertex itself (at distance 0) should be added to the result.
+
+        Returns:
+            The set of the ancestors.
+        """
+        ancestors = {vertex}
+        current_generation = [vertex]
+        for _ in range(generations):
+            next_generation = {parent for child in current_generation for parent in self.get_parents(child)
+                               if parent not in ancestors}
+            ancestors.update(next_generation)
+            current_generation = next_generation
+        if not include_self:
+            ancestors.discard(vertex)
+        return ancestors
+
     def get_connected_component_for_vertex(self, vertex: int) -> [int]:
         """
         The function finds all the vertices that are in the same connected component as the passed vertex.
@@ -0,0 +1,194 @@
+from __future__ import annotations
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable
+
+import numpy as np
+from scipy import sparse
+
+from lineagekit.core.abstract_pedigree import AbstractPedigree
+from lineagekit.core.ploid_pedigree import PloidPedigree
+
+# The simulation arrays shared by the worker processes
+_worker_arguments = None
+
+
+def _initialize_worker(arguments):
+    global _worker_arguments
+    _worker_arguments = arguments
+
+
+def _drop_genes_in_worker(replicates: int, seed_sequence: np.random.SeedSequence) -> np.ndarray:
+    return _drop_genes(*_worker_arguments, replicates=replicates, seed_sequence=seed_sequence)
+
+
+def _drop_genes(ordered_slots: np.ndarray, level_bounds: np.ndarray, first_sources: np.ndarray,
+                second_sources: np.ndarray, founder_slots: np.ndarray, proband_slots: np.ndarray,
+                replicates: int, seed_sequence: np.random.SeedSequence) -> np.ndarray:
+    """
+    Simulates the given number of replicates at once. Every allele slot takes the allele of its first or second
+    source slot with equal probability, and the slots of one level are processed together.
+
+    Returns:
+        The founder allele indices of the proband slots. The array has the shape (proband slots, replicates).
+    """
+    generator = np.random.default_rng(seed_sequence)
+    alleles = np.empty((len(first_sources), replicates), dtype=np.int32)
+    alleles[founder_slots] = np.arange(len(founder_slots), dtype=np.int32)[:, np.newaxis]
+    for start, end in zip(level_bounds[:-1], level_bounds[1:]):
+        slots = ordered_slots[start:end]
+        take_second = generator.random((len(slots), replicates)) < 0.5
+        alleles[slots] = np.where(take_second, alleles[second_sources[slots]], alleles[first_sources[slots]])
+    return alleles[proband_slots]
+
+
+class GeneDropping:
+    """
+    Simulates the transmission of the founder alleles to the probands (gene dropping) on the ascending genealogy of
+    the probands.
+
+    Every vertex of a :class:`Pedigree` is a diploid individual with two allele slots, where the i-th slot receives
+    one of the two alleles of the i-th parent (chosen with equal probability). Every vertex of a
+    :class:`PloidPedigree` is a ploid with one slot, which receives the allele of one of its parents (the ploids of
+    the parent individual). The slots without a parent carry unique founder alleles.
+
+    The replicates are simulated in batches, and every batch is a NumPy array with a column per replicate that is
+    filled level by level. Every batch uses its own random stream spawned from the seed, so the result only
+    depends on the seed and the batch size, and the batches can be simulated in parallel processes.
+
+    Example:
+        >>> gene_dropping = GeneDropping(pedigree)
+        >>> proband_alleles = gene_dropping.simulate(replicates=10_000, seed=42)
+        >>> probands, kinship_matrix = gene_dropping.estimate_kinship(replicates=10_000, seed=42)
+    """
+
+    def __init__(self, pedigree: AbstractPedigree, probands: Iterable[int] = None):
+        """
+        Prepares the transmission arrays for the ascending genealogy of the probands.
+
+        Args:
+            pedigree (AbstractPedigree): The pedigree.
+            probands (Iterable[int]): The vertices for which the alleles are simulated. If not specified,
+                                      the sink vertices are used.
+        """
+        if probands is None:
+            probands = pedigree.get_sink_vertices()
+        self._probands = np.array(sorted(probands), dtype=np.int64)
+        self._ploidy = 1 if isinstance(pedigree, PloidPedigree) else 2
+        ascending_genealogy = pedigree.get_ascending_vertices_from_probands(self._probands.tolist())
+        # The parents have greater levels than their children, so they are processed first
+        levels = [[x for x in level if x in ascending_genealogy] for level in reversed(pedigree.get_levels())]
+        vertices = [vertex for level in levels for vertex in level]
+        vertex_to_index = {vertex: index for index, vertex in enumerate(vertices)}
+        ploidy = self._ploidy
+        first_sources = np.full(len(vertices) * ploidy, -1, dtype=np.int64)
+        second_sources = np.full(len(vertices) * ploidy, -1, dtype=np.int64)
+        for index, vertex in enumerate(vertices):
+            parent_indices = [vertex_to_index[parent] for parent in pedigree.get_parents(vertex)]
+            if ploidy == 1:
+                if parent_indices:
+                    first_sources[index] = parent_indices[0]
+                    second_sources[index] = parent_indices[-1]
+                continue
+            for slot, parent_index in enumerate(parent_indices[:ploidy]):
+                first_sources[index * ploidy + slot] = parent_index * ploidy
+                second_sources[index * ploidy + slot] = parent_index * ploidy + 1
+        is_founder_slot = first_sources < 0
+        self._founder_slots = np.flatnonzero(is_founder_slot)
+        self._founder_vertices = np.array(vertices, dtype=np.int64)[self._founder_slots // ploidy]
+        slot_levels = np.repeat(np.repeat(np.arange(len(levels)), [len(level) for level in levels]), ploidy)
+        self._slot_levels = slot_levels
+        self._ordered_slots = np.flatnonzero(~is_founder_slot)
+        self._level_bounds = np.searchsorted(slot_levels[self._ordered_slots], np.arange(len(levels) + 1))
+        self._first_sources = first_sources
+        self._second_sources = second_sources
+        self._proband_slots = (np.array([vertex_to_index[x] for x in self._probands.tolist()], dtype=np.int64)[:, None]
+                               * ploidy + np.arange(ploidy)).ravel()
+
+    def get_probands(self) -> np.ndarray:
+        """
+        Returns:
+            The sorted proband ids. The i-th row of the simulated arrays corresponds to the i-th proband.
+        """
+        return self._probands
+
+    def get_founder_alleles(self) -> np.ndarray:
+        """
+        Returns:
+            The vertex carrying every founder allele. The simulated alleles are indices into this array.
+        """
+        return self._founder_vertices
+
+    def simulate(self, replicates: int, seed: int | np.random.SeedSequence = None, batch_size: int = 1000,
+                 processes: int = 1) -> np.ndarray:
+        """
+        Simulates the transmission of the founder alleles to the probands.
+
+        Args:
+            replicates (int): The number of the simulated replicates.
+            seed (int | np.random.SeedSequence): The seed of the random streams. If not specified, fresh entropy
+                                                 is used.
+            batch_size (int): The number of the replicates simulated at once. The memory usage is proportional to
+                              the batch size multiplied by the size of the ascending genealogy.
+            processes (int): The number of the processes simulating the batches in parallel.
+
+        Returns:
+            The array of the shape (probands, ploidy, replicates) containing the indices of the founder alleles
+            (see :meth:`get_founder_alleles`) carried by the probands.
+        """
+        seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        batch_sizes = [min(batch_size, replicates - start) for start in range(0, replicates, batch_size)]
+        batch_seeds = seed_sequence.spawn(len(batch_sizes))
+        arguments = (self._ordered_slots, self._level_bounds, self._first_sources, self._second_sources,
+                     self._founder_slots, self._proband_slots)
+        if processes > 1 and len(batch_sizes) > 1:
+            with ProcessPoolExecutor(max_workers=processes, initializer=_initialize_worker,
+                                     initargs=(arguments,)) as executor:
+                batches = list(executor.map(_drop_genes_in_worker, batch_sizes, batch_seeds))
+        else:
+            batches = [_drop_genes(*arguments, replicates=size, seed_sequence=batch_seed)
+                       for size, batch_seed in zip(batch_sizes, batch_seeds)]
+        proband_alleles = np.concatenate(batches, axis=1) if batches else \
+            np.empty((len(self._proband_slots), 0), dtype=np.int32)
+        return proband_alleles.reshape(len(self._probands), self._ploidy, replicates)
+
+    def estimate_kinship(self, replicates: int, seed: int | np.random.SeedSequence = None, batch_size: int = 1000,
+                         processes: int = 1) -> (np.ndarray, np.ndarray):
+        """
+        Estimates the kinship coefficients between the probands as the fraction of the replicates in which
+        the alleles randomly chosen from the two probands are identical by descent. For a ploid pedigree,
+        the self-kinship of a ploid is 1. The arguments are the same as in :meth:`simulate`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray]: A tuple containing:
+                1. The sorted proband ids.
+                2. The dense matrix with the estimated kinships, where the i-th row (column) corresponds to
+                   the i-th proband.
+        """
+        proband_alleles = self.simulate(replicates=replicates, seed=seed, batch_size=batch_size,
+                                        processes=processes)
+        return self._probands, self.calculate_ibd_sharing(proband_alleles, founder_alleles_number=len(
+            self._founder_vertices))
+
+    @staticmethod
+    def calculate_ibd_sharing(proband_alleles: np.ndarray, founder_alleles_number: int) -> np.ndarray:
+        """
+        Calculates the average IBD sharing between the probands: the probability that two alleles chosen at random
+        from the two probands (one from each) are copies of the same founder allele.
+
+        Args:
+            proband_alleles (np.ndarray): The array returned by :meth:`simulate`.
+            founder_alleles_number (int): The number of the founder alleles.
+
+        Returns:
+            The dense matrix with the IBD sharing between every pair of probands.
+        """
+        probands_number, ploidy, replicates = proband_alleles.shape
+        # Every proband has an indicator row over the (replicate, founder allele) pairs with the fraction of its
+        # alleles that are copies of the given founder allele in the given replicate
+        columns = (np.arange(replicates, dtype=np.int64) * founder_alleles_number + proband_alleles).ravel()
+        rows = np.repeat(np.arange(probands_number), ploidy * replicates)
+        values = np.full(len(columns), 1.0 / ploidy)
+        indicators = sparse.csr_matrix((values, (rows, columns)),
+                                       shape=(probands_number, replicates * founder_alleles_number))
+        return (indicators @ indicators.T).toarray() / max(replicates, 1)
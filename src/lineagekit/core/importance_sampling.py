@@ -0,0 +1,226 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+import numpy as np
+
+from lineagekit.core.abstract_pedigree import AbstractPedigree
+from lineagekit.core.gene_dropping import GeneDropping
+
+
+class CarrierImportanceSampling(GeneDropping):
+    """
+    Estimates the probability that a single copy of an allele introduced by a founder is transmitted to all the given
+    carrier probands. The event is usually too rare to be observed in plain gene dropping, so the transmissions are
+    sampled from a proposal distribution that always delivers the allele to the carriers, and every replicate is
+    weighted by the ratio of its probabilities under the Mendelian and the proposal distributions (importance sampling
+    in the spirit of ISGen).
+
+    The proposal processes the ascending genealogy of the carriers from the carriers to the founders. Every carrier
+    that hasn't received a transmission path from another carrier picks one of its allele slots that can carry
+    the allele, and the path is extended upwards: a slot on a path inherits from the source slot that can carry the
+    allele, or from a random one if both can. All the other slots inherit from a random source, as in gene dropping.
+    The weight of a replicate is :math:`2^{-f} \\prod_c k_c / n_c`, where f is the number of the forced choices,
+    :math:`k_c` is the number of the slots the carrier c could pick from and :math:`n_c` is the number of its slots
+    that actually carry the allele (only counting the carriers that picked a slot).
+    The replicates are simulated in vectorized batches with their own random streams, like in :class:`GeneDropping`.
+
+    Example:
+        >>> importance_sampling = CarrierImportanceSampling(pedigree, carriers=[101, 102, 103])
+        >>> probability, effective_sample_size = importance_sampling.estimate_carrier_probability(
+        ...     founder=1, replicates=10_000, seed=42)
+        >>> founders, probabilities, effective_sample_sizes = importance_sampling.estimate_carrier_probabilities(
+        ...     replicates=10_000, seed=42)
+    """
+
+    def __init__(self, pedigree: AbstractPedigree, carriers: Iterable[int]):
+        """
+        Prepares the transmission arrays for the ascending genealogy of the carriers.
+
+        Args:
+            pedigree (AbstractPedigree): The pedigree.
+            carriers (Iterable[int]): The probands that must carry the allele.
+        """
+        super().__init__(pedigree=pedigree, probands=carriers)
+        self._carrier_slots = self._proband_slots.reshape(len(self._probands), self._ploidy)
+        self._carrier_levels = self._slot_levels[self._carrier_slots[:, 0]]
+
+    def get_carriers(self) -> np.ndarray:
+        """
+        Returns:
+            The sorted carrier ids.
+        """
+        return self._probands
+
+    def get_founders(self) -> np.ndarray:
+        """
+        Returns:
+            The sorted founders of the carriers' ascending genealogy that can introduce the allele.
+        """
+        return np.unique(self._founder_vertices)
+
+    def estimate_carrier_probability(self, founder: int, replicates: int,
+                                     seed: int | np.random.SeedSequence = None,
+                                     batch_size: int = 1000) -> (float, float):
+        """
+        Estimates the probability that a single copy of an allele carried by the founder is transmitted to all
+        the carriers.
+
+        Args:
+            founder (int): The founder introducing the allele.
+            replicates (int): The number of the sampled replicates.
+            seed (int | np.random.SeedSequence): The seed of the random streams. If not specified, fresh entropy
+                                                 is used.
+            batch_size (int): The number of the replicates sampled at once.
+
+        Returns:
+            Tuple[float, float]: A tuple containing:
+                1. The estimated probability.
+                2. The effective sample size of the weighted replicates. The estimate is unreliable if it is much
+                   smaller than the number of the replicates.
+
+        Raises:
+            ValueError: If the vertex is not a founder of the carriers' ascending genealogy.
+        """
+        founder_alleles = np.flatnonzero(self._founder_vertices == founder)
+        if not len(founder_alleles):
+            raise ValueError(f"Vertex {founder} is not a founder of the carriers' ascending genealogy")
+        weights = self.sample_weights(founder_allele=int(founder_alleles[0]), replicates=replicates, seed=seed,
+                                      batch_size=batch_size)
+        return float(weights.mean()) if replicates else 0.0, self.calculate_effective_sample_size(weights)
+
+    def estimate_carrier_probabilities(self, replicates: int, seed: int | np.random.SeedSequence = None,
+                                       batch_size: int = 1000) -> (np.ndarray, np.ndarray, np.ndarray):
+        """
+        Estimates the carrier probability for every founder of the carriers' ascending genealogy.
+        The arguments are the same as in :meth:`estimate_carrier_probability`.
+
+        Returns:
+            Tuple[np.ndarray, np.ndarray, np.ndarray]: A tuple containing:
+                1. The sorted founders.
+                2. The estimated probabilities.
+                3. The effective sample sizes.
+        """
+        founders = self.get_founders()
+        seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        estimates = [self.estimate_carrier_probability(founder=founder, replicates=replicates,
+                                                       seed=founder_seed, batch_size=batch_size)
+                     for founder, founder_seed in zip(founders.tolist(), seed_sequence.spawn(len(founders)))]
+        probabilities = np.array([probability for probability, _ in estimates], dtype=np.float64)
+        effective_sample_sizes = np.array([size for _, size in estimates], dtype=np.float64)
+        return founders, probabilities, effective_sample_sizes
+
+    def sample_weights(self, founder_allele: int, replicates: int, seed: int | np.random.SeedSequence = None,
+                       batch_size: int = 1000) -> np.ndarray:
+        """
+        Samples the replicates from the proposal distribution.
+
+        Args:
+            founder_allele (int): The index of the founder allele (see :meth:`get_founder_alleles`) that is
+                                  transmitted.
+            replicates (int): The number of the sampled replicates.
+            seed (int | np.random.SeedSequence): The seed of the random streams.
+            batch_size (int): The number of the replicates sampled at once.
+
+        Returns:
+            The importance weights of the replicates. Their mean is an unbiased estimate of the carrier probability.
+        """
+        seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        batch_sizes = [min(batch_size, replicates - start) for start in range(0, replicates, batch_size)]
+        descendants = self._get_allele_descendants(int(self._founder_slots[founder_allele]))
+        batches = [np.exp(self._sample_log_weights(descendants=descendants, replicates=size,
+                                                   generator=np.random.default_rng(batch_seed)))
+                   for size, batch_seed in zip(batch_sizes, seed_sequence.spawn(len(batch_sizes)))]
+        return np.concatenate(batches) if batches else np.empty(0, dtype=np.float64)
+
+    @staticmethod
+    def calculate_effective_sample_size(weights: np.ndarray) -> float:
+        """
+        Returns:
+            Kish's effective sample size of the weighted replicates.
+        """
+        squared_sum = float(np.square(weights).sum())
+        if squared_sum == 0:
+            return 0.0
+        return float(weights.sum()) ** 2 / squared_sum
+
+    def _get_allele_descendants(self, allele_slot: int) -> tuple:
+        """
+        Restricts the transmission arrays to the slots descending from the allele slot, as the other slots never
+        carry the allele and their choices don't change the weights. The descending slots are renumbered, and
+        the other slots are replaced by an additional slot that never carries the allele.
+
+        Returns:
+            The number of the descending slots, the renumbered allele slot, the renumbered sources of the descending
+            slots, the renumbered non-founder descending slots ordered by levels together with the level bounds and
+            the renumbered carrier slots.
+        """
+        can_carry = np.zeros(len(self._first_sources), dtype=bool)
+        can_carry[allele_slot] = True
+        for start, end in zip(self._level_bounds[:-1], self._level_bounds[1:]):
+            slots = self._ordered_slots[start:end]
+            can_carry[slots] = can_carry[self._first_sources[slots]] | can_carry[self._second_sources[slots]]
+        descendants = np.flatnonzero(can_carry)
+        # The founder slots have the source -1, which is also mapped to the additional slot
+        renumbered = np.full(len(can_carry) + 1, len(descendants), dtype=np.int64)
+        renumbered[descendants] = np.arange(len(descendants))
+        ordered_slots = self._ordered_slots[can_carry[self._ordered_slots]]
+        level_bounds = np.searchsorted(self._slot_levels[ordered_slots], np.arange(len(self._level_bounds)))
+        return (len(descendants), int(renumbered[allele_slot]), renumbered[self._first_sources[descendants]],
+                renumbered[self._second_sources[descendants]], renumbered[ordered_slots], level_bounds,
+                renumbered[self._carrier_slots])
+
+    def _sample_log_weights(self, descendants: tuple, replicates: int, generator: np.random.Generator) -> np.ndarray:
+        (slots_number, allele_slot, first_sources, second_sources, ordered_slots, level_bounds,
+         carrier_slots) = descendants
+        carrier_can_carry = carrier_slots < slots_number
+        candidates_number = carrier_can_carry.sum(axis=1)
+        if not candidates_number.all():
+            return np.full(replicates, -np.inf)
+        # The last row is the additional slot that never carries the allele
+        marked = np.zeros((slots_number + 1, replicates), dtype=bool)
+        take_second = np.zeros((slots_number + 1, replicates), dtype=bool)
+        picked = np.zeros((len(carrier_slots), replicates), dtype=bool)
+        log_weights = np.zeros(replicates)
+        # The children have smaller levels than their parents, so the paths are extended upwards
+        for level in range(len(level_bounds) - 2, -1, -1):
+            level_carriers = np.flatnonzero(self._carrier_levels == level)
+            if len(level_carriers):
+                level_carrier_slots = carrier_slots[level_carriers]
+                must_pick = ~marked[level_carrier_slots].any(axis=1)
+                # Picking the r-th slot that can carry the allele
+                choices = (generator.random((len(level_carriers), replicates)) *
+                           candidates_number[level_carriers, np.newaxis]).astype(np.int64)
+                cumulative_counts = np.cumsum(carrier_can_carry[level_carriers], axis=1)
+                positions = (choices[:, np.newaxis, :] >= cumulative_counts[:, :, np.newaxis]).sum(axis=1)
+                picked_slots = np.take_along_axis(level_carrier_slots, positions, axis=1)
+                carrier_indices, replicate_indices = np.nonzero(must_pick)
+                marked[picked_slots[carrier_indices, replicate_indices], replicate_indices] = True
+                picked[level_carriers] = must_pick
+                log_weights += (np.log(candidates_number[level_carriers])[:, np.newaxis] * must_pick).sum(axis=0)
+            slots = ordered_slots[level_bounds[level]:level_bounds[level + 1]]
+            if not len(slots):
+                continue
+            level_first_sources = first_sources[slots]
+            level_second_sources = second_sources[slots]
+            level_take_second = generator.random((len(slots), replicates)) < 0.5
+            # A marked slot must inherit from the only source that can carry the allele
+            first_cannot_carry = level_first_sources == slots_number
+            forced = marked[slots] & (first_cannot_carry | (level_second_sources == slots_number))[:, np.newaxis]
+            level_take_second = np.where(forced, first_cannot_carry[:, np.newaxis], level_take_second)
+            log_weights -= forced.sum(axis=0) * np.log(2)
+            take_second[slots] = level_take_second
+            slot_indices, replicate_indices = np.nonzero(marked[slots])
+            sources = np.where(level_take_second[slot_indices, replicate_indices], level_second_sources[slot_indices],
+                               level_first_sources[slot_indices])
+            marked[sources, replicate_indices] = True
+        # Counting the carrier slots that received the allele
+        carrying = np.zeros((slots_number + 1, replicates), dtype=bool)
+        carrying[allele_slot] = True
+        for start, end in zip(level_bounds[:-1], level_bounds[1:]):
+            slots = ordered_slots[start:end]
+            carrying[slots] = np.where(take_second[slots], carrying[second_sources[slots]],
+                                       carrying[first_sources[slots]])
+        carrying_number = carrying[carrier_slots].sum(axis=1)
+        log_weights -= (np.log(np.maximum(carrying_number, 1)) * picked).sum(axis=0)
+        return log_weights
@@ -1,7 +1,21 @@
 #include <pybind11/pybind11.h>
 #include <pybind11/stl.h>
 #include <pybind11/numpy.h>
+#include <algorithm>
+#include <array>
+#include <charconv>
+#include <chrono>
+#include <cstdio>
+#include <cstring>
+#include <fstream>
+#include <limits>
+#include <list>
+#include <numeric>
+#include <optional>
 #include <queue>
+#include <sstream>
+#include <string>
+#include <tuple>
 #include <vector>
 #include <unordered_set>
 #include <unordered_map>
@@ -15,27 +29,194 @@ using phmap::parallel_flat_hash_map;
 using spp::sparse_hash_map;
 using phmap::flat_hash_set;
 
-typedef sparse_hash_map<int, sparse_hash_map<int, float>> MemorySparseMatrix;
-typedef flat_hash_map<int, flat_hash_map<int, float>> TimeSparseMatrix;
+// The memory usage of the hash maps is derived from their layouts. A flat_hash_map keeps a slot and a control byte
+// per bucket (and a group of trailing control bytes) and doubles its capacity once 7/8 of the buckets are used, so
+// at least 7/16 of the buckets are used after the growth. A sparse_hash_map keeps only the used slots, and every group
+// of SPP_GROUP_SIZE buckets has a header pointing to its slots. The buckets are doubled once half of them are used, so
+// at least a quarter of the buckets are used after the growth. The estimates assume the lowest load, so they are
+// upper bounds for the maps built by insertions
+template<typename Map>
+size_t get_flat_hash_map_bytes(const Map& map)
+{
+    if (map.capacity() == 0)
+    {
+        return 0;
+    }
+    return map.capacity() * (sizeof(typename Map::value_type) + 1) + phmap::priv::Group::kWidth;
+}
 
-template<typename T>
-struct inner_map_type;
+template<typename Map>
+size_t estimate_flat_hash_map_bytes(size_t size)
+{
+    return size * (sizeof(typename Map::value_type) + 1) * 16 / 7;
+}
+
+template<typename Map>
+constexpr size_t get_sparse_group_bytes()
+{
+    return sizeof(spp::sparsegroup<typename Map::value_type, typename Map::allocator_type>);
+}
+
+template<typename Map>
+size_t get_sparse_hash_map_bytes(const Map& map)
+{
+    return map.bucket_count() / SPP_GROUP_SIZE * get_sparse_group_bytes<Map>() +
+           map.size() * sizeof(typename Map::value_type);
+}
+
+template<typename Map>
+size_t estimate_sparse_hash_map_bytes(size_t size)
+{
+    return size * (sizeof(typename Map::value_type) + 4 * get_sparse_group_bytes<Map>() / SPP_GROUP_SIZE);
+}
 
-template<typename K, typename V>
-struct inner_map_type<sparse_hash_map<K, sparse_hash_map<K, V>>> {
-    using type = sparse_hash_map<K, V>;
+// Every kinship matrix also keeps the peak number of vertices that were stored during the calculation
+struct TimeSparseMatrix : flat_hash_map<int, flat_hash_map<int, float>>
+{
+    static constexpr const char* storage_name = "speed";
+    size_t peak_frontier_size = 0;
+    // If the drop threshold is positive, the kinships below it are not stored, and the missing pairs of the stored
+    // vertices are zeros. Every vertex keeps an upper bound on the error of its kinships caused by the dropped
+    // entries, and the error of a pair is bounded by the sum of the bounds of its vertices.
+    float drop_threshold = 0.0f;
+    flat_hash_map<int, double> vertex_bounds;
+    double max_error_bound = 0.0;
+
+    // Every stored vertex has a row, and every stored pair is kept in the row of one of its vertices
+    static size_t estimate_memory_usage(size_t vertices, size_t pairs)
+    {
+        return estimate_flat_hash_map_bytes<flat_hash_map<int, flat_hash_map<int, float>>>(vertices) +
+               vertices * phmap::priv::Group::kWidth + estimate_flat_hash_map_bytes<flat_hash_map<int, float>>(pairs);
+    }
 };
 
-template<typename K, typename V>
-struct inner_map_type<flat_hash_map<K, flat_hash_map<K, V>>> {
-    using type = flat_hash_map<K, V>;
+// Helper functions for reading and writing the checkpoint and the kinship matrix files
+template<typename T>
+void write_binary(std::ostream& stream, const T& value)
+{
+    stream.write(reinterpret_cast<const char*>(&value), sizeof(T));
+}
+
+template<typename T>
+T read_binary(std::istream& stream)
+{
+    T value;
+    stream.read(reinterpret_cast<char*>(&value), sizeof(T));
+    if (!stream)
+    {
+        throw std::runtime_error("The file is truncated or corrupted");
+    }
+    return value;
+}
+
+template<typename T>
+void write_binary_vector(std::ostream& stream, const std::vector<T>& values)
+{
+    write_binary(stream, static_cast<uint64_t>(values.size()));
+    stream.write(reinterpret_cast<const char*>(values.data()), values.size() * sizeof(T));
+}
+
+template<typename T>
+std::vector<T> read_binary_array(std::istream& stream, size_t size)
+{
+    std::vector<T> values(size);
+    stream.read(reinterpret_cast<char*>(values.data()), values.size() * sizeof(T));
+    if (!stream)
+    {
+        throw std::runtime_error("The file is truncated or corrupted");
+    }
+    return values;
+}
+
+template<typename T>
+std::vector<T> read_binary_vector(std::istream& stream)
+{
+    return read_binary_array<T>(stream, read_binary<uint64_t>(stream));
+}
+
+// Restricts the calculation to the pairs that can affect the kinships between the row and the column vertices.
+// Every vertex is marked with the sides (row and/or column) of the retained vertices among itself and its descendants.
+// The kinship of two vertices can only contribute to a row-column kinship if one of them has the row side and
+// the other one has the column side. Once all the children of a retained vertex have been processed,
+// it only keeps its own sides.
+class RectangularPairFilter
+{
+public:
+    static constexpr uint8_t ROW = 1;
+    static constexpr uint8_t COLUMN = 2;
+
+    RectangularPairFilter(const std::unordered_map<int, std::vector<int>>& parents,
+                          const std::unordered_set<int>& row_vertices,
+                          const std::unordered_set<int>& column_vertices)
+    {
+        vertex_sides.reserve(parents.size());
+        for (const auto& entry : parents)
+        {
+            vertex_sides[entry.first] = 0;
+        }
+        for (const auto& [side, vertices] : {std::pair<uint8_t, const std::unordered_set<int>*>(ROW, &row_vertices),
+                                             std::pair<uint8_t, const std::unordered_set<int>*>(COLUMN,
+                                                                                                &column_vertices)})
+        {
+            std::vector<int> stack(vertices->begin(), vertices->end());
+            for (const int vertex : *vertices)
+            {
+                own_sides[vertex] |= side;
+            }
+            while (!stack.empty())
+            {
+                const int vertex = stack.back();
+                stack.pop_back();
+                uint8_t& vertex_side = vertex_sides.at(vertex);
+                if (vertex_side & side)
+                {
+                    continue;
+                }
+                vertex_side |= side;
+                stack.insert(stack.end(), parents.at(vertex).begin(), parents.at(vertex).end());
+            }
+        }
+    }
+
+    static bool is_needed(const uint8_t first_side, const uint8_t second_side)
+    {
+        return ((first_side & ROW) && (second_side & COLUMN)) || ((first_side & COLUMN) && (second_side & ROW));
+    }
+
+    uint8_t get_side(const int vertex) const
+    {
+        return vertex_sides.at(vertex);
+    }
+
+    void retire(const int vertex)
+    {
+        vertex_sides[vertex] = own_sides.at(vertex);
+    }
+
+private:
+    flat_hash_map<int, uint8_t> vertex_sides;
+    flat_hash_map<int, uint8_t> own_sides;
 };
 
+// Returns the kinship stored in the row, or zero if the entry has been dropped
+template<typename Row>
+float find_row_kinship(const Row& row, const int column)
+{
+    auto it = row.find(column);
+    return it == row.end() ? 0.0f : it->second;
+}
+
+// A hemizygous vertex (e.g. a male for the X chromosome) carries a single copy inherited from its only parent, so its
+// self-kinship is 1 and its kinships are the kinships of the parent
 template<typename KinshipMatrix>
 void calculate_pair_kinships_sparse(KinshipMatrix& kinship_sparse_matrix, const int vertex,
-    const std::unordered_map<int, std::vector<int>>& parents_map)
+    const std::unordered_map<int, std::vector<int>>& parents_map,
+    const RectangularPairFilter* pair_filter = nullptr, const bool is_hemizygous = false)
 {
-    using inner_map = typename inner_map_type<KinshipMatrix>::type;
+    using inner_map = typename KinshipMatrix::mapped_type;
+    const uint8_t vertex_side = pair_filter ? pair_filter->get_side(vertex) : 0;
+    const bool is_self_pair_needed = !pair_filter || RectangularPairFilter::is_needed(vertex_side, vertex_side);
+    const float drop_threshold = kinship_sparse_matrix.drop_threshold;
     auto it = parents_map.find(vertex);
     inner_map& vertex_map = kinship_sparse_matrix[vertex];
     inner_map* first_parent_map = nullptr;
@@ -43,7 +224,8 @@ void calculate_pair_kinships_sparse(KinshipMatrix& kinship_sparse_matrix, const
 
     int first_parent = -1;
     int second_parent = -1;
-    float self_kinship = 0.5f;
+    float self_kinship = is_hemizygous ? 1.0f : 0.5f;
+    double parents_bound = 0.0;
     if (it != parents_map.end())
     {
         const std::vector<int>& parents = it->second;
@@ -55,21 +237,37 @@ void calculate_pair_kinships_sparse(KinshipMatrix& kinship_sparse_matrix, const
             {
                 second_parent = parents[1];
                 second_parent_map = &kinship_sparse_matrix.at(second_parent);
-                if (first_parent > second_parent)
+                if (is_self_pair_needed)
                 {
-                    self_kinship = (1 + kinship_sparse_matrix.at(second_parent).at(first_parent)) / 2.0f;
+                    if (first_parent > second_parent)
+                    {
+                        self_kinship = (1 + find_row_kinship(*second_parent_map, first_parent)) / 2.0f;
+                    }
+                    else
+                    {
+                        self_kinship = (1 + find_row_kinship(*first_parent_map, second_parent)) / 2.0f;
+                    }
                 }
-                else
+            }
+            if (drop_threshold > 0)
+            {
+                for (const int parent : parents)
                 {
-                    self_kinship = (1 + kinship_sparse_matrix.at(first_parent).at(second_parent)) / 2.0f;
+                    parents_bound = std::max(parents_bound, kinship_sparse_matrix.vertex_bounds[parent]);
                 }
             }
         }
     }
-    vertex_map[vertex] = self_kinship;
+    // The self-kinship is always stored, so that the matrix keeps the vertex
+    if (is_self_pair_needed)
+    {
+        vertex_map[vertex] = self_kinship;
+    }
+    bool is_entry_dropped = false;
     for (auto& [second_vertex, second_vertex_map] : kinship_sparse_matrix)
     {
-        if (second_vertex == vertex)
+        if (second_vertex == vertex ||
+            (pair_filter && !RectangularPairFilter::is_needed(vertex_side, pair_filter->get_side(second_vertex))))
         {
             continue;
         }
@@ -78,24 +276,33 @@ void calculate_pair_kinships_sparse(KinshipMatrix& kinship_sparse_matrix, const
         {
             if (second_vertex > first_parent)
             {
-                first_second_kinship_non_normalized += first_parent_map->at(second_vertex);
+                first_second_kinship_non_normalized += find_row_kinship(*first_parent_map, second_vertex);
             }
             else
             {
-                first_second_kinship_non_normalized += second_vertex_map.at(first_parent);
+                first_second_kinship_non_normalized += find_row_kinship(second_vertex_map, first_parent);
             }
             if (second_parent_map)
             {
                 if (second_vertex > second_parent)
                 {
-                    first_second_kinship_non_normalized += second_parent_map->at(second_vertex);
+                    first_second_kinship_non_normalized += find_row_kinship(*second_parent_map, second_vertex);
                 }
                 else
                 {
-                    first_second_kinship_non_normalized += second_vertex_map.at(second_parent);
+                    first_second_kinship_non_normalized += find_row_kinship(second_vertex_map, second_parent);
                 }
             }
-            first_second_kinship_non_normalized /= 2.0f;
+            if (!is_hemizygous)
+            {
+                first_second_kinship_non_normalized /= 2.0f;
+            }
+        }
+        if (first_second_kinship_non_normalized < drop_threshold)
+        {
+            // Dropping a zero doesn't introduce any error
+            is_entry_dropped |= first_second_kinship_non_normalized > 0.0f;
+            continue;
         }
         if (vertex > second_vertex)
         {
@@ -106,204 +313,3175 @@ void calculate_pair_kinships_sparse(KinshipMatrix& kinship_sparse_matrix, const
             vertex_map[second_vertex] = first_second_kinship_non_normalized;
         }
     }
+    if (drop_threshold > 0)
+    {
+        // The error of a pair (vertex, other) is at most the average of the parents' errors with the other vertex
+        // plus the dropped value
+        const double vertex_bound = parents_bound + (is_entry_dropped ? drop_threshold : 0.0);
+        kinship_sparse_matrix.vertex_bounds[vertex] = vertex_bound;
+        kinship_sparse_matrix.max_error_bound = std::max(kinship_sparse_matrix.max_error_bound, 2 * vertex_bound);
+    }
 }
 
-using QueueElement = std::pair<float, std::vector<int>>;
-
-struct CompareOnlyFirst {
-    bool operator()(const QueueElement& a, const QueueElement& b) {
-        return a.first > b.first; // Min-heap: smallest priority at the top
+// The functions below give a uniform access to the different kinship matrix types. In the hash map based matrices,
+// every pair is stored in the row of the smaller vertex.
+template<typename KinshipMatrix>
+void remove_vertex(KinshipMatrix& kinship_sparse_matrix, const int vertex)
+{
+    kinship_sparse_matrix.erase(vertex);
+    kinship_sparse_matrix.vertex_bounds.erase(vertex);
+    for (auto& other_vertex : kinship_sparse_matrix)
+    {
+        if (vertex > other_vertex.first)
+        {
+            other_vertex.second.erase(vertex);
+        }
     }
-};
+}
 
+// Removes the pairs of the vertex that are no longer needed according to the filter
 template<typename KinshipMatrix>
-KinshipMatrix calculate_kinship_sparse(
-    std::unordered_map<int, std::vector<int>>& children,
-    std::unordered_map<int, std::vector<int>>& parents,
-    std::unordered_set<int>& sink_vertices)
+void remove_unneeded_pairs(KinshipMatrix& kinship_sparse_matrix, const int vertex,
+    const RectangularPairFilter& pair_filter)
 {
-    // Find the founders
-    flat_hash_set<int> founders;
-    for (const auto& entry : parents)
+    auto& vertex_map = kinship_sparse_matrix.at(vertex);
+    const uint8_t vertex_side = pair_filter.get_side(vertex);
+    for (auto& [other_vertex, other_vertex_map] : kinship_sparse_matrix)
     {
-        if (entry.second.empty())
+        if (RectangularPairFilter::is_needed(vertex_side, pair_filter.get_side(other_vertex)))
         {
-            founders.insert(entry.first);
+            continue;
+        }
+        if (other_vertex < vertex)
+        {
+            other_vertex_map.erase(vertex);
+        }
+        else
+        {
+            vertex_map.erase(other_vertex);
         }
     }
-    // Initialize the maps that will keep track of how many children/parents need to be processed
-    flat_hash_map<int, int> parent_to_remaining_children;
-    flat_hash_map<int, int> child_to_remaining_parents;
-    parent_to_remaining_children.reserve(children.size());
-    child_to_remaining_parents.reserve(parents.size());
-    for (const auto& entry : children)
+}
+
+template<typename KinshipMatrix>
+bool contains_vertex(const KinshipMatrix& self, int vertex)
+{
+    return self.find(vertex) != self.end();
+}
+
+template<typename KinshipMatrix, typename Function>
+void for_each_vertex(const KinshipMatrix& self, Function function)
+{
+    for (const auto& row : self)
     {
-        parent_to_remaining_children[entry.first] = entry.second.size();
+        function(row.first);
     }
-    for (const auto& entry : parents)
+}
+
+// Calls the function for every (other vertex, kinship) entry stored in the vertex's row. Going through the rows of all
+// the vertices visits every unordered pair (including the diagonal) exactly once.
+template<typename KinshipMatrix, typename Function>
+void for_each_row_entry(const KinshipMatrix& self, int vertex, Function function)
+{
+    for (const auto& [column, value] : self.at(vertex))
     {
-        child_to_remaining_parents[entry.first] = entry.second.size();
+        function(column, value);
     }
-    // Initialize the queue with the founders
-    KinshipMatrix kinship_sparse_matrix;
-    std::priority_queue<QueueElement, std::vector<QueueElement>, CompareOnlyFirst> queue;
-    for (const auto& founder : founders)
+}
+
+template<typename KinshipMatrix>
+float get_kinship_value(const KinshipMatrix& self, int key1, int key2)
+{
+    const auto& row = self.at(std::min(key1, key2));
+    auto it = row.find(std::max(key1, key2));
+    if (it != row.end())
     {
-        queue.emplace(1, std::vector<int>{founder});
+        return it->second;
     }
-    // Calculate the kinships
-    while (!queue.empty())
+    if (self.drop_threshold > 0 && self.find(std::max(key1, key2)) != self.end())
     {
-        auto [priority, vertices] = queue.top();
-        queue.pop();
-        for (const int vertex : vertices)
-        {
-            calculate_pair_kinships_sparse(kinship_sparse_matrix, vertex, parents);
-            for (const auto& parent : parents.at(vertex))
-            {
-                // Updating the counter of unprocessed children for the parent
-                if (--parent_to_remaining_children[parent] == 0 && sink_vertices.find(parent) == sink_vertices.end())
-                {
-                    // Erasing the parent's kinship information because it isn't a proband
-                    // and all of its children have been processed
-                    parent_to_remaining_children.erase(parent);
-                    kinship_sparse_matrix.erase(parent);
-                    for (auto& other_vertex : kinship_sparse_matrix)
-                    {
-                        if (parent > other_vertex.first)
-                        {
-                            other_vertex.second.erase(parent);
-                        }
-                    }
-                }
-            }
+        return 0.0f;
+    }
+    throw std::out_of_range("The pair (" + std::to_string(key1) + ", " + std::to_string(key2) +
+                            ") is not present in the matrix");
+}
 
-            flat_hash_set<int> children_to_add;
-            for (const auto& child : children.at(vertex))
-            {
-                if (--child_to_remaining_parents[child] == 0)
-                {
-                    children_to_add.insert(child);
-                    child_to_remaining_parents.erase(child);
-                }
-            }
+template<typename KinshipMatrix>
+float get_error_bound(const KinshipMatrix& self)
+{
+    // The values are stored as single-precision floats, so only the dropped entries introduce an error
+    return static_cast<float>(self.max_error_bound);
+}
 
-            if (!children_to_add.empty())
-            {
-                float additional_space = (float) children_to_add.size();
-                flat_hash_set<int> children_parents;
-                for (const int child : children_to_add)
-                {
-                    for (const int parent : parents.at(child))
-                    {
-                        children_parents.insert(parent);
-                    }
-                }
-                for (const int child_parent : children_parents)
-                {
-                    const int children_unprocessed = parent_to_remaining_children.at(child_parent);
-                    int counter = 0;
-                    for (const int child : children.at(child_parent))
-                    {
-                        if (children_to_add.find(child) == children_to_add.end())
-                        {
-                            counter++;
-                        }
-                    }
-                    if (children_unprocessed != counter)
-                    {
-                        additional_space -= 1.0f;
-                    }
-                }
-                queue.emplace(additional_space, std::vector<int>(children_to_add.begin(), children_to_add.end()));
-            }
-        }
+template<typename KinshipMatrix>
+size_t get_memory_usage(const KinshipMatrix& self)
+{
+    size_t bytes = get_flat_hash_map_bytes(self) + get_flat_hash_map_bytes(self.vertex_bounds);
+    for (const auto& [vertex, row] : self)
+    {
+        bytes += get_flat_hash_map_bytes(row);
     }
-    return kinship_sparse_matrix;
+    return bytes;
 }
 
-TimeSparseMatrix calculate_kinship_sparse_speed(
-    std::unordered_map<int, std::vector<int>>& children,
-    std::unordered_map<int, std::vector<int>>& parents,
-    std::unordered_set<int>& sink_vertices)
+template<typename KinshipMatrix>
+float get_drop_threshold(const KinshipMatrix&)
 {
-    return calculate_kinship_sparse<TimeSparseMatrix>(children, parents, sink_vertices);
+    return 0.0f;
 }
 
-MemorySparseMatrix calculate_kinship_sparse_memory(
-    std::unordered_map<int, std::vector<int>>& children,
-    std::unordered_map<int, std::vector<int>>& parents,
-    std::unordered_set<int>& sink_vertices)
+float get_drop_threshold(const TimeSparseMatrix& self)
 {
-    return calculate_kinship_sparse<MemorySparseMatrix>(children, parents, sink_vertices);
+    return self.drop_threshold;
 }
 
 template<typename KinshipMatrix>
-std::pair<std::unordered_map<size_t, size_t>, py::array_t<float>> convert_to_numpy_and_free(KinshipMatrix& self)
+void set_drop_threshold(KinshipMatrix&, float drop_threshold)
 {
-    // Create a mapping of keys to contiguous indices
-    std::unordered_map<size_t, size_t> key_to_index;
-    int index = 0;
-    for (const auto& row : self)
+    if (drop_threshold > 0)
     {
-        key_to_index[row.first] = index++;
+        throw std::invalid_argument(std::string("The storage ") + KinshipMatrix::storage_name +
+                                    " doesn't support dropping the negligible kinships");
     }
+}
 
-    size_t size = key_to_index.size();
+void set_drop_threshold(TimeSparseMatrix& self, float drop_threshold)
+{
+    self.drop_threshold = drop_threshold;
+}
 
-    // Create a NumPy array of shape (size, size)
-    py::array_t<float> numpy_matrix({size, size});
-    auto buffer = numpy_matrix.mutable_unchecked<2>();
+template<typename KinshipMatrix>
+void free_kinship_matrix(KinshipMatrix& self)
+{
+    // Swapping with an empty matrix releases the allocated buckets, unlike clear()
+    KinshipMatrix().swap(self);
+}
 
-    for (const auto& row : self)
+template<typename KinshipMatrix>
+void save_matrix_state(std::ostream& stream, const KinshipMatrix& self)
+{
+    write_binary(stream, static_cast<uint64_t>(self.size()));
+    for (const auto& [vertex, row] : self)
     {
-        int row_index = key_to_index[row.first];
-        for (const auto& col : row.second)
+        write_binary(stream, vertex);
+        write_binary(stream, static_cast<uint64_t>(row.size()));
+        for (const auto& [column, value] : row)
         {
-            int col_index = key_to_index[col.first];
-            buffer(row_index, col_index) = col.second;
-            buffer(col_index, row_index) = col.second;
+            write_binary(stream, column);
+            write_binary(stream, value);
+        }
+    }
+    // The drop threshold is a part of the input fingerprint, so the state is loaded with the same threshold
+    if (self.drop_threshold > 0)
+    {
+        write_binary(stream, self.max_error_bound);
+        write_binary(stream, static_cast<uint64_t>(self.vertex_bounds.size()));
+        for (const auto& [vertex, bound] : self.vertex_bounds)
+        {
+            write_binary(stream, vertex);
+            write_binary(stream, bound);
         }
     }
-    self.clear();
-    return {key_to_index, numpy_matrix};
 }
 
-
-PYBIND11_MODULE(kinship, m)
+template<typename KinshipMatrix>
+void load_matrix_state(std::istream& stream, KinshipMatrix& self)
 {
-    py::class_<TimeSparseMatrix>(m, "TimeSparseMatrix")
-        .def("get_kinship", [](const TimeSparseMatrix& self, int key1, int key2)
-        {
-            if (key1 < key2)
-            {
-                return self.at(key1).at(key2);
-            }
-            return self.at(key2).at(key1);
-        }, "Get the float value for two integers", py::arg("key1"), py::arg("key2"))
-        .def("to_numpy_and_free", [](TimeSparseMatrix& self)
-        {
-            auto [key_to_index, numpy_matrix] = convert_to_numpy_and_free(self);
-            return std::make_tuple(key_to_index, numpy_matrix);
-        }, "Convert the sparse matrix to a NumPy array and free the memory");
-    py::class_<MemorySparseMatrix>(m, "MemorySparseMatrix")
-        .def("get_kinship", [](const MemorySparseMatrix& self, int key1, int key2)
+    const uint64_t rows_number = read_binary<uint64_t>(stream);
+    for (uint64_t row_index = 0; row_index < rows_number; ++row_index)
+    {
+        auto& row = self[read_binary<int>(stream)];
+        const uint64_t entries_number = read_binary<uint64_t>(stream);
+        for (uint64_t entry_index = 0; entry_index < entries_number; ++entry_index)
         {
-            if (key1 < key2)
-            {
-                return self.at(key1).at(key2);
-            }
-            return self.at(key2).at(key1);
-        }, "Get the float value for two integers", py::arg("key1"), py::arg("key2"))
-         .def("to_numpy_and_free", [](MemorySparseMatrix& self)
+            const int column = read_binary<int>(stream);
+            row[column] = read_binary<float>(stream);
+        }
+    }
+    if (self.drop_threshold > 0)
+    {
+        self.max_error_bound = read_binary<double>(stream);
+        const uint64_t bounds_number = read_binary<uint64_t>(stream);
+        for (uint64_t index = 0; index < bounds_number; ++index)
         {
-            auto [key_to_index, numpy_matrix] = convert_to_numpy_and_free(self);
-            return std::make_tuple(key_to_index, numpy_matrix);
-        }, "Convert the sparse matrix to a NumPy array and free the memory");
+            const int vertex = read_binary<int>(stream);
+            self.vertex_bounds[vertex] = read_binary<double>(stream);
+        }
+    }
+}
+
+// A record of a saved kinship matrix file
+struct KinshipRecord
+{
+    int32_t column;
+    float kinship;
+};
+
+// Collects the kinships between the vertex at the given position and the vertices that follow it in the sorted list
+template<typename KinshipMatrix>
+void collect_upper_row_entries(const KinshipMatrix& self, const std::vector<int>& sorted_vertices, size_t position,
+    std::vector<KinshipRecord>& records)
+{
+    for (const auto& [column, value] : self.at(sorted_vertices[position]))
+    {
+        records.push_back({column, value});
+    }
+}
+
+template<typename KinshipMatrix>
+void add_loaded_vertex(KinshipMatrix& self, int vertex)
+{
+    self[vertex];
+}
+
+template<typename KinshipMatrix>
+void set_kinship_value(KinshipMatrix& self, int key1, int key2, float value)
+{
+    self[std::min(key1, key2)][std::max(key1, key2)] = value;
+}
+
+template<typename KinshipMatrix>
+void set_error_bound(KinshipMatrix& self, double error_bound)
+{
+    self.max_error_bound = error_bound;
+}
+
+// Stores every pair in the row of the vertex that has been added later (the newer vertex), so that removing a vertex
+// only erases its own row. Its pairs with the older vertices are freed together with the row, and its pairs with
+// the newer vertices become dead entries in their rows. The accessors skip the dead entries, and all the rows are
+// rebuilt without them once the estimated number of the dead entries exceeds the number of the live ones. Thus,
+// removing a vertex takes O(1) amortized time per stored pair (instead of a scan over all the rows with an erase in
+// each of them), and the memory of the removed vertices is returned.
+class MemorySparseMatrix
+{
+public:
+    static constexpr const char* storage_name = "memory";
+
+    void add_vertex(const int vertex, const std::vector<int>& parents, const RectangularPairFilter* pair_filter,
+                    const bool is_hemizygous = false)
+    {
+        // Inserting the row first, since the insertion can move the other rows
+        Row& row = rows[vertex];
+        row.order = next_order++;
+        if (!pair_filter)
+        {
+            // With the filter, only a part of the pairs is stored, so the row grows as needed
+            row.entries.reserve(rows.size());
+        }
+        const uint8_t vertex_side = pair_filter ? pair_filter->get_side(vertex) : 0;
+        int first_parent = -1;
+        int second_parent = -1;
+        const Row* first_parent_row = nullptr;
+        const Row* second_parent_row = nullptr;
+        if (!parents.empty())
+        {
+            first_parent = parents[0];
+            first_parent_row = &get_row(first_parent);
+            if (parents.size() > 1)
+            {
+                second_parent = parents[1];
+                second_parent_row = &get_row(second_parent);
+            }
+        }
+        if (!pair_filter || RectangularPairFilter::is_needed(vertex_side, vertex_side))
+        {
+            float self_kinship = is_hemizygous ? 1.0f : 0.5f;
+            if (second_parent_row)
+            {
+                self_kinship = (1 + lookup(first_parent, *first_parent_row, second_parent, *second_parent_row)) / 2.0f;
+            }
+            row.entries[vertex] = self_kinship;
+            ++stored_entries;
+        }
+        for (auto& [other_vertex, other_row] : rows)
+        {
+            if (other_vertex == vertex ||
+                (pair_filter && !RectangularPairFilter::is_needed(vertex_side, pair_filter->get_side(other_vertex))))
+            {
+                continue;
+            }
+            float kinship = 0.0f;
+            if (first_parent_row)
+            {
+                kinship = lookup(first_parent, *first_parent_row, other_vertex, other_row);
+                if (second_parent_row)
+                {
+                    kinship += lookup(second_parent, *second_parent_row, other_vertex, other_row);
+                }
+                if (!is_hemizygous)
+                {
+                    kinship /= 2.0f;
+                }
+            }
+            row.entries[other_vertex] = kinship;
+            ++other_row.newer_entries;
+            ++stored_entries;
+        }
+    }
+
+    void remove_vertex(const int vertex)
+    {
+        auto it = rows.find(vertex);
+        if (it == rows.end())
+        {
+            return;
+        }
+        dead_entries += it->second.newer_entries;
+        stored_entries -= it->second.entries.size();
+        rows.erase(it);
+        if (2 * dead_entries > stored_entries)
+        {
+            remove_dead_entries();
+        }
+    }
+
+    // Removes the pairs of the vertex that are no longer needed according to the filter
+    void remove_unneeded_pairs(const int vertex, const RectangularPairFilter& pair_filter)
+    {
+        Row& row = get_row(vertex);
+        const uint8_t vertex_side = pair_filter.get_side(vertex);
+        for (auto& [other_vertex, other_row] : rows)
+        {
+            if (RectangularPairFilter::is_needed(vertex_side, pair_filter.get_side(other_vertex)))
+            {
+                continue;
+            }
+            if (other_row.order > row.order)
+            {
+                stored_entries -= other_row.entries.erase(vertex);
+            }
+            else
+            {
+                stored_entries -= row.entries.erase(other_vertex);
+            }
+        }
+    }
+
+    bool contains(int vertex) const
+    {
+        return rows.find(vertex) != rows.end();
+    }
+
+    size_t size() const
+    {
+        return rows.size();
+    }
+
+    float get(int first, int second) const
+    {
+        return lookup(first, get_row(first), second, get_row(second));
+    }
+
+    const float* find(int first, int second) const
+    {
+        const Row& first_row = get_row(first);
+        const Row& second_row = get_row(second);
+        const Row& newer_row = first_row.order > second_row.order ? first_row : second_row;
+        auto it = newer_row.entries.find(first_row.order > second_row.order ? second : first);
+        return it == newer_row.entries.end() ? nullptr : &it->second;
+    }
+
+    // Adds a vertex without any pairs, e.g. when a saved matrix is loaded
+    void add_empty_vertex(const int vertex)
+    {
+        rows[vertex].order = next_order++;
+    }
+
+    void set(int first, int second, float value)
+    {
+        Row& first_row = get_row(first);
+        Row& second_row = get_row(second);
+        Row& newer_row = first_row.order > second_row.order ? first_row : second_row;
+        Row& older_row = first_row.order > second_row.order ? second_row : first_row;
+        auto [it, inserted] = newer_row.entries.emplace(first_row.order > second_row.order ? second : first, value);
+        if (!inserted)
+        {
+            it->second = value;
+            return;
+        }
+        ++stored_entries;
+        older_row.newer_entries += first != second;
+    }
+
+    template<typename Function>
+    void for_each_vertex(Function function) const
+    {
+        for (const auto& entry : rows)
+        {
+            function(entry.first);
+        }
+    }
+
+    template<typename Function>
+    void for_each_row_entry(int vertex, Function function) const
+    {
+        for (const auto& [column, value] : get_row(vertex).entries)
+        {
+            if (rows.find(column) != rows.end())
+            {
+                function(column, value);
+            }
+        }
+    }
+
+    void save(std::ostream& stream) const
+    {
+        write_binary(stream, next_order);
+        write_binary(stream, static_cast<uint64_t>(rows.size()));
+        for (const auto& [vertex, row] : rows)
+        {
+            std::vector<KinshipRecord> records;
+            for_each_row_entry(vertex, [&records](int column, float value)
+            {
+                records.push_back({column, value});
+            });
+            write_binary(stream, vertex);
+            write_binary(stream, row.order);
+            write_binary_vector(stream, records);
+        }
+    }
+
+    void load(std::istream& stream)
+    {
+        next_order = read_binary<uint64_t>(stream);
+        const uint64_t rows_number = read_binary<uint64_t>(stream);
+        for (uint64_t index = 0; index < rows_number; ++index)
+        {
+            Row& row = rows[read_binary<int>(stream)];
+            row.order = read_binary<uint64_t>(stream);
+            for (const KinshipRecord& record : read_binary_vector<KinshipRecord>(stream))
+            {
+                row.entries[record.column] = record.kinship;
+            }
+            stored_entries += row.entries.size();
+        }
+        // Only the live entries are saved, so the entry counters are restored from the loaded rows
+        dead_entries = 0;
+        for (const auto& [vertex, row] : rows)
+        {
+            for (const auto& entry : row.entries)
+            {
+                if (entry.first != vertex)
+                {
+                    ++get_row(entry.first).newer_entries;
+                }
+            }
+        }
+    }
+
+    void free()
+    {
+        sparse_hash_map<int, Row>().swap(rows);
+        stored_entries = 0;
+        dead_entries = 0;
+    }
+
+    size_t get_memory_usage() const
+    {
+        size_t bytes = get_sparse_hash_map_bytes(rows);
+        for (const auto& [vertex, row] : rows)
+        {
+            bytes += get_sparse_hash_map_bytes(row.entries);
+        }
+        return bytes;
+    }
+
+    // Every stored vertex has a row with at least one group of buckets. The dead entries are not counted, although
+    // they can take as much space as the live ones until the rows are rebuilt
+    static size_t estimate_memory_usage(size_t vertices, size_t pairs)
+    {
+        return estimate_sparse_hash_map_bytes<sparse_hash_map<int, Row>>(vertices) +
+               vertices * get_sparse_group_bytes<sparse_hash_map<int, float>>() +
+               estimate_sparse_hash_map_bytes<sparse_hash_map<int, float>>(pairs);
+    }
+
+    size_t peak_frontier_size = 0;
+
+private:
+    struct Row
+    {
+        // The position of the vertex in the order of the additions
+        uint64_t order = 0;
+        // The number of the entries of this vertex stored in the rows of the newer vertices
+        size_t newer_entries = 0;
+        sparse_hash_map<int, float> entries;
+    };
+
+    const Row& get_row(int vertex) const
+    {
+        auto it = rows.find(vertex);
+        if (it == rows.end())
+        {
+            throw std::out_of_range("Vertex " + std::to_string(vertex) + " is not present in the matrix");
+        }
+        return it->second;
+    }
+
+    Row& get_row(int vertex)
+    {
+        return const_cast<Row&>(static_cast<const MemorySparseMatrix*>(this)->get_row(vertex));
+    }
+
+    static float lookup(int first, const Row& first_row, int second, const Row& second_row)
+    {
+        if (first_row.order > second_row.order)
+        {
+            return first_row.entries.at(second);
+        }
+        return second_row.entries.at(first);
+    }
+
+    void remove_dead_entries()
+    {
+        for (auto& entry : rows)
+        {
+            Row& row = entry.second;
+            size_t live_entries = 0;
+            for (const auto& [column, value] : row.entries)
+            {
+                live_entries += rows.find(column) != rows.end();
+            }
+            if (live_entries == row.entries.size())
+            {
+                continue;
+            }
+            // Rebuilding the row, since erasing from a sparse hash map doesn't release the memory
+            sparse_hash_map<int, float> live_row;
+            live_row.reserve(live_entries);
+            for (const auto& [column, value] : row.entries)
+            {
+                if (rows.find(column) != rows.end())
+                {
+                    live_row.emplace(column, value);
+                }
+            }
+            stored_entries -= row.entries.size() - live_entries;
+            row.entries.swap(live_row);
+        }
+        dead_entries = 0;
+    }
+
+    sparse_hash_map<int, Row> rows;
+    uint64_t next_order = 0;
+    size_t stored_entries = 0;
+    size_t dead_entries = 0;
+};
+
+void calculate_pair_kinships_sparse(MemorySparseMatrix& kinship_sparse_matrix, const int vertex,
+    const std::unordered_map<int, std::vector<int>>& parents_map, const RectangularPairFilter* pair_filter = nullptr,
+    const bool is_hemizygous = false)
+{
+    auto it = parents_map.find(vertex);
+    kinship_sparse_matrix.add_vertex(vertex, it == parents_map.end() ? std::vector<int>() : it->second, pair_filter,
+                                     is_hemizygous);
+}
+
+void remove_vertex(MemorySparseMatrix& kinship_sparse_matrix, const int vertex)
+{
+    kinship_sparse_matrix.remove_vertex(vertex);
+}
+
+void remove_unneeded_pairs(MemorySparseMatrix& kinship_sparse_matrix, const int vertex,
+    const RectangularPairFilter& pair_filter)
+{
+    kinship_sparse_matrix.remove_unneeded_pairs(vertex, pair_filter);
+}
+
+bool contains_vertex(const MemorySparseMatrix& self, int vertex)
+{
+    return self.contains(vertex);
+}
+
+template<typename Function>
+void for_each_vertex(const MemorySparseMatrix& self, Function function)
+{
+    self.for_each_vertex(function);
+}
+
+template<typename Function>
+void for_each_row_entry(const MemorySparseMatrix& self, int vertex, Function function)
+{
+    self.for_each_row_entry(vertex, function);
+}
+
+float get_kinship_value(const MemorySparseMatrix& self, int key1, int key2)
+{
+    return self.get(key1, key2);
+}
+
+float get_error_bound(const MemorySparseMatrix&)
+{
+    // The values are stored as single-precision floats
+    return 0.0f;
+}
+
+size_t get_memory_usage(const MemorySparseMatrix& self)
+{
+    return self.get_memory_usage();
+}
+
+void free_kinship_matrix(MemorySparseMatrix& self)
+{
+    self.free();
+}
+
+void save_matrix_state(std::ostream& stream, const MemorySparseMatrix& self)
+{
+    self.save(stream);
+}
+
+void load_matrix_state(std::istream& stream, MemorySparseMatrix& self)
+{
+    self.load(stream);
+}
+
+void collect_upper_row_entries(const MemorySparseMatrix& self, const std::vector<int>& sorted_vertices,
+    size_t position, std::vector<KinshipRecord>& records)
+{
+    // The pairs of the vertex are spread over the rows of the newer vertices, so they are looked up one by one
+    const int vertex = sorted_vertices[position];
+    for (size_t index = position; index < sorted_vertices.size(); ++index)
+    {
+        if (const float* value = self.find(vertex, sorted_vertices[index]))
+        {
+            records.push_back({sorted_vertices[index], *value});
+        }
+    }
+}
+
+void add_loaded_vertex(MemorySparseMatrix& self, int vertex)
+{
+    self.add_empty_vertex(vertex);
+}
+
+void set_kinship_value(MemorySparseMatrix& self, int key1, int key2, float value)
+{
+    self.set(key1, key2, value);
+}
+
+void set_error_bound(MemorySparseMatrix&, double)
+{
+}
+
+// Stores the kinships of the frontier vertices in a dense lower-triangular matrix. Every vertex is given a slot, and
+// the slots of the removed vertices are reused by the new ones (the smallest free slot first), so that the matrix
+// size follows the frontier size. The values are stored as fixed-point numbers with sizeof(Value) * 8 - 1 fractional
+// bits. Since the kinship of a child is the average of its parents' kinships, the values are calculated in
+// the integer domain, and every rounding adds at most half a unit in the last place. The error of K(a, b) is bounded
+// by B(a) + B(b), where B is zero for the founders and is the maximum of the parents' bounds plus half a unit
+// otherwise.
+template<typename Value>
+class CompactKinshipMatrix
+{
+public:
+    static constexpr uint64_t one = uint64_t(1) << (sizeof(Value) * 8 - 1);
+    static constexpr const char* storage_name = sizeof(Value) == 2 ? "compact16" : "compact32";
+
+    void add_vertex(const int vertex, const std::vector<int>& parents, const bool is_hemizygous = false)
+    {
+        int first_parent_slot = -1;
+        int second_parent_slot = -1;
+        double bound = 0.0;
+        if (!parents.empty())
+        {
+            first_parent_slot = get_slot(parents[0]);
+            bound = slot_bounds[first_parent_slot];
+            if (parents.size() > 1)
+            {
+                second_parent_slot = get_slot(parents[1]);
+                bound = std::max(bound, slot_bounds[second_parent_slot]);
+            }
+            // The kinships of a hemizygous vertex are copied from its parent without rounding
+            if (!is_hemizygous)
+            {
+                bound += 0.5 / one;
+            }
+        }
+        const int slot = allocate_slot(vertex);
+        slot_bounds[slot] = bound;
+        max_error_bound = std::max(max_error_bound, 2 * bound);
+        const int slots_number = static_cast<int>(rows.size());
+        Value* row = rows[slot].data();
+        for (int other_slot = 0; other_slot < slots_number; ++other_slot)
+        {
+            if (other_slot == slot || slot_vertices[other_slot] < 0)
+            {
+                continue;
+            }
+            uint64_t parents_sum = 0;
+            if (first_parent_slot != -1)
+            {
+                parents_sum = get_code(first_parent_slot, other_slot);
+                if (second_parent_slot != -1)
+                {
+                    parents_sum += get_code(second_parent_slot, other_slot);
+                }
+            }
+            const Value code = static_cast<Value>(is_hemizygous ? parents_sum : (parents_sum + 1) >> 1);
+            if (other_slot < slot)
+            {
+                row[other_slot] = code;
+            }
+            else
+            {
+                rows[other_slot][slot] = code;
+            }
+        }
+        uint64_t parents_kinship = 0;
+        if (second_parent_slot != -1)
+        {
+            parents_kinship = get_code(first_parent_slot, second_parent_slot);
+        }
+        row[slot] = static_cast<Value>(is_hemizygous ? one : (one + parents_kinship + 1) >> 1);
+    }
+
+    void remove_vertex(const int vertex)
+    {
+        auto it = vertex_to_slot.find(vertex);
+        if (it == vertex_to_slot.end())
+        {
+            return;
+        }
+        const int slot = it->second;
+        vertex_to_slot.erase(it);
+        slot_vertices[slot] = -1;
+        std::vector<Value>().swap(rows[slot]);
+        free_slots.push(slot);
+        // The trailing free slots are released, so that the matrix shrinks together with the frontier
+        while (!slot_vertices.empty() && slot_vertices.back() < 0)
+        {
+            rows.pop_back();
+            slot_vertices.pop_back();
+            slot_bounds.pop_back();
+        }
+    }
+
+    bool contains(int vertex) const
+    {
+        return vertex_to_slot.find(vertex) != vertex_to_slot.end();
+    }
+
+    size_t size() const
+    {
+        return vertex_to_slot.size();
+    }
+
+    float get(int first, int second) const
+    {
+        return decode(get_code(get_slot(first), get_slot(second)));
+    }
+
+    float get_error_bound() const
+    {
+        return static_cast<float>(max_error_bound);
+    }
+
+    size_t get_memory_usage() const
+    {
+        size_t bytes = get_flat_hash_map_bytes(vertex_to_slot) + slot_vertices.capacity() * sizeof(int) +
+                       rows.capacity() * sizeof(std::vector<Value>) + slot_bounds.capacity() * sizeof(double);
+        for (const std::vector<Value>& row : rows)
+        {
+            bytes += row.capacity() * sizeof(Value);
+        }
+        return bytes;
+    }
+
+    // Every slot has a row of the values shared with the lower slots, and the vectors of the slots grow twice
+    static size_t estimate_memory_usage(size_t vertices, size_t pairs)
+    {
+        return estimate_flat_hash_map_bytes<flat_hash_map<int, int>>(vertices) +
+               2 * vertices * (sizeof(int) + sizeof(std::vector<Value>) + sizeof(double)) + pairs * sizeof(Value);
+    }
+
+    void set_error_bound(double error_bound)
+    {
+        max_error_bound = error_bound;
+    }
+
+    // Replaces the kinship of two stored vertices, e.g. when a saved matrix is loaded
+    void set(int first, int second, float value)
+    {
+        const int first_slot = get_slot(first);
+        const int second_slot = get_slot(second);
+        const Value code = static_cast<Value>(std::llround(static_cast<double>(value) * one));
+        if (first_slot >= second_slot)
+        {
+            rows[first_slot][second_slot] = code;
+        }
+        else
+        {
+            rows[second_slot][first_slot] = code;
+        }
+    }
+
+    void save(std::ostream& stream) const
+    {
+        write_binary(stream, max_error_bound);
+        write_binary_vector(stream, slot_vertices);
+        write_binary_vector(stream, slot_bounds);
+        for (const auto& row : rows)
+        {
+            write_binary_vector(stream, row);
+        }
+    }
+
+    void load(std::istream& stream)
+    {
+        max_error_bound = read_binary<double>(stream);
+        slot_vertices = read_binary_vector<int>(stream);
+        slot_bounds = read_binary_vector<double>(stream);
+        rows.clear();
+        for (size_t slot = 0; slot < slot_vertices.size(); ++slot)
+        {
+            rows.push_back(read_binary_vector<Value>(stream));
+            if (slot_vertices[slot] >= 0)
+            {
+                vertex_to_slot[slot_vertices[slot]] = static_cast<int>(slot);
+            }
+            else
+            {
+                free_slots.push(static_cast<int>(slot));
+            }
+        }
+    }
+
+    template<typename Function>
+    void for_each_vertex(Function function) const
+    {
+        for (const auto& entry : vertex_to_slot)
+        {
+            function(entry.first);
+        }
+    }
+
+    template<typename Function>
+    void for_each_row_entry(int vertex, Function function) const
+    {
+        const int slot = get_slot(vertex);
+        const std::vector<Value>& row = rows[slot];
+        for (int other_slot = 0; other_slot <= slot; ++other_slot)
+        {
+            if (slot_vertices[other_slot] >= 0)
+            {
+                function(slot_vertices[other_slot], decode(row[other_slot]));
+            }
+        }
+    }
+
+private:
+    static float decode(Value code)
+    {
+        return static_cast<float>(static_cast<double>(code) / one);
+    }
+
+    int get_slot(int vertex) const
+    {
+        auto it = vertex_to_slot.find(vertex);
+        if (it == vertex_to_slot.end())
+        {
+            throw std::out_of_range("Vertex " + std::to_string(vertex) + " is not present in the matrix");
+        }
+        return it->second;
+    }
+
+    Value get_code(int first_slot, int second_slot) const
+    {
+        if (first_slot >= second_slot)
+        {
+            return rows[first_slot][second_slot];
+        }
+        return rows[second_slot][first_slot];
+    }
+
+    int allocate_slot(const int vertex)
+    {
+        // Skipping the entries of the released trailing slots and the slots that have been taken again since
+        while (!free_slots.empty() && (free_slots.top() >= static_cast<int>(rows.size()) ||
+                                       slot_vertices[free_slots.top()] >= 0))
+        {
+            free_slots.pop();
+        }
+        int slot;
+        if (free_slots.empty())
+        {
+            slot = static_cast<int>(rows.size());
+            rows.emplace_back();
+            slot_vertices.push_back(vertex);
+            slot_bounds.push_back(0.0);
+        }
+        else
+        {
+            slot = free_slots.top();
+            free_slots.pop();
+            slot_vertices[slot] = vertex;
+        }
+        rows[slot].assign(slot + 1, 0);
+        vertex_to_slot[vertex] = slot;
+        return slot;
+    }
+
+    flat_hash_map<int, int> vertex_to_slot;
+    std::vector<int> slot_vertices;
+    std::vector<std::vector<Value>> rows;
+    std::vector<double> slot_bounds;
+    std::priority_queue<int, std::vector<int>, std::greater<int>> free_slots;
+    double max_error_bound = 0.0;
+
+public:
+    size_t peak_frontier_size = 0;
+};
+
+typedef CompactKinshipMatrix<uint16_t> Compact16SparseMatrix;
+typedef CompactKinshipMatrix<uint32_t> Compact32SparseMatrix;
+
+// The dense matrix keeps all the pairs of the frontier anyway, so the pair filter isn't used
+template<typename Value>
+void calculate_pair_kinships_sparse(CompactKinshipMatrix<Value>& kinship_sparse_matrix, const int vertex,
+    const std::unordered_map<int, std::vector<int>>& parents_map, const RectangularPairFilter* = nullptr,
+    const bool is_hemizygous = false)
+{
+    auto it = parents_map.find(vertex);
+    kinship_sparse_matrix.add_vertex(vertex, it == parents_map.end() ? std::vector<int>() : it->second,
+                                     is_hemizygous);
+}
+
+template<typename Value>
+void remove_vertex(CompactKinshipMatrix<Value>& kinship_sparse_matrix, const int vertex)
+{
+    kinship_sparse_matrix.remove_vertex(vertex);
+}
+
+template<typename Value>
+void remove_unneeded_pairs(CompactKinshipMatrix<Value>&, const int, const RectangularPairFilter&)
+{
+}
+
+template<typename Value>
+bool contains_vertex(const CompactKinshipMatrix<Value>& self, int vertex)
+{
+    return self.contains(vertex);
+}
+
+template<typename Value, typename Function>
+void for_each_vertex(const CompactKinshipMatrix<Value>& self, Function function)
+{
+    self.for_each_vertex(function);
+}
+
+template<typename Value, typename Function>
+void for_each_row_entry(const CompactKinshipMatrix<Value>& self, int vertex, Function function)
+{
+    self.for_each_row_entry(vertex, function);
+}
+
+template<typename Value>
+float get_kinship_value(const CompactKinshipMatrix<Value>& self, int key1, int key2)
+{
+    return self.get(key1, key2);
+}
+
+template<typename Value>
+float get_error_bound(const CompactKinshipMatrix<Value>& self)
+{
+    return self.get_error_bound();
+}
+
+template<typename Value>
+size_t get_memory_usage(const CompactKinshipMatrix<Value>& self)
+{
+    return self.get_memory_usage();
+}
+
+template<typename Value>
+void collect_upper_row_entries(const CompactKinshipMatrix<Value>& self, const std::vector<int>& sorted_vertices,
+    size_t position, std::vector<KinshipRecord>& records)
+{
+    // The dense matrix stores every pair, so the values are taken for all the following vertices
+    const int vertex = sorted_vertices[position];
+    for (size_t index = position; index < sorted_vertices.size(); ++index)
+    {
+        records.push_back({sorted_vertices[index], self.get(vertex, sorted_vertices[index])});
+    }
+}
+
+template<typename Value>
+void add_loaded_vertex(CompactKinshipMatrix<Value>& self, int vertex)
+{
+    self.add_vertex(vertex, {});
+}
+
+template<typename Value>
+void set_kinship_value(CompactKinshipMatrix<Value>& self, int key1, int key2, float value)
+{
+    self.set(key1, key2, value);
+}
+
+template<typename Value>
+void set_error_bound(CompactKinshipMatrix<Value>& self, double error_bound)
+{
+    self.set_error_bound(error_bound);
+}
+
+template<typename Value>
+void save_matrix_state(std::ostream& stream, const CompactKinshipMatrix<Value>& self)
+{
+    self.save(stream);
+}
+
+template<typename Value>
+void load_matrix_state(std::istream& stream, CompactKinshipMatrix<Value>& self)
+{
+    self.load(stream);
+}
+
+template<typename Value>
+void free_kinship_matrix(CompactKinshipMatrix<Value>& self)
+{
+    const size_t peak_frontier_size = self.peak_frontier_size;
+    self = CompactKinshipMatrix<Value>();
+    self.peak_frontier_size = peak_frontier_size;
+}
+
+// Replays the kinship calculation without calculating the values. Only the frontier (the vertices whose kinships are
+// kept in the matrix) is tracked, which is enough to estimate the memory usage and the running time of the calculation.
+// The sides of the frontier vertices are counted as well, so that the number of the stored pairs is known when
+// the pairs are restricted by the column vertices.
+struct KinshipFrontierCounter
+{
+    static constexpr const char* storage_name = "plan";
+    size_t frontier_size = 0;
+    size_t peak_frontier_size = 0;
+    size_t peak_stored_pairs = 0;
+    size_t pair_updates = 0;
+    size_t processed_vertices = 0;
+    flat_hash_map<int, uint8_t> vertex_sides;
+    std::array<size_t, 4> side_counts = {};
+
+    // Returns the number of the pairs of the frontier vertices (including the self-pairs) that are stored
+    size_t get_stored_pairs() const
+    {
+        const size_t both_sides = side_counts[RectangularPairFilter::ROW | RectangularPairFilter::COLUMN];
+        const size_t rows = side_counts[RectangularPairFilter::ROW];
+        const size_t columns = side_counts[RectangularPairFilter::COLUMN];
+        return rows * columns + (rows + columns) * both_sides + both_sides * (both_sides + 1) / 2;
+    }
+
+    void set_side(const int vertex, const uint8_t side)
+    {
+        auto [it, inserted] = vertex_sides.emplace(vertex, side);
+        if (!inserted)
+        {
+            --side_counts[it->second];
+            it->second = side;
+        }
+        ++side_counts[side];
+    }
+};
+
+void calculate_pair_kinships_sparse(KinshipFrontierCounter& counter, const int vertex,
+    const std::unordered_map<int, std::vector<int>>&, const RectangularPairFilter* pair_filter = nullptr,
+    const bool = false)
+{
+    counter.pair_updates += ++counter.frontier_size;
+    ++counter.processed_vertices;
+    // Without the filter, all the pairs are stored, as if every vertex had both sides
+    counter.set_side(vertex, pair_filter ? pair_filter->get_side(vertex) :
+                             RectangularPairFilter::ROW | RectangularPairFilter::COLUMN);
+    counter.peak_stored_pairs = std::max(counter.peak_stored_pairs, counter.get_stored_pairs());
+}
+
+void remove_vertex(KinshipFrontierCounter& counter, const int vertex)
+{
+    --counter.frontier_size;
+    auto it = counter.vertex_sides.find(vertex);
+    --counter.side_counts[it->second];
+    counter.vertex_sides.erase(it);
+}
+
+void remove_unneeded_pairs(KinshipFrontierCounter& counter, const int vertex, const RectangularPairFilter& pair_filter)
+{
+    counter.set_side(vertex, pair_filter.get_side(vertex));
+}
+
+void save_matrix_state(std::ostream& stream, const KinshipFrontierCounter& counter)
+{
+    write_binary(stream, counter.frontier_size);
+    write_binary(stream, counter.peak_stored_pairs);
+    write_binary(stream, counter.pair_updates);
+    write_binary(stream, counter.processed_vertices);
+    write_binary(stream, static_cast<uint64_t>(counter.vertex_sides.size()));
+    for (const auto& [vertex, side] : counter.vertex_sides)
+    {
+        write_binary(stream, vertex);
+        write_binary(stream, side);
+    }
+}
+
+void load_matrix_state(std::istream& stream, KinshipFrontierCounter& counter)
+{
+    counter.frontier_size = read_binary<size_t>(stream);
+    counter.peak_stored_pairs = read_binary<size_t>(stream);
+    counter.pair_updates = read_binary<size_t>(stream);
+    counter.processed_vertices = read_binary<size_t>(stream);
+    const uint64_t vertices_number = read_binary<uint64_t>(stream);
+    for (uint64_t index = 0; index < vertices_number; ++index)
+    {
+        const int vertex = read_binary<int>(stream);
+        counter.set_side(vertex, read_binary<uint8_t>(stream));
+    }
+}
+
+// Accumulates the kinship sums between the groups of probands without retaining the probands in the matrix. Every
+// vertex in the frontier has a row with the sums of its kinships with the probands of every group that have already
+// left the frontier. The kinship of a new vertex is the average of its parents' kinships, so its row is the average
+// of the parents' rows. A proband leaves the frontier like any other vertex (as soon as all its children have been
+// processed), and its kinships with the frontier are added to the rows of its group, so only the sums over the pairs
+// of groups are kept.
+class GroupKinshipAccumulator
+{
+public:
+    GroupKinshipAccumulator(const std::unordered_map<int, int>& proband_groups, size_t groups_number)
+        : proband_groups(proband_groups), groups_number(groups_number),
+          pair_sums(groups_number * groups_number, 0.0), self_sums(groups_number, 0.0)
+    {
+        for (const auto& [proband, group] : proband_groups)
+        {
+            if (group < 0 || static_cast<size_t>(group) >= groups_number)
+            {
+                throw std::invalid_argument("The group of proband " + std::to_string(proband) + " is out of range");
+            }
+        }
+    }
+
+    void add_vertex(const int vertex, const std::vector<int>& parents)
+    {
+        std::vector<double> sums(groups_number, 0.0);
+        for (const int parent : parents)
+        {
+            const std::vector<double>& parent_sums = vertex_sums.at(parent);
+            for (size_t group = 0; group < groups_number; ++group)
+            {
+                sums[group] += parent_sums[group] / 2;
+            }
+        }
+        vertex_sums[vertex] = std::move(sums);
+    }
+
+    // Removes the vertex's row. If the vertex is a proband, its kinships with the frontier are added to the sums
+    template<typename KinshipMatrix>
+    void remove_vertex(const KinshipMatrix& kinship_sparse_matrix, const int vertex)
+    {
+        auto row = vertex_sums.find(vertex);
+        const std::vector<double> sums = std::move(row->second);
+        vertex_sums.erase(row);
+        auto group_entry = proband_groups.find(vertex);
+        if (group_entry == proband_groups.end())
+        {
+            return;
+        }
+        const size_t vertex_group = group_entry->second;
+        // The pairs with the probands that have left the frontier earlier
+        for (size_t group = 0; group < groups_number; ++group)
+        {
+            pair_sums[vertex_group * groups_number + group] += sums[group];
+            pair_sums[group * groups_number + vertex_group] += sums[group];
+        }
+        self_sums[vertex_group] += get_kinship_value(kinship_sparse_matrix, vertex, vertex);
+        for (auto& [other_vertex, other_sums] : vertex_sums)
+        {
+            other_sums[vertex_group] += get_kinship_value(kinship_sparse_matrix, vertex, other_vertex);
+        }
+    }
+
+    // The sums over the ordered pairs of different probands from the two groups
+    const std::vector<double>& get_pair_sums() const
+    {
+        return pair_sums;
+    }
+
+    const std::vector<double>& get_self_sums() const
+    {
+        return self_sums;
+    }
+
+    void save(std::ostream& stream) const
+    {
+        write_binary_vector(stream, pair_sums);
+        write_binary_vector(stream, self_sums);
+        write_binary(stream, static_cast<uint64_t>(vertex_sums.size()));
+        for (const auto& [vertex, sums] : vertex_sums)
+        {
+            write_binary(stream, vertex);
+            stream.write(reinterpret_cast<const char*>(sums.data()), sums.size() * sizeof(double));
+        }
+    }
+
+    void load(std::istream& stream)
+    {
+        pair_sums = read_binary_vector<double>(stream);
+        self_sums = read_binary_vector<double>(stream);
+        if (pair_sums.size() != groups_number * groups_number || self_sums.size() != groups_number)
+        {
+            throw std::runtime_error("The file is truncated or corrupted");
+        }
+        vertex_sums.clear();
+        const uint64_t size = read_binary<uint64_t>(stream);
+        for (uint64_t index = 0; index < size; ++index)
+        {
+            const int vertex = read_binary<int>(stream);
+            vertex_sums[vertex] = read_binary_array<double>(stream, groups_number);
+        }
+    }
+
+private:
+    const std::unordered_map<int, int>& proband_groups;
+    size_t groups_number;
+    std::vector<double> pair_sums;
+    std::vector<double> self_sums;
+    flat_hash_map<int, std::vector<double>> vertex_sums;
+};
+
+template<typename KinshipMatrix>
+void remove_group_vertex(GroupKinshipAccumulator& group_accumulator, const KinshipMatrix& kinship_sparse_matrix,
+    const int vertex)
+{
+    group_accumulator.remove_vertex(kinship_sparse_matrix, vertex);
+}
+
+void remove_group_vertex(GroupKinshipAccumulator&, const KinshipFrontierCounter&, const int)
+{
+}
+
+// The kinships of a cached ancestral frontier. The frontier vertices are founders of the genealogy that stand for
+// the generations above them, so they are processed before any other vertex and their kinships are taken from
+// the cache instead of being zeros. The kinships are packed like the upper triangle of a matrix (including
+// the diagonal) row by row in the order of the vertices.
+class FrontierSeed
+{
+public:
+    // The packed kinships are referenced rather than copied, as the frontier can be large. They must outlive the seed
+    FrontierSeed(const std::unordered_map<int, std::vector<int>>& parents, const std::vector<int>& vertices,
+                 const float* kinships, const size_t kinships_number)
+        : vertices(vertices), kinships(kinships)
+    {
+        if (kinships_number != vertices.size() * (vertices.size() + 1) / 2)
+        {
+            throw std::invalid_argument("The frontier kinships must contain " +
+                                        std::to_string(vertices.size() * (vertices.size() + 1) / 2) + " values");
+        }
+        for (size_t position = 0; position < vertices.size(); ++position)
+        {
+            const int vertex = vertices[position];
+            auto it = parents.find(vertex);
+            if (it == parents.end() || !it->second.empty())
+            {
+                throw std::invalid_argument("The frontier vertex " + std::to_string(vertex) +
+                                            " must be a founder of the genealogy");
+            }
+            vertex_positions[vertex] = position;
+        }
+    }
+
+    const std::vector<int>& get_vertices() const
+    {
+        return vertices;
+    }
+
+    bool contains(int vertex) const
+    {
+        return vertex_positions.find(vertex) != vertex_positions.end();
+    }
+
+    float get_kinship(int first, int second) const
+    {
+        size_t first_position = vertex_positions.at(first);
+        size_t second_position = vertex_positions.at(second);
+        if (first_position > second_position)
+        {
+            std::swap(first_position, second_position);
+        }
+        return kinships[first_position * vertices.size() - first_position * (first_position - 1) / 2 +
+                        (second_position - first_position)];
+    }
+
+private:
+    std::vector<int> vertices;
+    const float* kinships;
+    flat_hash_map<int, size_t> vertex_positions;
+};
+
+void set_kinship_value(KinshipFrontierCounter&, int, int, float)
+{
+}
+
+// The order in which the ready vertices (the vertices whose parents have all been processed) are processed. The order
+// determines the peak frontier size, which determines the memory usage and the running time of the calculation:
+// - additional_space: the children that become ready together are processed as a batch, and the batches that increase
+//   the frontier the least go first.
+// - generation: the vertices with the greater level (the length of the longest path to a proband) go first, so that
+//   the genealogy is processed generation by generation.
+// - min_fill: the vertex whose processing increases the frontier the least goes first. A vertex is queued again with
+//   the updated priority when one of its parents has only one unprocessed child left.
+// - explicit: the vertices are processed in the given order as soon as their parents have been processed.
+enum class FrontierOrdering { ADDITIONAL_SPACE, GENERATION, MIN_FILL, EXPLICIT };
+
+FrontierOrdering parse_frontier_ordering(const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order)
+{
+    if (ordering == "explicit" || vertex_order)
+    {
+        if (!vertex_order || ordering != "explicit")
+        {
+            throw std::invalid_argument("The vertex order must be given if and only if the ordering is 'explicit'");
+        }
+        return FrontierOrdering::EXPLICIT;
+    }
+    if (ordering == "additional_space")
+    {
+        return FrontierOrdering::ADDITIONAL_SPACE;
+    }
+    if (ordering == "generation")
+    {
+        return FrontierOrdering::GENERATION;
+    }
+    if (ordering == "min_fill")
+    {
+        return FrontierOrdering::MIN_FILL;
+    }
+    throw std::invalid_argument("Unsupported ordering " + ordering +
+                                ", expected 'additional_space', 'generation', 'min_fill' or 'explicit'");
+}
+
+// Calculates the level of every vertex in the genealogy (the length of the longest path to a vertex without children)
+flat_hash_map<int, int> calculate_genealogy_levels(
+    const std::unordered_map<int, std::vector<int>>& children,
+    const std::unordered_map<int, std::vector<int>>& parents)
+{
+    flat_hash_map<int, int> levels;
+    flat_hash_map<int, int> remaining_children;
+    std::vector<int> stack;
+    levels.reserve(children.size());
+    for (const auto& [vertex, vertex_children] : children)
+    {
+        levels[vertex] = 0;
+        remaining_children[vertex] = static_cast<int>(vertex_children.size());
+        if (vertex_children.empty())
+        {
+            stack.push_back(vertex);
+        }
+    }
+    while (!stack.empty())
+    {
+        const int vertex = stack.back();
+        stack.pop_back();
+        for (const int parent : parents.at(vertex))
+        {
+            levels[parent] = std::max(levels[parent], levels[vertex] + 1);
+            if (--remaining_children[parent] == 0)
+            {
+                stack.push_back(parent);
+            }
+        }
+    }
+    return levels;
+}
+
+// Calculates the FNV-1a hash of the calculation input, so that a checkpoint is never resumed with a different input
+uint64_t calculate_input_fingerprint(
+    const std::unordered_map<int, std::vector<int>>& parents,
+    const std::unordered_set<int>& sink_vertices,
+    const std::optional<std::unordered_set<int>>& column_vertices,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::string& storage_name,
+    const std::unordered_map<int, int>* proband_groups = nullptr,
+    float drop_threshold = 0.0f,
+    const FrontierSeed* frontier_seed = nullptr,
+    const std::unordered_set<int>* hemizygous_vertices = nullptr)
+{
+    uint64_t hash = 14695981039346656037ULL;
+    auto mix = [&hash](uint64_t value)
+    {
+        for (int byte = 0; byte < 8; ++byte)
+        {
+            hash = (hash ^ ((value >> (byte * 8)) & 0xFF)) * 1099511628211ULL;
+        }
+    };
+    std::vector<int> vertices;
+    vertices.reserve(parents.size());
+    for (const auto& entry : parents)
+    {
+        vertices.push_back(entry.first);
+    }
+    std::sort(vertices.begin(), vertices.end());
+    for (const int vertex : vertices)
+    {
+        const std::vector<int>& vertex_parents = parents.at(vertex);
+        mix(vertex);
+        mix(vertex_parents.size());
+        for (const int parent : vertex_parents)
+        {
+            mix(parent);
+        }
+    }
+    for (const auto* vertex_set : {&sink_vertices, column_vertices ? &*column_vertices : nullptr})
+    {
+        if (!vertex_set)
+        {
+            continue;
+        }
+        std::vector<int> sorted_vertices(vertex_set->begin(), vertex_set->end());
+        std::sort(sorted_vertices.begin(), sorted_vertices.end());
+        mix(sorted_vertices.size());
+        for (const int vertex : sorted_vertices)
+        {
+            mix(vertex);
+        }
+    }
+    for (const std::string& text : {ordering, storage_name})
+    {
+        mix(text.size());
+        for (const char character : text)
+        {
+            mix(static_cast<unsigned char>(character));
+        }
+    }
+    if (vertex_order)
+    {
+        for (const int vertex : *vertex_order)
+        {
+            mix(vertex);
+        }
+    }
+    if (proband_groups)
+    {
+        std::vector<std::pair<int, int>> sorted_groups(proband_groups->begin(), proband_groups->end());
+        std::sort(sorted_groups.begin(), sorted_groups.end());
+        mix(sorted_groups.size());
+        for (const auto& [proband, group] : sorted_groups)
+        {
+            mix(proband);
+            mix(group);
+        }
+    }
+    if (drop_threshold > 0)
+    {
+        uint32_t threshold_bits;
+        std::memcpy(&threshold_bits, &drop_threshold, sizeof(threshold_bits));
+        mix(threshold_bits);
+    }
+    if (hemizygous_vertices)
+    {
+        std::vector<int> sorted_vertices(hemizygous_vertices->begin(), hemizygous_vertices->end());
+        std::sort(sorted_vertices.begin(), sorted_vertices.end());
+        mix(sorted_vertices.size());
+        for (const int vertex : sorted_vertices)
+        {
+            mix(vertex);
+        }
+    }
+    if (frontier_seed)
+    {
+        const std::vector<int>& frontier_vertices = frontier_seed->get_vertices();
+        mix(frontier_vertices.size());
+        for (const int first : frontier_vertices)
+        {
+            mix(first);
+            for (const int second : frontier_vertices)
+            {
+                const float kinship = frontier_seed->get_kinship(first, second);
+                uint32_t kinship_bits;
+                std::memcpy(&kinship_bits, &kinship, sizeof(kinship_bits));
+                mix(kinship_bits);
+            }
+        }
+    }
+    return hash;
+}
+
+using QueueElement = std::pair<float, std::vector<int>>;
+
+struct CompareOnlyFirst {
+    bool operator()(const QueueElement& a, const QueueElement& b) {
+        return a.first > b.first; // Min-heap: smallest priority at the top
+    }
+};
+
+template<typename KinshipMatrix>
+KinshipMatrix calculate_kinship_sparse(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    std::unordered_set<int>& sink_vertices,
+    const std::string& ordering = "additional_space",
+    const std::optional<std::vector<int>>& vertex_order = std::nullopt,
+    const std::optional<std::string>& checkpoint_path = std::nullopt,
+    double checkpoint_interval = 3600.0,
+    const std::optional<std::unordered_set<int>>& column_vertices = std::nullopt,
+    const std::unordered_map<int, int>* proband_groups = nullptr,
+    GroupKinshipAccumulator* group_accumulator = nullptr,
+    float drop_threshold = 0.0f,
+    const FrontierSeed* frontier_seed = nullptr,
+    const std::unordered_set<int>* hemizygous_vertices = nullptr)
+{
+    const FrontierOrdering frontier_ordering = parse_frontier_ordering(ordering, vertex_order);
+    // Find the founders
+    flat_hash_set<int> founders;
+    for (const auto& entry : parents)
+    {
+        if (entry.second.empty())
+        {
+            founders.insert(entry.first);
+        }
+    }
+    // Initialize the maps that will keep track of how many children/parents need to be processed
+    flat_hash_map<int, int> parent_to_remaining_children;
+    flat_hash_map<int, int> child_to_remaining_parents;
+    parent_to_remaining_children.reserve(children.size());
+    child_to_remaining_parents.reserve(parents.size());
+    for (const auto& entry : children)
+    {
+        parent_to_remaining_children[entry.first] = entry.second.size();
+    }
+    for (const auto& entry : parents)
+    {
+        child_to_remaining_parents[entry.first] = entry.second.size();
+    }
+    // Initialize the fixed priorities of the vertices
+    flat_hash_map<int, float> vertex_priorities;
+    if (frontier_ordering == FrontierOrdering::GENERATION)
+    {
+        for (const auto& [vertex, level] : calculate_genealogy_levels(children, parents))
+        {
+            vertex_priorities[vertex] = static_cast<float>(-level);
+        }
+    }
+    else if (frontier_ordering == FrontierOrdering::EXPLICIT)
+    {
+        for (size_t position = 0; position < vertex_order->size(); ++position)
+        {
+            vertex_priorities.emplace((*vertex_order)[position], static_cast<float>(position));
+        }
+        for (const auto& entry : parents)
+        {
+            if (vertex_priorities.find(entry.first) == vertex_priorities.end())
+            {
+                throw std::invalid_argument("The vertex order must contain all the vertices of the genealogy, "
+                                            "but vertex " + std::to_string(entry.first) + " is missing");
+            }
+        }
+    }
+    auto get_priority = [&](const int vertex) -> float
+    {
+        if (frontier_ordering != FrontierOrdering::MIN_FILL)
+        {
+            return vertex_priorities.at(vertex);
+        }
+        // The vertex is added to the frontier, and the non-proband parents for which it is the last unprocessed
+        // child are removed from it
+        float frontier_change = 1.0f;
+        for (const int parent : parents.at(vertex))
+        {
+            if (parent_to_remaining_children.at(parent) == 1 && sink_vertices.find(parent) == sink_vertices.end())
+            {
+                frontier_change -= 1.0f;
+            }
+        }
+        return frontier_change;
+    };
+    KinshipMatrix kinship_sparse_matrix;
+    set_drop_threshold(kinship_sparse_matrix, drop_threshold);
+    std::priority_queue<QueueElement, std::vector<QueueElement>, CompareOnlyFirst> queue;
+    flat_hash_set<int> queued_vertices;
+    size_t frontier_size = 0;
+    size_t peak_frontier_size = 0;
+    // The checkpoint contains the input fingerprint, the counters, the queue and the matrix state
+    const uint64_t fingerprint = checkpoint_path ? calculate_input_fingerprint(
+        parents, sink_vertices, column_vertices, ordering, vertex_order, KinshipMatrix::storage_name,
+        proband_groups, drop_threshold, frontier_seed, hemizygous_vertices) : 0;
+    // If the column vertices are given, only the pairs between the row (sink) vertices and the column vertices are
+    // kept, and both the row and the column vertices are retained
+    std::optional<RectangularPairFilter> pair_filter;
+    if (column_vertices)
+    {
+        pair_filter.emplace(parents, sink_vertices, *column_vertices);
+        sink_vertices.insert(column_vertices->begin(), column_vertices->end());
+    }
+    auto retire_retained_vertex = [&](const int vertex)
+    {
+        pair_filter->retire(vertex);
+        remove_unneeded_pairs(kinship_sparse_matrix, vertex, *pair_filter);
+    };
+    const char checkpoint_magic[8] = {'L', 'K', 'K', 'C', 'K', 'P', 'T', '1'};
+    auto write_counters = [](std::ostream& stream, const flat_hash_map<int, int>& counters)
+    {
+        write_binary(stream, static_cast<uint64_t>(counters.size()));
+        for (const auto& [vertex, counter] : counters)
+        {
+            write_binary(stream, vertex);
+            write_binary(stream, counter);
+        }
+    };
+    auto read_counters = [](std::istream& stream, flat_hash_map<int, int>& counters)
+    {
+        counters.clear();
+        const uint64_t size = read_binary<uint64_t>(stream);
+        for (uint64_t index = 0; index < size; ++index)
+        {
+            const int vertex = read_binary<int>(stream);
+            counters[vertex] = read_binary<int>(stream);
+        }
+    };
+    auto save_checkpoint = [&]()
+    {
+        // Writing to a temporary file first, so that a crash during the writing doesn't corrupt the last checkpoint
+        const std::string temporary_path = *checkpoint_path + ".tmp";
+        {
+            std::ofstream stream(temporary_path, std::ios::binary | std::ios::trunc);
+            stream.write(checkpoint_magic, sizeof(checkpoint_magic));
+            write_binary(stream, fingerprint);
+            write_binary(stream, frontier_size);
+            write_binary(stream, peak_frontier_size);
+            write_counters(stream, parent_to_remaining_children);
+            write_counters(stream, child_to_remaining_parents);
+            write_binary_vector(stream, std::vector<int>(queued_vertices.begin(), queued_vertices.end()));
+            auto queue_copy = queue;
+            write_binary(stream, static_cast<uint64_t>(queue_copy.size()));
+            while (!queue_copy.empty())
+            {
+                write_binary(stream, queue_copy.top().first);
+                write_binary_vector(stream, queue_copy.top().second);
+                queue_copy.pop();
+            }
+            save_matrix_state(stream, kinship_sparse_matrix);
+            if (group_accumulator)
+            {
+                group_accumulator->save(stream);
+            }
+            stream.close();
+            if (!stream)
+            {
+                throw std::runtime_error("Could not write the checkpoint file " + temporary_path);
+            }
+        }
+        if (std::rename(temporary_path.c_str(), checkpoint_path->c_str()) != 0)
+        {
+            throw std::runtime_error("Could not replace the checkpoint file " + *checkpoint_path);
+        }
+    };
+    std::ifstream checkpoint_stream;
+    if (checkpoint_path)
+    {
+        checkpoint_stream.open(*checkpoint_path, std::ios::binary);
+    }
+    if (checkpoint_stream.is_open())
+    {
+        // Resuming the calculation from the checkpoint
+        char magic[sizeof(checkpoint_magic)];
+        checkpoint_stream.read(magic, sizeof(magic));
+        if (!checkpoint_stream || std::memcmp(magic, checkpoint_magic, sizeof(magic)) != 0)
+        {
+            throw std::runtime_error("The file " + *checkpoint_path + " is not a kinship checkpoint");
+        }
+        if (read_binary<uint64_t>(checkpoint_stream) != fingerprint)
+        {
+            throw std::invalid_argument("The checkpoint " + *checkpoint_path + " has been created for a different "
+                                        "genealogy, proband set, ordering or mode");
+        }
+        frontier_size = read_binary<size_t>(checkpoint_stream);
+        peak_frontier_size = read_binary<size_t>(checkpoint_stream);
+        read_counters(checkpoint_stream, parent_to_remaining_children);
+        read_counters(checkpoint_stream, child_to_remaining_parents);
+        const std::vector<int> checkpoint_queued_vertices = read_binary_vector<int>(checkpoint_stream);
+        queued_vertices.insert(checkpoint_queued_vertices.begin(), checkpoint_queued_vertices.end());
+        const uint64_t queue_size = read_binary<uint64_t>(checkpoint_stream);
+        for (uint64_t index = 0; index < queue_size; ++index)
+        {
+            const float priority = read_binary<float>(checkpoint_stream);
+            queue.emplace(priority, read_binary_vector<int>(checkpoint_stream));
+        }
+        load_matrix_state(checkpoint_stream, kinship_sparse_matrix);
+        if (group_accumulator)
+        {
+            group_accumulator->load(checkpoint_stream);
+        }
+        checkpoint_stream.close();
+        if (pair_filter)
+        {
+            // Restoring the sides of the retained vertices whose children have all been processed
+            for (const int vertex : sink_vertices)
+            {
+                const bool is_processed = queued_vertices.find(vertex) == queued_vertices.end() &&
+                                          (parents.at(vertex).empty() ||
+                                           child_to_remaining_parents.find(vertex) == child_to_remaining_parents.end());
+                if (is_processed && parent_to_remaining_children.at(vertex) == 0)
+                {
+                    pair_filter->retire(vertex);
+                }
+            }
+        }
+    }
+    else
+    {
+        // Initialize the queue with the founders. The frontier vertices are processed first as a single batch, so
+        // that their cached kinships are set before any other vertex is calculated from them
+        if (frontier_seed)
+        {
+            queue.emplace(-std::numeric_limits<float>::infinity(), frontier_seed->get_vertices());
+            queued_vertices.insert(frontier_seed->get_vertices().begin(), frontier_seed->get_vertices().end());
+        }
+        for (const auto& founder : founders)
+        {
+            if (frontier_seed && frontier_seed->contains(founder))
+            {
+                continue;
+            }
+            const float priority = frontier_ordering == FrontierOrdering::ADDITIONAL_SPACE ? 1 :
+                                   get_priority(founder);
+            queue.emplace(priority, std::vector<int>{founder});
+            queued_vertices.insert(founder);
+        }
+    }
+    auto last_checkpoint_time = std::chrono::steady_clock::now();
+    // Calculate the kinships
+    while (!queue.empty())
+    {
+        if (checkpoint_path)
+        {
+            // An interrupted calculation (e.g. by Ctrl+C) saves its state before raising the exception
+            if (PyErr_CheckSignals() != 0)
+            {
+                save_checkpoint();
+                throw py::error_already_set();
+            }
+            if (std::chrono::duration<double>(std::chrono::steady_clock::now() - last_checkpoint_time).count() >=
+                checkpoint_interval)
+            {
+                save_checkpoint();
+                last_checkpoint_time = std::chrono::steady_clock::now();
+            }
+        }
+        auto [priority, vertices] = queue.top();
+        queue.pop();
+        for (const int vertex : vertices)
+        {
+            if (queued_vertices.erase(vertex) == 0)
+            {
+                // The vertex has been queued again with a better priority and has already been processed
+                continue;
+            }
+            calculate_pair_kinships_sparse(kinship_sparse_matrix, vertex, parents,
+                                           pair_filter ? &*pair_filter : nullptr,
+                                           hemizygous_vertices && hemizygous_vertices->count(vertex));
+            if (frontier_seed && frontier_seed->contains(vertex))
+            {
+                // The frontier batch goes first, so the other frontier vertices in the matrix are the only
+                // vertices that can be related to this one
+                for (const int frontier_vertex : frontier_seed->get_vertices())
+                {
+                    set_kinship_value(kinship_sparse_matrix, vertex, frontier_vertex,
+                                      frontier_seed->get_kinship(vertex, frontier_vertex));
+                    if (frontier_vertex == vertex)
+                    {
+                        break;
+                    }
+                }
+            }
+            peak_frontier_size = std::max(peak_frontier_size, ++frontier_size);
+            if (pair_filter && children.at(vertex).empty() && sink_vertices.find(vertex) != sink_vertices.end())
+            {
+                retire_retained_vertex(vertex);
+            }
+            if (group_accumulator)
+            {
+                group_accumulator->add_vertex(vertex, parents.at(vertex));
+                if (children.at(vertex).empty())
+                {
+                    // Nothing is retained, so the vertices without children leave the frontier immediately
+                    remove_group_vertex(*group_accumulator, kinship_sparse_matrix, vertex);
+                    remove_vertex(kinship_sparse_matrix, vertex);
+                    --frontier_size;
+                }
+            }
+            for (const auto& parent : parents.at(vertex))
+            {
+                // Updating the counter of unprocessed children for the parent
+                const int remaining_children = --parent_to_remaining_children[parent];
+                if (sink_vertices.find(parent) != sink_vertices.end())
+                {
+                    if (pair_filter && remaining_children == 0)
+                    {
+                        retire_retained_vertex(parent);
+                    }
+                    continue;
+                }
+                if (remaining_children == 0)
+                {
+                    // Erasing the parent's kinship information because it isn't a proband
+                    // and all of its children have been processed
+                    parent_to_remaining_children.erase(parent);
+                    if (group_accumulator)
+                    {
+                        remove_group_vertex(*group_accumulator, kinship_sparse_matrix, parent);
+                    }
+                    remove_vertex(kinship_sparse_matrix, parent);
+                    --frontier_size;
+                }
+                else if (remaining_children == 1 && frontier_ordering == FrontierOrdering::MIN_FILL)
+                {
+                    // Processing the last child of the parent will remove the parent from the frontier
+                    for (const int child : children.at(parent))
+                    {
+                        if (queued_vertices.find(child) != queued_vertices.end())
+                        {
+                            queue.emplace(get_priority(child), std::vector<int>{child});
+                        }
+                    }
+                }
+            }
+
+            flat_hash_set<int> children_to_add;
+            for (const auto& child : children.at(vertex))
+            {
+                if (--child_to_remaining_parents[child] == 0)
+                {
+                    children_to_add.insert(child);
+                    child_to_remaining_parents.erase(child);
+                }
+            }
+            queued_vertices.insert(children_to_add.begin(), children_to_add.end());
+
+            if (!children_to_add.empty() && frontier_ordering != FrontierOrdering::ADDITIONAL_SPACE)
+            {
+                for (const int child : children_to_add)
+                {
+                    queue.emplace(get_priority(child), std::vector<int>{child});
+                }
+            }
+            else if (!children_to_add.empty())
+            {
+                float additional_space = (float) children_to_add.size();
+                flat_hash_set<int> children_parents;
+                for (const int child : children_to_add)
+                {
+                    for (const int parent : parents.at(child))
+                    {
+                        children_parents.insert(parent);
+                    }
+                }
+                for (const int child_parent : children_parents)
+                {
+                    const int children_unprocessed = parent_to_remaining_children.at(child_parent);
+                    int counter = 0;
+                    for (const int child : children.at(child_parent))
+                    {
+                        if (children_to_add.find(child) == children_to_add.end())
+                        {
+                            counter++;
+                        }
+                    }
+                    if (children_unprocessed != counter)
+                    {
+                        additional_space -= 1.0f;
+                    }
+                }
+                queue.emplace(additional_space, std::vector<int>(children_to_add.begin(), children_to_add.end()));
+            }
+        }
+    }
+    kinship_sparse_matrix.peak_frontier_size = peak_frontier_size;
+    if (checkpoint_path)
+    {
+        // The calculation is complete, so the checkpoint is no longer needed
+        std::remove(checkpoint_path->c_str());
+    }
+    return kinship_sparse_matrix;
+}
+
+std::optional<FrontierSeed> make_frontier_seed(const std::unordered_map<int, std::vector<int>>& parents,
+    const std::optional<std::vector<int>>& frontier_vertices,
+    const std::optional<py::array_t<float, py::array::c_style | py::array::forcecast>>& frontier_kinships)
+{
+    if (frontier_vertices.has_value() != frontier_kinships.has_value())
+    {
+        throw std::invalid_argument("The frontier vertices and the frontier kinships must be specified together");
+    }
+    if (!frontier_vertices)
+    {
+        return std::nullopt;
+    }
+    if (frontier_kinships->ndim() != 1)
+    {
+        throw std::invalid_argument("The frontier kinships must be a one-dimensional array");
+    }
+    return FrontierSeed(parents, *frontier_vertices, frontier_kinships->data(),
+                        static_cast<size_t>(frontier_kinships->size()));
+}
+
+// Checks that every hemizygous vertex has at most one parent (e.g. only the mother of a male for the X chromosome)
+const std::unordered_set<int>* validate_hemizygous_vertices(const std::unordered_map<int, std::vector<int>>& parents,
+    const std::optional<std::unordered_set<int>>& hemizygous_vertices)
+{
+    if (!hemizygous_vertices)
+    {
+        return nullptr;
+    }
+    for (const int vertex : *hemizygous_vertices)
+    {
+        auto it = parents.find(vertex);
+        if (it != parents.end() && it->second.size() > 1)
+        {
+            throw std::invalid_argument("The hemizygous vertex " + std::to_string(vertex) +
+                                        " must have at most one parent");
+        }
+    }
+    return &*hemizygous_vertices;
+}
+
+TimeSparseMatrix calculate_kinship_sparse_speed(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    std::unordered_set<int>& sink_vertices,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::string>& checkpoint_path,
+    double checkpoint_interval,
+    const std::optional<std::unordered_set<int>>& column_vertices,
+    float drop_threshold,
+    const std::optional<std::vector<int>>& frontier_vertices,
+    const std::optional<py::array_t<float, py::array::c_style | py::array::forcecast>>& frontier_kinships,
+    const std::optional<std::unordered_set<int>>& hemizygous_vertices)
+{
+    if (drop_threshold < 0)
+    {
+        throw std::invalid_argument("The drop threshold must be non-negative");
+    }
+    const std::optional<FrontierSeed> frontier_seed = make_frontier_seed(parents, frontier_vertices,
+                                                                         frontier_kinships);
+    return calculate_kinship_sparse<TimeSparseMatrix>(children, parents, sink_vertices, ordering, vertex_order,
+                                           checkpoint_path, checkpoint_interval, column_vertices, nullptr, nullptr,
+                                           drop_threshold, frontier_seed ? &*frontier_seed : nullptr,
+                                           validate_hemizygous_vertices(parents, hemizygous_vertices));
+}
+
+MemorySparseMatrix calculate_kinship_sparse_memory(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    std::unordered_set<int>& sink_vertices,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::string>& checkpoint_path,
+    double checkpoint_interval,
+    const std::optional<std::unordered_set<int>>& column_vertices,
+    const std::optional<std::vector<int>>& frontier_vertices,
+    const std::optional<py::array_t<float, py::array::c_style | py::array::forcecast>>& frontier_kinships,
+    const std::optional<std::unordered_set<int>>& hemizygous_vertices)
+{
+    const std::optional<FrontierSeed> frontier_seed = make_frontier_seed(parents, frontier_vertices,
+                                                                         frontier_kinships);
+    return calculate_kinship_sparse<MemorySparseMatrix>(children, parents, sink_vertices, ordering, vertex_order,
+                                           checkpoint_path, checkpoint_interval, column_vertices, nullptr, nullptr,
+                                           0.0f, frontier_seed ? &*frontier_seed : nullptr,
+                                           validate_hemizygous_vertices(parents, hemizygous_vertices));
+}
+
+std::tuple<size_t, size_t, size_t, std::unordered_map<std::string, size_t>> plan_kinship_sparse(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    std::unordered_set<int>& sink_vertices,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::unordered_set<int>>& column_vertices)
+{
+    const KinshipFrontierCounter counter = calculate_kinship_sparse<KinshipFrontierCounter>(
+        children, parents, sink_vertices, ordering, vertex_order, std::nullopt, 3600.0, column_vertices);
+    // The hash map based storages only keep the needed pairs, while the dense storages keep all the frontier pairs
+    const size_t peak_vertices = counter.peak_frontier_size;
+    const size_t peak_pairs = peak_vertices * (peak_vertices + 1) / 2;
+    const size_t peak_stored_pairs = counter.peak_stored_pairs;
+    std::unordered_map<std::string, size_t> memory_estimates;
+    memory_estimates[TimeSparseMatrix::storage_name] = TimeSparseMatrix::estimate_memory_usage(peak_vertices,
+                                                                                                 peak_stored_pairs);
+    memory_estimates[MemorySparseMatrix::storage_name] = MemorySparseMatrix::estimate_memory_usage(
+        peak_vertices, peak_stored_pairs);
+    memory_estimates[Compact16SparseMatrix::storage_name] = Compact16SparseMatrix::estimate_memory_usage(
+        peak_vertices, peak_pairs);
+    memory_estimates[Compact32SparseMatrix::storage_name] = Compact32SparseMatrix::estimate_memory_usage(
+        peak_vertices, peak_pairs);
+    return {counter.peak_frontier_size, counter.pair_updates, counter.processed_vertices, memory_estimates};
+}
+
+Compact16SparseMatrix calculate_kinship_sparse_compact16(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    std::unordered_set<int>& sink_vertices,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::string>& checkpoint_path,
+    double checkpoint_interval,
+    const std::optional<std::unordered_set<int>>& column_vertices,
+    const std::optional<std::unordered_set<int>>& hemizygous_vertices)
+{
+    return calculate_kinship_sparse<Compact16SparseMatrix>(children, parents, sink_vertices, ordering, vertex_order,
+                                           checkpoint_path, checkpoint_interval, column_vertices, nullptr, nullptr,
+                                           0.0f, nullptr, validate_hemizygous_vertices(parents, hemizygous_vertices));
+}
+
+Compact32SparseMatrix calculate_kinship_sparse_compact32(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    std::unordered_set<int>& sink_vertices,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::string>& checkpoint_path,
+    double checkpoint_interval,
+    const std::optional<std::unordered_set<int>>& column_vertices,
+    const std::optional<std::unordered_set<int>>& hemizygous_vertices)
+{
+    return calculate_kinship_sparse<Compact32SparseMatrix>(children, parents, sink_vertices, ordering, vertex_order,
+                                           checkpoint_path, checkpoint_interval, column_vertices, nullptr, nullptr,
+                                           0.0f, nullptr, validate_hemizygous_vertices(parents, hemizygous_vertices));
+}
+
+template<typename KinshipMatrix>
+std::tuple<py::array_t<double>, py::array_t<double>, size_t> calculate_group_kinship_sums(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    const std::unordered_map<int, int>& proband_groups,
+    size_t groups_number,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::string>& checkpoint_path,
+    double checkpoint_interval)
+{
+    GroupKinshipAccumulator group_accumulator(proband_groups, groups_number);
+    std::unordered_set<int> sink_vertices;
+    const KinshipMatrix kinship_sparse_matrix = calculate_kinship_sparse<KinshipMatrix>(
+        children, parents, sink_vertices, ordering, vertex_order, checkpoint_path, checkpoint_interval, std::nullopt,
+        &proband_groups, &group_accumulator);
+    const std::vector<double>& pair_sums = group_accumulator.get_pair_sums();
+    const std::vector<double>& self_sums = group_accumulator.get_self_sums();
+    const py::ssize_t size = static_cast<py::ssize_t>(groups_number);
+    py::array_t<double> pair_sums_array({size, size});
+    py::array_t<double> self_sums_array(size);
+    std::copy(pair_sums.begin(), pair_sums.end(), pair_sums_array.mutable_data());
+    std::copy(self_sums.begin(), self_sums.end(), self_sums_array.mutable_data());
+    return {pair_sums_array, self_sums_array, kinship_sparse_matrix.peak_frontier_size};
+}
+
+std::tuple<py::array_t<double>, py::array_t<double>, size_t> calculate_group_kinship_sums_for_storage(
+    std::unordered_map<int, std::vector<int>>& children,
+    std::unordered_map<int, std::vector<int>>& parents,
+    const std::unordered_map<int, int>& proband_groups,
+    size_t groups_number,
+    const std::string& storage,
+    const std::string& ordering,
+    const std::optional<std::vector<int>>& vertex_order,
+    const std::optional<std::string>& checkpoint_path,
+    double checkpoint_interval)
+{
+    if (storage == TimeSparseMatrix::storage_name)
+    {
+        return calculate_group_kinship_sums<TimeSparseMatrix>(children, parents, proband_groups, groups_number,
+            ordering, vertex_order, checkpoint_path, checkpoint_interval);
+    }
+    if (storage == MemorySparseMatrix::storage_name)
+    {
+        return calculate_group_kinship_sums<MemorySparseMatrix>(children, parents, proband_groups, groups_number,
+            ordering, vertex_order, checkpoint_path, checkpoint_interval);
+    }
+    if (storage == Compact16SparseMatrix::storage_name)
+    {
+        return calculate_group_kinship_sums<Compact16SparseMatrix>(children, parents, proband_groups, groups_number,
+            ordering, vertex_order, checkpoint_path, checkpoint_interval);
+    }
+    if (storage == Compact32SparseMatrix::storage_name)
+    {
+        return calculate_group_kinship_sums<Compact32SparseMatrix>(children, parents, proband_groups, groups_number,
+            ordering, vertex_order, checkpoint_path, checkpoint_interval);
+    }
+    throw std::invalid_argument("Unsupported storage " + storage +
+                                ", expected 'speed', 'memory', 'compact16' or 'compact32'");
+}
+
+template<typename KinshipMatrix>
+std::pair<std::unordered_map<size_t, size_t>, py::array_t<float>> convert_to_numpy_and_free(KinshipMatrix& self)
+{
+    // Create a mapping of keys to contiguous indices
+    std::unordered_map<size_t, size_t> key_to_index;
+    int index = 0;
+    for_each_vertex(self, [&](int vertex)
+    {
+        key_to_index[vertex] = index++;
+    });
+
+    size_t size = key_to_index.size();
+
+    // Create a NumPy array of shape (size, size)
+    py::array_t<float> numpy_matrix({size, size});
+    // The pairs that aren't stored in the matrix (e.g. between two row vertices of a rectangular matrix) are zeros
+    std::fill(numpy_matrix.mutable_data(), numpy_matrix.mutable_data() + numpy_matrix.size(), 0.0f);
+    auto buffer = numpy_matrix.mutable_unchecked<2>();
+
+    for (const auto& [vertex, row_index] : key_to_index)
+    {
+        for_each_row_entry(self, vertex, [&](int column, float value)
+        {
+            size_t col_index = key_to_index[column];
+            buffer(row_index, col_index) = value;
+            buffer(col_index, row_index) = value;
+        });
+    }
+    free_kinship_matrix(self);
+    return {key_to_index, numpy_matrix};
+}
+
+template<typename KinshipMatrix>
+std::vector<int> get_matrix_vertices(const KinshipMatrix& self, const std::optional<std::vector<int>>& vertices)
+{
+    if (vertices)
+    {
+        for (const int vertex : *vertices)
+        {
+            if (!contains_vertex(self, vertex))
+            {
+                throw std::out_of_range("Vertex " + std::to_string(vertex) + " is not present in the matrix");
+            }
+        }
+        return *vertices;
+    }
+    std::vector<int> result;
+    result.reserve(self.size());
+    for_each_vertex(self, [&](int vertex)
+    {
+        result.push_back(vertex);
+    });
+    std::sort(result.begin(), result.end());
+    return result;
+}
+
+template<typename KinshipMatrix>
+std::pair<py::array_t<int>, py::array_t<float>> convert_to_packed(KinshipMatrix& self,
+    const std::optional<std::vector<int>>& vertices, bool free)
+{
+    const std::vector<int> ordered_vertices = get_matrix_vertices(self, vertices);
+    const size_t size = ordered_vertices.size();
+    flat_hash_map<int, size_t> key_to_index;
+    key_to_index.reserve(size);
+    for (size_t index = 0; index < size; ++index)
+    {
+        key_to_index[ordered_vertices[index]] = index;
+    }
+    // The upper triangle (including the diagonal) is stored row by row
+    py::array_t<float> packed(size * (size + 1) / 2);
+    float* buffer = packed.mutable_data();
+    std::fill(buffer, buffer + packed.size(), 0.0f);
+    for (size_t row_index = 0; row_index < size; ++row_index)
+    {
+        for_each_row_entry(self, ordered_vertices[row_index], [&](int column, float value)
+        {
+            auto column_it = key_to_index.find(column);
+            if (column_it == key_to_index.end())
+            {
+                return;
+            }
+            size_t first = row_index;
+            size_t second = column_it->second;
+            if (first > second)
+            {
+                std::swap(first, second);
+            }
+            buffer[first * size - first * (first - 1) / 2 + (second - first)] = value;
+        });
+    }
+    if (free)
+    {
+        free_kinship_matrix(self);
+    }
+    return {py::array_t<int>(size, ordered_vertices.data()), packed};
+}
+
+template<typename KinshipMatrix>
+std::pair<py::array_t<int>, py::object> convert_to_scipy_sparse(KinshipMatrix& self,
+    const std::optional<std::vector<int>>& vertices, const std::string& sparse_format, bool symmetric, bool free)
+{
+    if (sparse_format != "csr" && sparse_format != "coo")
+    {
+        throw std::invalid_argument("Unsupported sparse format " + sparse_format + ", expected 'csr' or 'coo'");
+    }
+    const std::vector<int> ordered_vertices = get_matrix_vertices(self, vertices);
+    const size_t size = ordered_vertices.size();
+    flat_hash_map<int, int> key_to_index;
+    key_to_index.reserve(size);
+    for (size_t index = 0; index < size; ++index)
+    {
+        key_to_index[ordered_vertices[index]] = static_cast<int>(index);
+    }
+    std::vector<int> rows;
+    std::vector<int> columns;
+    std::vector<float> values;
+    for (size_t row_index = 0; row_index < size; ++row_index)
+    {
+        for_each_row_entry(self, ordered_vertices[row_index], [&](int column, float value)
+        {
+            auto column_it = key_to_index.find(column);
+            if (column_it == key_to_index.end() || value == 0.0f)
+            {
+                return;
+            }
+            int first = static_cast<int>(row_index);
+            int second = column_it->second;
+            if (first > second)
+            {
+                std::swap(first, second);
+            }
+            rows.push_back(first);
+            columns.push_back(second);
+            values.push_back(value);
+            if (symmetric && first != second)
+            {
+                rows.push_back(second);
+                columns.push_back(first);
+                values.push_back(value);
+            }
+        });
+    }
+    if (free)
+    {
+        free_kinship_matrix(self);
+    }
+    py::module_ scipy_sparse = py::module_::import("scipy.sparse");
+    py::object matrix = scipy_sparse.attr("coo_matrix")(
+        py::make_tuple(py::array_t<float>(values.size(), values.data()),
+                       py::make_tuple(py::array_t<int>(rows.size(), rows.data()),
+                                      py::array_t<int>(columns.size(), columns.data()))),
+        py::arg("shape") = py::make_tuple(size, size));
+    if (sparse_format == "csr")
+    {
+        matrix = matrix.attr("tocsr")();
+    }
+    return {py::array_t<int>(size, ordered_vertices.data()), matrix};
+}
+
+template<typename KinshipMatrix>
+py::array_t<float> get_kinships(const KinshipMatrix& self,
+    const py::array_t<int, py::array::c_style | py::array::forcecast>& first_vertices,
+    const py::array_t<int, py::array::c_style | py::array::forcecast>& second_vertices)
+{
+    if (first_vertices.ndim() != 1 || first_vertices.shape(0) != second_vertices.size())
+    {
+        throw std::invalid_argument("The vertex arrays must be one-dimensional and have the same length");
+    }
+    const py::ssize_t size = first_vertices.shape(0);
+    py::array_t<float> result(size);
+    float* buffer = result.mutable_data();
+    const int* first = first_vertices.data();
+    const int* second = second_vertices.data();
+    for (py::ssize_t index = 0; index < size; ++index)
+    {
+        buffer[index] = get_kinship_value(self, first[index], second[index]);
+    }
+    return result;
+}
+
+template<typename KinshipMatrix>
+std::pair<py::array_t<int>, py::array_t<float>> get_kinship_rows(const KinshipMatrix& self,
+    const py::array_t<int, py::array::c_style | py::array::forcecast>& vertices,
+    const std::optional<std::vector<int>>& columns)
+{
+    const std::vector<int> column_vertices = get_matrix_vertices(self, columns);
+    const py::ssize_t rows_number = vertices.size();
+    const size_t columns_number = column_vertices.size();
+    py::array_t<float> result({static_cast<size_t>(rows_number), columns_number});
+    auto buffer = result.template mutable_unchecked<2>();
+    const int* row_vertices = vertices.data();
+    for (py::ssize_t row_index = 0; row_index < rows_number; ++row_index)
+    {
+        for (size_t column_index = 0; column_index < columns_number; ++column_index)
+        {
+            buffer(row_index, column_index) = get_kinship_value(self, row_vertices[row_index],
+                                                                column_vertices[column_index]);
+        }
+    }
+    return {py::array_t<int>(columns_number, column_vertices.data()), result};
+}
+
+// Iterates over the stored (first vertex, second vertex, kinship) triples in chunks of NumPy arrays.
+// Every unordered pair (including the diagonal) is produced exactly once.
+template<typename KinshipMatrix>
+class KinshipPairIterator
+{
+public:
+    KinshipPairIterator(const KinshipMatrix& matrix, size_t chunk_size)
+        : matrix(matrix), chunk_size(chunk_size)
+    {
+        if (chunk_size == 0)
+        {
+            throw std::invalid_argument("The chunk size must be positive");
+        }
+        for_each_vertex(matrix, [&](int vertex)
+        {
+            row_vertices.push_back(vertex);
+        });
+    }
+
+    std::tuple<py::array_t<int>, py::array_t<int>, py::array_t<float>> next()
+    {
+        std::vector<int> first_vertices;
+        std::vector<int> second_vertices;
+        std::vector<float> values;
+        first_vertices.reserve(chunk_size);
+        second_vertices.reserve(chunk_size);
+        values.reserve(chunk_size);
+        while (values.size() < chunk_size)
+        {
+            if (entry_index == row_entries.size())
+            {
+                // Loading the next row
+                if (row_index == row_vertices.size())
+                {
+                    break;
+                }
+                row_entries.clear();
+                entry_index = 0;
+                for_each_row_entry(matrix, row_vertices[row_index++], [&](int column, float value)
+                {
+                    row_entries.emplace_back(column, value);
+                });
+                continue;
+            }
+            first_vertices.push_back(row_vertices[row_index - 1]);
+            second_vertices.push_back(row_entries[entry_index].first);
+            values.push_back(row_entries[entry_index].second);
+            ++entry_index;
+        }
+        if (values.empty())
+        {
+            throw py::stop_iteration();
+        }
+        return {py::array_t<int>(first_vertices.size(), first_vertices.data()),
+                py::array_t<int>(second_vertices.size(), second_vertices.data()),
+                py::array_t<float>(values.size(), values.data())};
+    }
+
+private:
+    const KinshipMatrix& matrix;
+    size_t chunk_size;
+    std::vector<int> row_vertices;
+    size_t row_index = 0;
+    std::vector<std::pair<int, float>> row_entries;
+    size_t entry_index = 0;
+};
+
+// Buffers the output and writes it to the file in large blocks. If the output is compressed, every block is passed
+// through a gzip compressor created by the zlib Python module, so that no additional native dependencies are needed.
+// The class is kept in an anonymous namespace, as it holds a Python object (which has hidden visibility).
+namespace {
+class BufferedPairWriter
+{
+public:
+    BufferedPairWriter(const std::string& filepath, bool compress, size_t buffer_size)
+        : file(filepath, std::ios::binary | std::ios::trunc), buffer_size(buffer_size)
+    {
+        if (!file)
+        {
+            throw std::runtime_error("Could not open the file " + filepath);
+        }
+        if (compress)
+        {
+            // The wbits value 31 makes zlib produce the gzip format
+            compressor = py::module_::import("zlib").attr("compressobj")(6, 8, 31);
+        }
+        buffer.reserve(buffer_size + 64);
+    }
+
+    void write(const char* data, size_t size)
+    {
+        buffer.append(data, size);
+        if (buffer.size() >= buffer_size)
+        {
+            flush();
+        }
+    }
+
+    void close()
+    {
+        flush();
+        if (compressor)
+        {
+            write_bytes(compressor.attr("flush")());
+        }
+        file.close();
+        if (!file)
+        {
+            throw std::runtime_error("Could not write the kinship pairs to the file");
+        }
+    }
+
+private:
+    void flush()
+    {
+        if (buffer.empty())
+        {
+            return;
+        }
+        if (compressor)
+        {
+            write_bytes(compressor.attr("compress")(py::bytes(buffer)));
+        }
+        else
+        {
+            file.write(buffer.data(), static_cast<std::streamsize>(buffer.size()));
+        }
+        buffer.clear();
+    }
+
+    void write_bytes(const py::object& data)
+    {
+        char* bytes_buffer;
+        py::ssize_t length;
+        PyBytes_AsStringAndSize(data.ptr(), &bytes_buffer, &length);
+        file.write(bytes_buffer, length);
+    }
+
+    std::ofstream file;
+    size_t buffer_size;
+    std::string buffer;
+    py::object compressor;
+};
+}
+
+// Writes the kinship pairs to the given file. Every unordered pair is written once with the smaller id first. If the
+// vertices are specified, only the pairs containing at least one of them are written, and this vertex is written first.
+template<typename KinshipMatrix>
+size_t write_kinship_pairs(const KinshipMatrix& self, const std::string& filepath, const std::string& file_format,
+    const std::string& compression, std::optional<float> threshold, const std::optional<std::vector<int>>& vertices,
+    bool include_self, const std::optional<std::vector<std::string>>& column_names, const std::string& separator,
+    size_t buffer_size)
+{
+    if (file_format != "csv" && file_format != "binary")
+    {
+        throw std::invalid_argument("Unsupported file format " + file_format + ", expected 'csv' or 'binary'");
+    }
+    bool compress;
+    if (compression == "infer")
+    {
+        compress = filepath.size() >= 3 && filepath.compare(filepath.size() - 3, 3, ".gz") == 0;
+    }
+    else if (compression == "gzip" || compression == "none")
+    {
+        compress = compression == "gzip";
+    }
+    else
+    {
+        throw std::invalid_argument("Unsupported compression " + compression + ", expected 'infer', 'gzip' or 'none'");
+    }
+    flat_hash_set<int> row_vertices;
+    if (vertices)
+    {
+        get_matrix_vertices(self, vertices);
+        row_vertices.insert(vertices->begin(), vertices->end());
+    }
+    const bool binary = file_format == "binary";
+    BufferedPairWriter writer(filepath, compress, buffer_size);
+    if (!binary && column_names)
+    {
+        std::string header;
+        for (size_t index = 0; index < column_names->size(); ++index)
+        {
+            header += (index ? separator : "") + (*column_names)[index];
+        }
+        header += '\n';
+        writer.write(header.data(), header.size());
+    }
+    size_t pairs_written = 0;
+    char record[2 * sizeof(int) + sizeof(float)];
+    std::string line;
+    line.reserve(2 * separator.size() + 64);
+    const auto append_number = [&line](auto number)
+    {
+        char digits[32];
+        const auto [end, error] = std::to_chars(digits, digits + sizeof(digits), number);
+        if (error != std::errc())
+        {
+            throw std::runtime_error("Failed to format a kinship pair");
+        }
+        line.append(digits, end);
+    };
+    for_each_vertex(self, [&](int row_vertex)
+    {
+        for_each_row_entry(self, row_vertex, [&](int column_vertex, float value)
+        {
+            if ((!include_self && row_vertex == column_vertex) || (threshold && value < *threshold))
+            {
+                return;
+            }
+            int first = std::min(row_vertex, column_vertex);
+            int second = std::max(row_vertex, column_vertex);
+            if (vertices)
+            {
+                if (row_vertices.find(first) == row_vertices.end())
+                {
+                    if (row_vertices.find(second) == row_vertices.end())
+                    {
+                        return;
+                    }
+                    std::swap(first, second);
+                }
+            }
+            if (binary)
+            {
+                std::memcpy(record, &first, sizeof(int));
+                std::memcpy(record + sizeof(int), &second, sizeof(int));
+                std::memcpy(record + 2 * sizeof(int), &value, sizeof(float));
+                writer.write(record, sizeof(record));
+            }
+            else
+            {
+                line.clear();
+                append_number(first);
+                line += separator;
+                append_number(second);
+                line += separator;
+                append_number(value);
+                line += '\n';
+                writer.write(line.data(), line.size());
+            }
+            ++pairs_written;
+        });
+    });
+    writer.close();
+    return pairs_written;
+}
+
+// The saved kinship matrix file consists of:
+// - the 48-byte header: the magic bytes, the format version (32-bit), the drop threshold (32-bit float, zero if all
+//   the pairs are stored), the number of vertices, the number of pairs, the peak frontier size (64-bit integers) and
+//   the error bound (64-bit float);
+// - the sorted vertex ids (32-bit integers), padded to a multiple of 8 bytes;
+// - the pair records (a 32-bit column id followed by a 32-bit float kinship). Every unordered pair is stored once in
+//   the row of the smaller vertex, and the records of every row are sorted by the column id. If the drop threshold
+//   is positive, the missing pairs of the stored vertices are zeros;
+// - the offsets of the rows in the records (number of vertices + 1 64-bit integers).
+// All the values are little-endian. The layout allows querying the file through numpy.memmap without loading it.
+constexpr char kinship_file_magic[8] = {'L', 'K', 'K', 'I', 'N', 'S', 'H', 'P'};
+constexpr uint32_t kinship_file_version = 1;
+
+template<typename KinshipMatrix>
+void save_kinship_matrix(const KinshipMatrix& self, std::ostream& stream)
+{
+    const std::vector<int> vertices = get_matrix_vertices(self, std::nullopt);
+    stream.write(kinship_file_magic, sizeof(kinship_file_magic));
+    write_binary(stream, kinship_file_version);
+    write_binary(stream, get_drop_threshold(self));
+    write_binary(stream, static_cast<uint64_t>(vertices.size()));
+    const auto pairs_number_position = stream.tellp();
+    write_binary(stream, uint64_t(0));
+    write_binary(stream, static_cast<uint64_t>(self.peak_frontier_size));
+    write_binary(stream, static_cast<double>(get_error_bound(self)));
+    stream.write(reinterpret_cast<const char*>(vertices.data()), vertices.size() * sizeof(int));
+    if (vertices.size() % 2 == 1)
+    {
+        write_binary(stream, int32_t(0));
+    }
+    std::vector<int64_t> offsets;
+    offsets.reserve(vertices.size() + 1);
+    offsets.push_back(0);
+    std::vector<KinshipRecord> records;
+    for (size_t position = 0; position < vertices.size(); ++position)
+    {
+        records.clear();
+        collect_upper_row_entries(self, vertices, position, records);
+        std::sort(records.begin(), records.end(), [](const KinshipRecord& first, const KinshipRecord& second)
+        {
+            return first.column < second.column;
+        });
+        stream.write(reinterpret_cast<const char*>(records.data()), records.size() * sizeof(KinshipRecord));
+        offsets.push_back(offsets.back() + static_cast<int64_t>(records.size()));
+    }
+    stream.write(reinterpret_cast<const char*>(offsets.data()), offsets.size() * sizeof(int64_t));
+    stream.seekp(pairs_number_position);
+    write_binary(stream, static_cast<uint64_t>(offsets.back()));
+    stream.seekp(0, std::ios::end);
+    if (!stream)
+    {
+        throw std::runtime_error("Could not write the kinship matrix");
+    }
+}
+
+template<typename KinshipMatrix>
+KinshipMatrix load_kinship_matrix(std::istream& stream)
+{
+    char magic[sizeof(kinship_file_magic)];
+    stream.read(magic, sizeof(magic));
+    if (!stream || std::memcmp(magic, kinship_file_magic, sizeof(magic)) != 0)
+    {
+        throw std::invalid_argument("The data is not a saved kinship matrix");
+    }
+    const uint32_t version = read_binary<uint32_t>(stream);
+    if (version != kinship_file_version)
+    {
+        throw std::invalid_argument("Unsupported kinship matrix format version " + std::to_string(version));
+    }
+    const float drop_threshold = read_binary<float>(stream);
+    const uint64_t vertices_number = read_binary<uint64_t>(stream);
+    const uint64_t pairs_number = read_binary<uint64_t>(stream);
+    const uint64_t peak_frontier_size = read_binary<uint64_t>(stream);
+    const double error_bound = read_binary<double>(stream);
+    const std::vector<int> vertices = read_binary_array<int>(stream, vertices_number);
+    if (vertices_number % 2 == 1)
+    {
+        read_binary<int32_t>(stream);
+    }
+    // The row offsets follow the records, so they are read first
+    const auto records_position = stream.tellg();
+    stream.seekg(records_position + static_cast<std::streamoff>(pairs_number * sizeof(KinshipRecord)));
+    const std::vector<int64_t> offsets = read_binary_array<int64_t>(stream, vertices_number + 1);
+    stream.seekg(records_position);
+    KinshipMatrix self;
+    set_drop_threshold(self, drop_threshold);
+    for (const int vertex : vertices)
+    {
+        add_loaded_vertex(self, vertex);
+    }
+    for (size_t index = 0; index < vertices_number; ++index)
+    {
+        for (const KinshipRecord& record :
+             read_binary_array<KinshipRecord>(stream, offsets[index + 1] - offsets[index]))
+        {
+            set_kinship_value(self, vertices[index], record.column, record.kinship);
+        }
+    }
+    set_error_bound(self, error_bound);
+    self.peak_frontier_size = peak_frontier_size;
+    return self;
+}
+
+template<typename KinshipMatrix>
+void bind_kinship_matrix(py::module_& m, const char* name)
+{
+    using PairIterator = KinshipPairIterator<KinshipMatrix>;
+    py::class_<PairIterator>(m, (std::string(name) + "PairIterator").c_str())
+        .def("__iter__", [](PairIterator& self) -> PairIterator& { return self; })
+        .def("__next__", &PairIterator::next);
+    py::class_<KinshipMatrix>(m, name)
+        .def("get_kinship", [](const KinshipMatrix& self, int key1, int key2)
+        {
+            return get_kinship_value(self, key1, key2);
+        }, "Get the float value for two integers", py::arg("key1"), py::arg("key2"))
+        .def("get_peak_frontier_size", [](const KinshipMatrix& self)
+        {
+            return self.peak_frontier_size;
+        }, "Get the peak number of vertices stored in the matrix during the calculation")
+        .def("get_memory_usage", [](const KinshipMatrix& self)
+        {
+            return get_memory_usage(self);
+        }, "Get the number of bytes taken by the hash maps and the arrays of the matrix")
+        .def("get_error_bound", [](const KinshipMatrix& self)
+        {
+            return get_error_bound(self);
+        }, "Get the upper bound on the absolute error of the stored kinships caused by the value encoding or "
+           "the dropped entries")
+        .def("get_drop_threshold", [](const KinshipMatrix& self)
+        {
+            return get_drop_threshold(self);
+        }, "Get the threshold below which the kinships are not stored (zero if all the kinships are stored)")
+        .def("to_numpy_and_free", [](KinshipMatrix& self)
+        {
+            auto [key_to_index, numpy_matrix] = convert_to_numpy_and_free(self);
+            return std::make_tuple(key_to_index, numpy_matrix);
+        }, "Convert the sparse matrix to a NumPy array and free the memory")
+        .def("to_packed", &convert_to_packed<KinshipMatrix>,
+             "Export the upper triangle (including the diagonal) for the given vertices as a packed NumPy array",
+             py::arg("vertices") = py::none(), py::arg("free") = false)
+        .def("to_sparse", &convert_to_scipy_sparse<KinshipMatrix>,
+             "Export the non-zero kinships for the given vertices as a scipy.sparse matrix",
+             py::arg("vertices") = py::none(), py::arg("sparse_format") = "csr",
+             py::arg("symmetric") = false, py::arg("free") = false)
+        .def("get_kinships", &get_kinships<KinshipMatrix>,
+             "Get the kinships for the pairs given by two NumPy arrays of the same length",
+             py::arg("ids1"), py::arg("ids2"))
+        .def("get_kinship_rows", &get_kinship_rows<KinshipMatrix>,
+             "Get the kinship rows for the given vertices against the given columns (all the vertices by default)",
+             py::arg("ids"), py::arg("columns") = py::none())
+        .def("iter_pairs", [](const KinshipMatrix& self, size_t chunk_size)
+        {
+            return PairIterator(self, chunk_size);
+        }, "Iterate over the stored (id1, id2, kinship) triples in chunks of NumPy arrays",
+           py::arg("chunk_size") = 1 << 20, py::keep_alive<0, 1>())
+        .def("write_pairs", &write_kinship_pairs<KinshipMatrix>,
+             "Stream the kinship pairs to a CSV (optionally gzip-compressed) or a binary triplet file",
+             py::arg("filepath"), py::arg("file_format") = "csv", py::arg("compression") = "infer",
+             py::arg("threshold") = py::none(), py::arg("vertices") = py::none(), py::arg("include_self") = false,
+             py::arg("column_names") = std::vector<std::string>{"id1", "id2", "kinship"},
+             py::arg("separator") = ",", py::arg("buffer_size") = 1 << 24)
+        .def("save", [](const KinshipMatrix& self, const std::string& filepath)
+        {
+            std::ofstream stream(filepath, std::ios::binary | std::ios::trunc);
+            if (!stream)
+            {
+                throw std::runtime_error("Could not open the file " + filepath);
+            }
+            save_kinship_matrix(self, stream);
+        }, "Save the matrix to a binary file that can be loaded or memory-mapped", py::arg("filepath"))
+        .def_static("load", [](const std::string& filepath)
+        {
+            std::ifstream stream(filepath, std::ios::binary);
+            if (!stream)
+            {
+                throw std::runtime_error("Could not open the file " + filepath);
+            }
+            return load_kinship_matrix<KinshipMatrix>(stream);
+        }, "Load a matrix saved by the save method", py::arg("filepath"))
+        .def(py::pickle(
+            [](const KinshipMatrix& self)
+            {
+                std::ostringstream stream(std::ios::binary);
+                save_kinship_matrix(self, stream);
+                return py::bytes(stream.str());
+            },
+            [](const py::bytes& state)
+            {
+                std::istringstream stream(std::string(state), std::ios::binary);
+                return load_kinship_matrix<KinshipMatrix>(stream);
+            }));
+}
+
+// Calculates the kinship for individual pairs on demand using the recursive definition of kinship:
+// K(a, b) = (K(p_1(a), b) + K(p_2(a), b)) / 2 if a is not an ancestor of b, and K(a, a) = (1 + K(p_1(a), p_2(a))) / 2.
+// The recursion is always done on the younger vertex (the one with the lower level), which can't be an ancestor of
+// the other one. The intermediate values are stored in a memo table that is shared between the queries and is bounded
+// by the cache size (the least recently used values are evicted first).
+class PairwiseKinshipCalculator
+{
+public:
+    PairwiseKinshipCalculator(const std::vector<int>& vertices, const std::vector<int>& first_parents,
+        const std::vector<int>& second_parents, const std::vector<int>& levels, size_t cache_size)
+        : first_parents(first_parents), second_parents(second_parents), levels(levels), cache_size(cache_size)
+    {
+        const size_t size = vertices.size();
+        if (first_parents.size() != size || second_parents.size() != size || levels.size() != size)
+        {
+            throw std::invalid_argument("The vertex, parent and level arrays must have the same length");
+        }
+        vertex_to_index.reserve(size);
+        for (size_t index = 0; index < size; ++index)
+        {
+            vertex_to_index[vertices[index]] = static_cast<int>(index);
+        }
+        for (size_t index = 0; index < size; ++index)
+        {
+            for (const int parent : {first_parents[index], second_parents[index]})
+            {
+                if (parent >= static_cast<int>(size) || (parent >= 0 && levels[parent] <= levels[index]))
+                {
+                    throw std::invalid_argument("Every parent must be a valid index with a greater level than "
+                                                "its child");
+                }
+            }
+        }
+    }
+
+    float get_kinship(int first_vertex, int second_vertex)
+    {
+        return calculate_kinship(get_index(first_vertex), get_index(second_vertex));
+    }
+
+    py::array_t<float> get_kinships(const py::array_t<int, py::array::c_style | py::array::forcecast>& first_vertices,
+        const py::array_t<int, py::array::c_style | py::array::forcecast>& second_vertices)
+    {
+        if (first_vertices.ndim() != 1 || first_vertices.shape(0) != second_vertices.size())
+        {
+            throw std::invalid_argument("The vertex arrays must be one-dimensional and have the same length");
+        }
+        const py::ssize_t size = first_vertices.shape(0);
+        std::vector<std::pair<int, int>> queries(size);
+        const int* first = first_vertices.data();
+        const int* second = second_vertices.data();
+        for (py::ssize_t index = 0; index < size; ++index)
+        {
+            queries[index] = {get_index(first[index]), get_index(second[index])};
+        }
+        // Evaluating the oldest pairs first lets the younger pairs reuse their values from the memo table
+        std::vector<py::ssize_t> order(size);
+        std::iota(order.begin(), order.end(), 0);
+        std::stable_sort(order.begin(), order.end(), [&](py::ssize_t a, py::ssize_t b)
+        {
+            return levels[queries[a].first] + levels[queries[a].second] >
+                   levels[queries[b].first] + levels[queries[b].second];
+        });
+        py::array_t<float> result(size);
+        float* buffer = result.mutable_data();
+        for (const py::ssize_t index : order)
+        {
+            buffer[index] = calculate_kinship(queries[index].first, queries[index].second);
+        }
+        return result;
+    }
+
+    // Replaces the parents of the vertex. The cached values that depend on the vertex become outdated, so they must be
+    // removed by calling clear_cache for the vertex and its descendants.
+    void set_parents(int vertex, const std::vector<int>& parents)
+    {
+        if (parents.size() > 2)
+        {
+            throw std::invalid_argument("A vertex can't have more than two parents");
+        }
+        const int index = get_index(vertex);
+        int parent_indices[2] = {-1, -1};
+        for (size_t parent_number = 0; parent_number < parents.size(); ++parent_number)
+        {
+            parent_indices[parent_number] = get_index(parents[parent_number]);
+            if (levels[parent_indices[parent_number]] <= levels[index])
+            {
+                throw std::invalid_argument("Every parent must have a greater level than its child");
+            }
+        }
+        first_parents[index] = parent_indices[0];
+        second_parents[index] = parent_indices[1];
+    }
+
+    // Removes the cached values for the pairs containing any of the given vertices (all the values by default)
+    void clear_cache(const std::optional<std::vector<int>>& vertices)
+    {
+        if (!vertices)
+        {
+            memo_order.clear();
+            memo.clear();
+            return;
+        }
+        flat_hash_set<int> indices;
+        for (const int vertex : *vertices)
+        {
+            indices.insert(get_index(vertex));
+        }
+        for (auto it = memo_order.begin(); it != memo_order.end();)
+        {
+            const int first = static_cast<int>(it->first >> 32);
+            const int second = static_cast<int>(static_cast<uint32_t>(it->first));
+            if (indices.find(first) != indices.end() || indices.find(second) != indices.end())
+            {
+                memo.erase(it->first);
+                it = memo_order.erase(it);
+            }
+            else
+            {
+                ++it;
+            }
+        }
+    }
+
+    size_t get_cached_values_number() const
+    {
+        return memo.size();
+    }
+
+private:
+    struct Frame
+    {
+        int first;
+        int second;
+        int stage;
+        float accumulated;
+    };
+
+    int get_index(int vertex) const
+    {
+        auto it = vertex_to_index.find(vertex);
+        if (it == vertex_to_index.end())
+        {
+            throw std::out_of_range("Vertex " + std::to_string(vertex) + " is not present in the pedigree");
+        }
+        return it->second;
+    }
+
+    static uint64_t get_key(int first, int second)
+    {
+        if (first > second)
+        {
+            std::swap(first, second);
+        }
+        return (static_cast<uint64_t>(first) << 32) | static_cast<uint32_t>(second);
+    }
+
+    bool lookup(int first, int second, float& value)
+    {
+        auto it = memo.find(get_key(first, second));
+        if (it == memo.end())
+        {
+            return false;
+        }
+        memo_order.splice(memo_order.begin(), memo_order, it->second);
+        value = it->second->second;
+        return true;
+    }
+
+    void store(int first, int second, float value)
+    {
+        if (cache_size == 0)
+        {
+            return;
+        }
+        const uint64_t key = get_key(first, second);
+        if (memo.find(key) != memo.end())
+        {
+            return;
+        }
+        if (memo.size() >= cache_size)
+        {
+            memo.erase(memo_order.back().first);
+            memo_order.pop_back();
+        }
+        memo_order.emplace_front(key, value);
+        memo[key] = memo_order.begin();
+    }
+
+    Frame make_frame(int first, int second) const
+    {
+        // The younger vertex goes first, as the recursion is done on it
+        if (levels[first] > levels[second] || (levels[first] == levels[second] && first < second))
+        {
+            std::swap(first, second);
+        }
+        return {first, second, 0, 0.0f};
+    }
+
+    float calculate_kinship(int first, int second)
+    {
+        float value;
+        if (lookup(first, second, value))
+        {
+            return value;
+        }
+        // The recursion is done with an explicit stack, as deep pedigrees can overflow the call stack
+        std::vector<Frame> stack{make_frame(first, second)};
+        while (true)
+        {
+            Frame& frame = stack.back();
+            const int first_parent = first_parents[frame.first];
+            const int second_parent = second_parents[frame.first];
+            int next_first = -1;
+            int next_second = -1;
+            if (frame.first == frame.second)
+            {
+                if (frame.stage == 0 && first_parent >= 0 && second_parent >= 0)
+                {
+                    next_first = first_parent;
+                    next_second = second_parent;
+                }
+                else if (frame.stage == 0)
+                {
+                    frame.stage = 1;
+                }
+            }
+            else if (frame.stage < 2)
+            {
+                next_first = frame.stage == 0 ? first_parent : second_parent;
+                next_second = frame.second;
+                if (next_first < 0)
+                {
+                    frame.stage++;
+                    continue;
+                }
+            }
+            if (next_first >= 0)
+            {
+                frame.stage++;
+                if (lookup(next_first, next_second, value))
+                {
+                    frame.accumulated += value;
+                }
+                else
+                {
+                    stack.push_back(make_frame(next_first, next_second));
+                }
+                continue;
+            }
+            if (frame.first == frame.second)
+            {
+                value = (1.0f + frame.accumulated) / 2.0f;
+            }
+            else
+            {
+                value = frame.accumulated / 2.0f;
+            }
+            store(frame.first, frame.second, value);
+            stack.pop_back();
+            if (stack.empty())
+            {
+                return value;
+            }
+            stack.back().accumulated += value;
+        }
+    }
+
+    flat_hash_map<int, int> vertex_to_index;
+    std::vector<int> first_parents;
+    std::vector<int> second_parents;
+    std::vector<int> levels;
+    size_t cache_size;
+    std::list<std::pair<uint64_t, float>> memo_order;
+    flat_hash_map<uint64_t, std::list<std::pair<uint64_t, float>>::iterator> memo;
+};
+
+// Calculates the inbreeding coefficients using the Meuwissen and Luo (1992) algorithm. The vertices must be given in
+// topological order (every parent index is smaller than the child index), with -1 representing a missing parent.
+// For every vertex, its ancestors are traversed from the youngest to the oldest while accumulating their contributions
+// L to the vertex. Then, the inbreeding coefficient is the sum of L^2 * D over the ancestors (and the vertex itself),
+// where D is the Mendelian sampling variance of the ancestor. The memory usage is linear in the number of vertices.
+// Following Sargolzaei and Iwaisaki (2005), the ancestors are kept in one list per generation instead of a single
+// ordered list, so that every ancestor is visited in constant time.
+py::array_t<double> calculate_inbreeding_coefficients(const std::vector<int>& first_parents,
+    const std::vector<int>& second_parents)
+{
+    const size_t size = first_parents.size();
+    if (second_parents.size() != size)
+    {
+        throw std::invalid_argument("The parent arrays must have the same length");
+    }
+    // The generation of a vertex is greater than the generations of its parents
+    std::vector<int> generations(size, 0);
+    int max_generation = 0;
+    for (size_t index = 0; index < size; ++index)
+    {
+        for (const int parent : {first_parents[index], second_parents[index]})
+        {
+            if (parent >= static_cast<int>(index))
+            {
+                throw std::invalid_argument("The vertices must be sorted so that the parents precede their children");
+            }
+            if (parent >= 0)
+            {
+                generations[index] = std::max(generations[index], generations[parent] + 1);
+            }
+        }
+        max_generation = std::max(max_generation, generations[index]);
+    }
+    py::array_t<double> result(size);
+    double* inbreeding = result.mutable_data();
+    // The inbreeding coefficient of a missing parent is treated as -1, so that D = 1 for the founders
+    auto get_inbreeding = [&](int vertex) { return vertex < 0 ? -1.0 : inbreeding[vertex]; };
+    std::vector<double> mendelian_variance(size);
+    std::vector<double> contributions(size, 0.0);
+    // Full siblings have the same inbreeding coefficient, so it's calculated only once per parent pair
+    flat_hash_map<uint64_t, double> parents_to_inbreeding;
+    std::vector<std::vector<int>> ancestors_by_generation(max_generation + 1);
+    for (size_t vertex = 0; vertex < size; ++vertex)
+    {
+        const int first_parent = first_parents[vertex];
+        const int second_parent = second_parents[vertex];
+        mendelian_variance[vertex] = 0.5 - 0.25 * (get_inbreeding(first_parent) + get_inbreeding(second_parent));
+        if (first_parent < 0 || second_parent < 0)
+        {
+            inbreeding[vertex] = 0.0;
+            continue;
+        }
+        const uint64_t parents_key = (static_cast<uint64_t>(std::min(first_parent, second_parent)) << 32) |
+                                     static_cast<uint32_t>(std::max(first_parent, second_parent));
+        auto it = parents_to_inbreeding.find(parents_key);
+        if (it != parents_to_inbreeding.end())
+        {
+            inbreeding[vertex] = it->second;
+            continue;
+        }
+        double vertex_inbreeding = -1.0;
+        contributions[vertex] = 1.0;
+        ancestors_by_generation[generations[vertex]].push_back(static_cast<int>(vertex));
+        for (int generation = generations[vertex]; generation >= 0; --generation)
+        {
+            // The parents belong to the previous generations, so the current list doesn't change during the loop
+            std::vector<int>& ancestors = ancestors_by_generation[generation];
+            for (const int ancestor : ancestors)
+            {
+                for (const int parent : {first_parents[ancestor], second_parents[ancestor]})
+                {
+                    if (parent < 0)
+                    {
+                        continue;
+                    }
+                    if (contributions[parent] == 0.0)
+                    {
+                        ancestors_by_generation[generations[parent]].push_back(parent);
+                    }
+                    contributions[parent] += 0.5 * contributions[ancestor];
+                }
+                vertex_inbreeding += contributions[ancestor] * contributions[ancestor] * mendelian_variance[ancestor];
+                contributions[ancestor] = 0.0;
+            }
+            ancestors.clear();
+        }
+        inbreeding[vertex] = vertex_inbreeding;
+        parents_to_inbreeding[parents_key] = vertex_inbreeding;
+    }
+    return result;
+}
+
+PYBIND11_MODULE(kinship, m)
+{
+    bind_kinship_matrix<TimeSparseMatrix>(m, "TimeSparseMatrix");
+    bind_kinship_matrix<MemorySparseMatrix>(m, "MemorySparseMatrix");
+    bind_kinship_matrix<Compact16SparseMatrix>(m, "Compact16SparseMatrix");
+    bind_kinship_matrix<Compact32SparseMatrix>(m, "Compact32SparseMatrix");
+    py::class_<PairwiseKinshipCalculator>(m, "PairwiseKinshipCalculator")
+        .def(py::init<const std::vector<int>&, const std::vector<int>&, const std::vector<int>&,
+                      const std::vector<int>&, size_t>(),
+             py::arg("vertices"), py::arg("first_parents"), py::arg("second_parents"), py::arg("levels"),
+             py::arg("cache_size"))
+        .def("get_kinship", &PairwiseKinshipCalculator::get_kinship,
+             "Get the kinship for two vertices", py::arg("key1"), py::arg("key2"))
+        .def("get_kinships", &PairwiseKinshipCalculator::get_kinships,
+             "Get the kinships for the pairs given by two NumPy arrays of the same length",
+             py::arg("ids1"), py::arg("ids2"))
+        .def("set_parents", &PairwiseKinshipCalculator::set_parents, "Replace the parents of the vertex",
+             py::arg("vertex"), py::arg("parents"))
+        .def("clear_cache", &PairwiseKinshipCalculator::clear_cache,
+             "Remove the cached values for the pairs containing the given vertices (the whole memo table by default)",
+             py::arg("vertices") = py::none())
+        .def("get_cached_values_number", &PairwiseKinshipCalculator::get_cached_values_number,
+             "Get the number of values stored in the memo table");
+    m.def("calculate_inbreeding_coefficients", &calculate_inbreeding_coefficients,
+          "Calculate the inbreeding coefficients for the vertices sorted in topological order",
+          py::arg("first_parents"), py::arg("second_parents"));
     m.def("calculate_kinship_sparse_speed", &calculate_kinship_sparse_speed,
           "Calculate kinship sparse matrix (running time preference)",
-          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"));
+          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"),
+          py::arg("ordering") = "additional_space", py::arg("vertex_order") = py::none(),
+          py::arg("checkpoint_path") = py::none(), py::arg("checkpoint_interval") = 3600.0,
+          py::arg("column_vertices") = py::none(), py::arg("drop_threshold") = 0.0f,
+          py::arg("frontier_vertices") = py::none(), py::arg("frontier_kinships") = py::none(),
+          py::arg("hemizygous_vertices") = py::none());
     m.def("calculate_kinship_sparse_memory", &calculate_kinship_sparse_memory,
           "Calculate kinship sparse matrix (memory preference)",
-          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"));
+          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"),
+          py::arg("ordering") = "additional_space", py::arg("vertex_order") = py::none(),
+          py::arg("checkpoint_path") = py::none(), py::arg("checkpoint_interval") = 3600.0,
+          py::arg("column_vertices") = py::none(), py::arg("frontier_vertices") = py::none(),
+          py::arg("frontier_kinships") = py::none(), py::arg("hemizygous_vertices") = py::none());
+    m.def("plan_kinship_sparse", &plan_kinship_sparse,
+          "Replay the sparse kinship calculation without calculating the values and return the peak frontier size, "
+          "the number of pair updates, the number of processed vertices and the estimated peak memory usage of "
+          "every storage in bytes",
+          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"),
+          py::arg("ordering") = "additional_space", py::arg("vertex_order") = py::none(),
+          py::arg("column_vertices") = py::none());
+    m.def("calculate_kinship_sparse_compact16", &calculate_kinship_sparse_compact16,
+          "Calculate kinship sparse matrix storing the values as 16-bit fixed-point numbers",
+          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"),
+          py::arg("ordering") = "additional_space", py::arg("vertex_order") = py::none(),
+          py::arg("checkpoint_path") = py::none(), py::arg("checkpoint_interval") = 3600.0,
+          py::arg("column_vertices") = py::none(), py::arg("hemizygous_vertices") = py::none());
+    m.def("calculate_kinship_sparse_compact32", &calculate_kinship_sparse_compact32,
+          "Calculate kinship sparse matrix storing the values as 32-bit fixed-point numbers",
+          py::arg("children"), py::arg("parents"), py::arg("sink_vertices"),
+          py::arg("ordering") = "additional_space", py::arg("vertex_order") = py::none(),
+          py::arg("checkpoint_path") = py::none(), py::arg("checkpoint_interval") = 3600.0,
+          py::arg("column_vertices") = py::none(), py::arg("hemizygous_vertices") = py::none());
+    m.def("calculate_group_kinship_sums", &calculate_group_kinship_sums_for_storage,
+          "Calculate the sums of the kinships between the groups of probands without retaining the probands and "
+          "return the sums over the pairs of different probands, the sums of the self-kinships and the peak "
+          "frontier size",
+          py::arg("children"), py::arg("parents"), py::arg("proband_groups"), py::arg("groups_number"),
+          py::arg("storage") = "speed", py::arg("ordering") = "additional_space",
+          py::arg("vertex_order") = py::none(), py::arg("checkpoint_path") = py::none(),
+          py::arg("checkpoint_interval") = 3600.0);
 }
@@ -0,0 +1,172 @@
+from __future__ import annotations
+
+import itertools
+from typing import Iterable
+
+import numpy as np
+
+from lineagekit import kinship
+from lineagekit.core.abstract_pedigree import AbstractPedigree, KinshipMode, KinshipOrdering
+
+
+class KinshipFrontierCache:
+    """
+    Keeps the kinships of the ancestral frontier at a cut level of the pedigree, so that the kinship matrices of many
+    different proband sets only recalculate the generations below the cut.
+
+    The vertices whose level (the length of the longest path to a sink vertex) is at least the cut level form
+    the upper part of the pedigree. The parents of an upper vertex are upper vertices as well, so the kinships of
+    the lower vertices only depend on the lower part of the pedigree and on the kinships between the frontier vertices:
+    the upper vertices that have a child in the lower part. The frontier kinships are calculated once (on the first
+    use), and every calculation for a proband set processes the lower part of the probands' ascending genealogy, where
+    the frontier vertices are founders whose kinships are taken from the cache.
+
+    The cache doesn't track the changes of the pedigree. After the pedigree has been modified, :meth:`invalidate`
+    must be called, and the frontier is recalculated on the next use.
+
+    Example:
+        >>> frontier_cache = KinshipFrontierCache(pedigree, cut_level=5)
+        >>> first_matrix = frontier_cache.calculate_probands_kinship(probands=first_probands)
+        >>> second_matrix = frontier_cache.calculate_probands_kinship(probands=second_probands)
+        >>> pedigree.remove_edge(parent, child)
+        >>> frontier_cache.invalidate()
+    """
+
+    def __init__(self, pedigree: AbstractPedigree, cut_level: int, mode: KinshipMode = KinshipMode.SPEED,
+                 ordering: KinshipOrdering = KinshipOrdering.ADDITIONAL_SPACE):
+        """
+        Args:
+            pedigree (AbstractPedigree): The pedigree.
+            cut_level (int): The level of the cut. The kinships between the vertices with the greater or equal levels
+                             that have a child below the cut are cached.
+            mode (KinshipMode): The running mode of the frontier kinship calculation. Only the SPEED and
+                                the MEMORY modes are supported, as they store the exact values.
+            ordering (KinshipOrdering): The order in which the vertices of the upper part are processed
+                                        (as in :meth:`AbstractPedigree.calculate_probands_kinship`).
+
+        Raises:
+            ValueError: If the cut level is not positive or the mode is not supported.
+        """
+        if cut_level < 1:
+            raise ValueError("The cut level must be positive")
+        if mode not in (KinshipMode.SPEED, KinshipMode.MEMORY):
+            raise ValueError(f"The frontier kinships can't be cached in the {mode.name} mode")
+        self._pedigree = pedigree
+        self._cut_level = cut_level
+        self._mode = mode
+        self._ordering = ordering
+        self._upper_vertices: set[int] | None = None
+        self._frontier: set[int] | None = None
+        self._frontier_matrix = None
+
+    def get_cut_level(self) -> int:
+        """
+        Returns:
+            The level of the cut.
+        """
+        return self._cut_level
+
+    def get_frontier(self) -> np.ndarray:
+        """
+        Returns:
+            The sorted frontier vertices. The frontier is calculated if the cache is not valid.
+        """
+        self._update()
+        return np.array(sorted(self._frontier), dtype=np.int64)
+
+    def is_valid(self) -> bool:
+        """
+        Returns:
+            Whether the frontier kinships have been calculated and not invalidated since.
+        """
+        return self._frontier is not None
+
+    def invalidate(self):
+        """
+        Removes the cached frontier kinships. Must be called after the pedigree has been modified.
+        """
+        self._upper_vertices = None
+        self._frontier = None
+        self._frontier_matrix = None
+
+    def calculate_probands_kinship(self, probands: Iterable[int] = None, mode: KinshipMode = KinshipMode.SPEED,
+                                   prune: bool = True, ordering: KinshipOrdering = KinshipOrdering.ADDITIONAL_SPACE,
+                                   vertex_order: Iterable[int] = None):
+        """
+        Calculates the kinship matrix for the probands starting from the cached frontier kinships. The result is
+        the same as the result of :meth:`AbstractPedigree.calculate_probands_kinship`.
+
+        Args:
+            probands (Iterable[int]): The probands. If not specified, the sink vertices are used. The probands must
+                                      be below the cut or belong to the frontier.
+            mode (KinshipMode): The running mode of the calculation. Only the SPEED and the MEMORY modes are
+                                supported.
+            prune (bool): Specifies whether the genealogy below the cut should be pruned
+                          (as in :meth:`AbstractPedigree.calculate_probands_kinship`).
+            ordering (KinshipOrdering): The order in which the vertices are processed
+                                        (as in :meth:`AbstractPedigree.calculate_probands_kinship`).
+            vertex_order (Iterable[int]): The explicit order in which the vertices are processed. The order must
+                                          contain all the vertices of the genealogy below the cut and the frontier
+                                          vertices it reaches.
+
+        Returns:
+            The kinship matrix for the probands.
+
+        Raises:
+            ValueError: If a proband is above the cut and doesn't belong to the frontier, or if the mode is not
+                        supported.
+        """
+        if mode == KinshipMode.SPEED:
+            calculate_kinship_sparse = kinship.calculate_kinship_sparse_speed
+        elif mode == KinshipMode.MEMORY:
+            calculate_kinship_sparse = kinship.calculate_kinship_sparse_memory
+        else:
+            raise ValueError(f"The calculation from the frontier is not supported in the {mode.name} mode")
+        self._update()
+        pedigree = self._pedigree
+        probands = frozenset(pedigree.get_sink_vertices() if probands is None else probands)
+        for proband in probands:
+            if proband in self._upper_vertices and proband not in self._frontier:
+                raise ValueError(f"Proband {proband} is above the cut level {self._cut_level} and doesn't belong "
+                                 f"to the frontier")
+        # The ascending genealogy is traversed up to the frontier, whose vertices become founders
+        genealogy = set(probands)
+        stack = [x for x in probands if x not in self._frontier]
+        while stack:
+            vertex = stack.pop()
+            for parent in pedigree.get_parents(vertex):
+                if parent not in genealogy:
+                    genealogy.add(parent)
+                    if parent not in self._frontier:
+                        stack.append(parent)
+        parents_map = {x: [] if x in self._frontier else list(pedigree.get_parents(x)) for x in genealogy}
+        children_map = {x: list(genealogy.intersection(pedigree.get_children(x))) for x in genealogy}
+        frontier_vertices = sorted(self._frontier.intersection(genealogy))
+        if prune:
+            # The frontier vertices are related to each other, so they are kept like the probands
+            AbstractPedigree._prune_kinship_genealogy(children_map=children_map, parents_map=parents_map,
+                                                      probands=probands.union(frontier_vertices))
+        frontier_kinships = np.empty(0, dtype=np.float32)
+        if frontier_vertices:
+            _, frontier_kinships = self._frontier_matrix.to_packed(vertices=frontier_vertices)
+        return calculate_kinship_sparse(
+            sink_vertices=set(probands), children=children_map, parents=parents_map,
+            **AbstractPedigree._get_ordering_arguments(ordering=ordering, vertex_order=vertex_order),
+            frontier_vertices=frontier_vertices, frontier_kinships=frontier_kinships
+        )
+
+    def _update(self):
+        """
+        Calculates the frontier and its kinships if the cache is not valid.
+        """
+        if self.is_valid():
+            return
+        pedigree = self._pedigree
+        upper_vertices = set(itertools.chain.from_iterable(pedigree.get_levels()[self._cut_level:]))
+        frontier = {x for x in upper_vertices
+                    if any(child not in upper_vertices for child in pedigree.get_children(x))}
+        if frontier:
+            self._frontier_matrix = pedigree.calculate_probands_kinship(probands=set(frontier), mode=self._mode,
+                                                                        ordering=self._ordering)
+        self._upper_vertices = upper_vertices
+        self._frontier = frontier
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+import numpy as np
+
+_KINSHIP_FILE_MAGIC = b"LKKINSHP"
+_KINSHIP_FILE_VERSION = 1
+_HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", "<u4"), ("drop_threshold", "<f4"), ("vertices_number", "<u8"),
+                          ("pairs_number", "<u8"), ("peak_frontier_size", "<u8"), ("error_bound", "<f8")])
+_RECORD_DTYPE = np.dtype([("column", "<i4"), ("kinship", "<f4")])
+
+
+class MappedKinshipMatrix:
+    """
+    Gives a read-only access to a kinship matrix saved by the save method of the kinship matrices without loading it
+    into the memory. The file is memory-mapped, and every query is answered by two binary searches: over the sorted
+    vertex ids and over the sorted records of the smaller vertex's row. Only the pages touched by the queries are read,
+    so the matrix can be shared between the processes and queried even if it doesn't fit into the memory.
+
+    Example:
+        >>> kinship_matrix = pedigree.calculate_probands_kinship()
+        >>> kinship_matrix.save("kinships.bin")
+        >>> mapped_matrix = MappedKinshipMatrix("kinships.bin")
+        >>> probands_kinship = mapped_matrix.get_kinship(proband, other_proband)
+    """
+
+    def __init__(self, filepath: str):
+        """
+        Memory-maps the saved kinship matrix.
+
+        Args:
+            filepath (str): The path to the file created by the save method of a kinship matrix.
+
+        Raises:
+            ValueError: If the file is not a saved kinship matrix.
+        """
+        header = np.fromfile(filepath, dtype=_HEADER_DTYPE, count=1)
+        if len(header) != 1 or header["magic"][0] != _KINSHIP_FILE_MAGIC:
+            raise ValueError(f"The file {filepath} is not a saved kinship matrix")
+        if header["version"][0] != _KINSHIP_FILE_VERSION:
+            raise ValueError(f"Unsupported kinship matrix format version {header['version'][0]}")
+        vertices_number = int(header["vertices_number"][0])
+        pairs_number = int(header["pairs_number"][0])
+        self._peak_frontier_size = int(header["peak_frontier_size"][0])
+        self._error_bound = float(header["error_bound"][0])
+        self._drop_threshold = float(header["drop_threshold"][0])
+        offset = _HEADER_DTYPE.itemsize
+        self._vertices = np.memmap(filepath, dtype="<i4", mode="r", offset=offset, shape=(vertices_number,))
+        # The vertex ids are padded to a multiple of 8 bytes
+        offset += (vertices_number + vertices_number % 2) * 4
+        self._records = np.memmap(filepath, dtype=_RECORD_DTYPE, mode="r", offset=offset, shape=(pairs_number,))
+        offset += pairs_number * _RECORD_DTYPE.itemsize
+        self._offsets = np.memmap(filepath, dtype="<i8", mode="r", offset=offset, shape=(vertices_number + 1,))
+
+    def get_vertices(self) -> np.ndarray:
+        """
+        Returns:
+            The sorted ids of the vertices stored in the matrix.
+        """
+        return np.asarray(self._vertices)
+
+    def get_peak_frontier_size(self) -> int:
+        """
+        Returns:
+            The peak number of vertices stored in the matrix during the calculation.
+        """
+        return self._peak_frontier_size
+
+    def get_error_bound(self) -> float:
+        """
+        Returns:
+            The upper bound on the absolute error of the stored kinships caused by the value encoding or
+            the dropped entries.
+        """
+        return self._error_bound
+
+    def get_drop_threshold(self) -> float:
+        """
+        Returns:
+            The threshold below which the kinships have not been stored. The missing pairs of the stored vertices
+            are zeros if the threshold is positive.
+        """
+        return self._drop_threshold
+
+    def get_kinship(self, key1: int, key2: int) -> float:
+        """
+        Returns:
+            The kinship coefficient between the two vertices.
+
+        Raises:
+            IndexError: If the pair is not present in the matrix.
+        """
+        return float(self.get_kinships(np.array([key1]), np.array([key2]))[0])
+
+    def get_kinships(self, ids1: Iterable[int], ids2: Iterable[int]) -> np.ndarray:
+        """
+        Returns:
+            The numpy array with the kinship coefficients for the pairs given by the two arrays of vertex ids.
+
+        Raises:
+            IndexError: If any of the pairs is not present in the matrix.
+        """
+        ids1 = np.asarray(ids1, dtype=np.int64)
+        ids2 = np.asarray(ids2, dtype=np.int64)
+        if ids1.shape != ids2.shape:
+            raise ValueError("The arrays of vertex ids must have the same length")
+        rows = np.minimum(ids1, ids2)
+        columns = np.maximum(ids1, ids2)
+        row_positions = np.searchsorted(self._vertices, rows)
+        found = row_positions < len(self._vertices)
+        found[found] = self._vertices[row_positions[found]] == rows[found]
+        if not found.all():
+            raise IndexError(f"Vertex {rows[~found][0]} is not present in the matrix")
+        if self._drop_threshold > 0:
+            column_positions = np.searchsorted(self._vertices, columns)
+            found = column_positions < len(self._vertices)
+            found[found] = self._vertices[column_positions[found]] == columns[found]
+            if not found.all():
+                raise IndexError(f"Vertex {columns[~found][0]} is not present in the matrix")
+        # Binary search over the records of every row at once
+        low = self._offsets[row_positions]
+        high = self._offsets[row_positions + 1]
+        record_columns = self._records["column"]
+        while True:
+            active = low < high
+            if not active.any():
+                break
+            middle = (low + high) // 2
+            is_less = np.zeros(len(rows), dtype=bool)
+            is_less[active] = record_columns[middle[active]] < columns[active]
+            low = np.where(active & is_less, middle + 1, low)
+            high = np.where(active & ~is_less, middle, high)
+        found = low < self._offsets[row_positions + 1]
+        found[found] = record_columns[low[found]] == columns[found]
+        if self._drop_threshold > 0:
+            # The dropped pairs are zeros
+            kinships = np.zeros(len(rows), dtype=np.float32)
+            kinships[found] = self._records["kinship"][low[found]]
+            return kinships
+        if not found.all():
+            raise IndexError(f"The pair ({rows[~found][0]}, {columns[~found][0]}) is not present in the matrix")
+        return np.asarray(self._records["kinship"][low], dtype=np.float32)
@@ -20,7 +20,7 @@ class Pedigree(AbstractPedigree):
     @staticmethod
     def get_pedigree_graph_from_file(filepath: str, probands: Iterable[int] = None,
                                      missing_parent_notation=None, separation_symbol=' ',
-                                     skip_first_line: bool = False) -> Pedigree:
+                                     skip_first_line: bool = False, sex_column: int = None) -> Pedigree:
         """
         Processes the input graph and builds the corresponding pedigree. There is one vertex
         for an individual in the input file.
@@ -35,6 +35,9 @@ class Pedigree(AbstractPedigree):
             separation_symbol (str): The symbol used to separate the values in a line. By default, a space is used.
             skip_first_line (bool): Specifies whether the first line in the file should be skipped. Can be useful if the
                                     header does not start with a '#' symbol.
+            sex_column (int): Optional parameter. The index of the metadata column containing the sexes of
+                              the individuals (1, M or male for a male and 2, F or female for a female). The sexes are
+                              used for the X chromosome kinship calculation.
         """
         gen_graph = AbstractPedigree.get_graph_from_file(filepath=filepath,
                                                          probands=probands,
@@ -44,6 +47,9 @@ class Pedigree(AbstractPedigree):
                                                          skip_first_line=skip_first_line)
         result = Pedigree()
         result.update(gen_graph)
+        if sex_column is not None:
+            result._read_sexes_from_file(filepath=filepath, sex_column=sex_column,
+                                         separation_symbol=separation_symbol, skip_first_line=skip_first_line)
         return result
 
     def get_vertex_spouses(self, vertex: int):
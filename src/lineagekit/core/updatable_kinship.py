@@ -0,0 +1,170 @@
+from __future__ import annotations
+
+from typing import Iterable
+
+import numpy as np
+
+from lineagekit.core.abstract_pedigree import AbstractPedigree, KinshipMode
+
+
+class UpdatableKinship:
+    """
+    Keeps the kinship coefficients between the probands up to date while the errors produced by
+    :meth:`AbstractPedigree.introduce_and_record_errors` are applied to the pedigree and reversed.
+
+    An error only changes the parents of one vertex, so only the kinships of this vertex's descendants change.
+    Instead of recalculating the whole kinship matrix, the kinship rows of the affected probands are recalculated
+    on demand by a :class:`PairwiseKinshipCalculator`, which keeps the values that don't depend on the changed vertices
+    in its memo table between the updates. If the errors affect a large part of the probands, recalculating the whole
+    kinship matrix is faster, so the matrix is recalculated instead.
+    The recalculated rows (or matrices) are kept in a stack of layers above the initial kinship matrix (one layer per
+    :meth:`apply_errors` call), so that the errors are reversed without any recalculation. The kinship of a pair is
+    taken from the newest layer containing any of its vertices.
+
+    Example:
+        >>> updatable_kinship = UpdatableKinship(pedigree)
+        >>> errors = pedigree.introduce_and_record_errors(error_rate=0.01, apply_errors=False)
+        >>> updatable_kinship.apply_errors(errors)
+        >>> kinship_with_errors = updatable_kinship.get_kinship(proband, other_proband)
+        >>> updatable_kinship.reverse_errors()
+    """
+
+    def __init__(self, pedigree: AbstractPedigree, probands: Iterable[int] = None,
+                 mode: KinshipMode = KinshipMode.SPEED, cache_size: int = 10_000_000,
+                 recalculation_threshold: float = 0.1):
+        """
+        Calculates the initial kinship matrix for the probands.
+
+        Args:
+            pedigree (AbstractPedigree): The pedigree. The errors must be applied and reversed through this object
+                                         rather than directly on the pedigree.
+            probands (Iterable[int]): The vertices for which the kinship coefficients are kept. If not specified,
+                                      the sink vertices are used.
+            mode (KinshipMode): The running mode of the kinship matrix calculations.
+            cache_size (int): The maximum number of intermediate values kept by the pairwise kinship calculator.
+            recalculation_threshold (float): If the fraction of the probands affected by the applied errors is
+                                             greater than this value, the whole kinship matrix is recalculated
+                                             instead of the affected rows.
+        """
+        if probands is None:
+            probands = pedigree.get_sink_vertices()
+        self._pedigree = pedigree
+        self._probands = np.array(sorted(probands), dtype=np.int32)
+        self._proband_to_index = {proband: index for index, proband in enumerate(self._probands.tolist())}
+        self._mode = mode
+        self._kinship_matrix = pedigree.calculate_probands_kinship(probands=set(self._proband_to_index), mode=mode)
+        self._cache_size = cache_size
+        self._recalculation_threshold = recalculation_threshold
+        self._calculator = pedigree.get_pairwise_kinship_calculator(cache_size=cache_size)
+        # Every layer contains the applied errors, the sorted affected probands and their recalculated rows.
+        # If the whole matrix has been recalculated, the rows are replaced by the kinship matrix
+        self._layers: list[tuple[list, np.ndarray, object]] = []
+
+    def apply_errors(self, errors):
+        """
+        Applies the errors to the pedigree and recalculates the kinship rows of the affected probands
+        (or the whole kinship matrix if the number of the affected probands exceeds the recalculation threshold).
+
+        Args:
+            errors: The errors in the format returned by :meth:`AbstractPedigree.introduce_and_record_errors`.
+        """
+        self._pedigree.apply_errors(errors)
+        affected_vertices = self._update_parents(errors)
+        affected_probands = np.array([x for x in self._proband_to_index if x in affected_vertices], dtype=np.int32)
+        probands_number = len(self._probands)
+        if len(affected_probands) > self._recalculation_threshold * probands_number:
+            kinship_matrix = self._pedigree.calculate_probands_kinship(probands=set(self._proband_to_index),
+                                                                       mode=self._mode)
+            self._layers.append((errors, self._probands, kinship_matrix))
+            return
+        first_vertices = np.repeat(affected_probands, probands_number)
+        second_vertices = np.tile(self._probands, len(affected_probands))
+        kinships = self._calculator.get_kinships(first_vertices, second_vertices)
+        self._layers.append((errors, affected_probands, kinships.reshape(len(affected_probands), probands_number)))
+
+    def reverse_errors(self):
+        """
+        Reverses the last applied errors in the pedigree and restores the previous kinship values.
+
+        Returns:
+            The reversed errors.
+
+        Raises:
+            ValueError: If there are no applied errors.
+        """
+        if not self._layers:
+            raise ValueError("There are no applied errors to reverse")
+        errors, _, _ = self._layers.pop()
+        self._pedigree.reverse_errors(errors)
+        self._update_parents(errors)
+        return errors
+
+    def get_kinship(self, first_vertex: int, second_vertex: int) -> float:
+        """
+        Returns:
+            The kinship coefficient between the two probands in the current state of the pedigree.
+        """
+        for _, layer_probands, layer_rows in reversed(self._layers):
+            if not isinstance(layer_rows, np.ndarray):
+                return layer_rows.get_kinship(first_vertex, second_vertex)
+            for row_vertex, column_vertex in ((first_vertex, second_vertex), (second_vertex, first_vertex)):
+                position = np.searchsorted(layer_probands, row_vertex)
+                if position < len(layer_probands) and layer_probands[position] == row_vertex:
+                    return float(layer_rows[position, self._proband_to_index[column_vertex]])
+        return self._kinship_matrix.get_kinship(first_vertex, second_vertex)
+
+    def get_kinships(self, first_vertices: Iterable[int], second_vertices: Iterable[int]) -> np.ndarray:
+        """
+        Returns:
+            The numpy array with the kinship coefficients for the pairs given by the two lists of probands in
+            the current state of the pedigree.
+        """
+        first_vertices = np.asarray(list(first_vertices), dtype=np.int32)
+        second_vertices = np.asarray(list(second_vertices), dtype=np.int32)
+        # Starting from the newest recalculated matrix, the newer layers overwrite the values taken from the older ones
+        first_layer = 0
+        kinship_matrix = self._kinship_matrix
+        for index, (_, _, layer_rows) in enumerate(self._layers):
+            if not isinstance(layer_rows, np.ndarray):
+                first_layer = index + 1
+                kinship_matrix = layer_rows
+        kinships = kinship_matrix.get_kinships(first_vertices, second_vertices)
+        for _, layer_probands, layer_rows in self._layers[first_layer:]:
+            if not len(layer_probands):
+                continue
+            for row_vertices, column_vertices in ((first_vertices, second_vertices), (second_vertices, first_vertices)):
+                positions = np.minimum(np.searchsorted(layer_probands, row_vertices), len(layer_probands) - 1)
+                in_layer = layer_probands[positions] == row_vertices
+                column_positions = np.searchsorted(self._probands, column_vertices[in_layer])
+                kinships[in_layer] = layer_rows[positions[in_layer], column_positions]
+        return kinships
+
+    def get_updated_probands(self) -> set[int]:
+        """
+        Returns:
+            The probands whose kinship rows differ from the initial kinship matrix because of the applied errors.
+        """
+        return {proband for _, layer_probands, _ in self._layers for proband in layer_probands.tolist()}
+
+    def _update_parents(self, errors) -> set[int]:
+        """
+        Passes the new parents of the changed vertices to the pairwise calculator and removes the outdated values
+        from its memo table.
+
+        Returns:
+            The changed vertices together with their descendants.
+        """
+        changed_vertices = {vertex for vertex, _, _ in errors}
+        affected_vertices = set()
+        for vertex in changed_vertices:
+            affected_vertices.update(self._pedigree.get_descendants_for_vertex(vertex, include_self=True))
+        try:
+            for vertex in changed_vertices:
+                self._calculator.set_parents(vertex, self._pedigree.get_parents(vertex))
+        except ValueError:
+            # The new parent doesn't have a greater level than the child in the initial pedigree,
+            # so the calculator needs to be rebuilt with the updated levels
+            self._calculator = self._pedigree.get_pairwise_kinship_calculator(cache_size=self._cache_size)
+            return affected_vertices
+        self._calculator.clear_cache(vertices=list(affected_vertices))
+        return affected_vertices
@@ -1,5 +1,3 @@
-import csv
-
 from lineagekit.core.pedigree import Pedigree
 from lineagekit.utility.utility import *
 import time
@@ -9,21 +7,15 @@ filepath = get_file_path("Specify the path to the pedigree:")
 pedigree = Pedigree.get_pedigree_graph_from_file(filepath=filepath, separation_symbol=" ",
                                                  missing_parent_notation=["-1"], skip_first_line=True)
 founders = set(pedigree.get_top_level_vertices())
-founders_and_probands = founders.union(pedigree.get_sink_vertices())
+probands = set(pedigree.get_sink_vertices())
 start_time = time.time()
-kinship_matrix_c = pedigree.calculate_probands_kinship(probands=founders_and_probands)
+# Only the founder-proband kinships are calculated
+kinship_matrix_c = pedigree.calculate_probands_kinship(probands=founders, column_probands=probands)
 end_time = time.time()
 elapsed_time = end_time - start_time
 print(f"Function took {elapsed_time:.4f} seconds to execute.")
 
 cartegene_filename = 'cartegene_probands_and_top_level_vertices_kinships.csv'
-with open(cartegene_filename, mode='w', newline='') as file:
-    writer = csv.writer(file)
-    writer.writerow(['Proband_1_id', 'Proband_2_id', 'Kinship'])
-    for proband in founders_and_probands:
-        for other_proband in founders_and_probands:
-            if proband >= other_proband:
-                continue
-            proband_kinship = kinship_matrix_c.get_kinship(proband, other_proband)
-            writer.writerow([proband, other_proband, proband_kinship])
+kinship_matrix_c.write_pairs(cartegene_filename, vertices=list(founders),
+                             column_names=['Founder_id', 'Proband_id', 'Kinship'])
 print("Kinships have been calculated")
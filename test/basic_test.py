@@ -222,6 +222,17 @@ def test_ascending_genealogy_reduction(simple_1_haploid):
     assert set(graph.nodes()) == {1, 6, 7, 10, 11}
 
 
+def test_ancestors_within_generations(simple_1_haploid):
+    graph = simple_1_haploid
+    assert graph.get_ancestors_within_generations(1, generations=0) == {1}
+    assert graph.get_ancestors_within_generations(1, generations=1) == {1, 6, 7}
+    assert graph.get_ancestors_within_generations(1, generations=2) == {1, 6, 7, 10, 11}
+    assert graph.get_ancestors_within_generations(1, generations=5, include_self=False) == {6, 7, 10, 11}
+    assert graph.get_ascending_vertices_from_probands([1], generations=1) == {1, 6, 7}
+    assert graph.get_ascending_vertices_from_probands([1, 3], generations=5) == \
+           graph.get_ascending_vertices_from_probands([1, 3])
+
+
 def test_ascending_genealogy_parsing(simple_1_haploid, simple_1_haploid_ascending,
                                      parse_simple_1_haploid_ascending_proband):
     graph_reduced = simple_1_haploid_ascending
@@ -19,3 +19,47 @@ def test_contribution_factor_calculation(test_pedigree):
     for founder in founders:
         founder_factor = pedigree.calculate_vertex_contribution_factor(founder)
         assert numpy.isclose(founder_factor, founders_contribution_factors[founder])
+
+
+def test_batch_contribution_factors(test_pedigree):
+    pedigree = Pedigree.get_pedigree_graph_from_file(filepath=test_pedigree, separation_symbol=" ",
+                                                     missing_parent_notation=["-1"], skip_first_line=True)
+    vertices = list(pedigree)[::5]
+    contribution_factors = pedigree.calculate_contribution_factors(vertices)
+    assert numpy.allclose(pedigree.calculate_vertices_contribution_factors(vertices),
+                          [contribution_factors[vertex] for vertex in vertices])
+    # The sink vertex 3 is both a child and a grandchild of 1
+    pedigree = Pedigree()
+    pedigree.add_edges_from([(1, 2), (1, 3), (2, 3)])
+    assert numpy.allclose(pedigree.calculate_vertices_contribution_factors([1, 2, 3]), [0.75, 0.5, 1])
+    # A lineage deeper than the recursion limit, where every vertex also has a child without descendants
+    pedigree = Pedigree()
+    pedigree.add_edges_from((vertex, vertex + 2) for vertex in range(0, 3000, 2))
+    pedigree.add_edges_from((vertex, vertex + 1) for vertex in range(0, 3000, 2))
+    assert numpy.allclose(pedigree.calculate_vertices_contribution_factors(range(0, 3000, 2)), 1)
+
+
+def test_genetic_contributions(test_pedigree):
+    pedigree = Pedigree.get_pedigree_graph_from_file(filepath=test_pedigree, separation_symbol=" ",
+                                                     missing_parent_notation=["-1"], skip_first_line=True)
+    founders, probands, contributions = pedigree.calculate_genetic_contributions(block_size=300)
+    assert contributions.shape == (len(founders), len(probands))
+    assert numpy.allclose(numpy.asarray(contributions.sum(axis=1)).ravel(),
+                          pedigree.calculate_vertices_contribution_factors(founders))
+    _, _, parallel_contributions = pedigree.calculate_genetic_contributions(block_size=300, processes=2)
+    assert (parallel_contributions != contributions).nnz == 0
+    founder_subset = founders[::3]
+    proband_subset = probands[::7]
+    subset_founders, subset_probands, subset_contributions = pedigree.calculate_genetic_contributions(
+        founders=founder_subset, probands=proband_subset)
+    assert numpy.array_equal(subset_founders, founder_subset)
+    assert numpy.array_equal(subset_probands, proband_subset)
+    assert numpy.allclose(subset_contributions.toarray(), contributions[::3][:, ::7].toarray())
+    # 3 is a child and a grandchild of 1, and 2 is specified as an ancestor that is not a founder
+    pedigree = Pedigree()
+    pedigree.add_edges_from([(1, 2), (1, 3), (2, 3), (2, 4), (5, 4)])
+    founders, probands, contributions = pedigree.calculate_genetic_contributions(founders=[1, 2, 5])
+    assert probands.tolist() == [3, 4]
+    assert numpy.allclose(contributions.toarray(), [[0.75, 0.25], [0.5, 0.5], [0, 0.5]])
+    with pytest.raises(ValueError):
+        pedigree.calculate_genetic_contributions(block_size=0)
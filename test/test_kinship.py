@@ -1,11 +1,21 @@
 import itertools
 
+import numpy as np
 import pytest
 import os
+import pickle
 import glob
+import gzip
+import signal
 
-from lineagekit.core.abstract_pedigree import KinshipMode
+from lineagekit.core.abstract_pedigree import KinshipChromosome, KinshipMode, KinshipOrdering, Sex
+from lineagekit.core.gene_dropping import GeneDropping
+from lineagekit.core.importance_sampling import CarrierImportanceSampling
+from lineagekit.core.kinship_frontier_cache import KinshipFrontierCache
+from lineagekit.core.mapped_kinship import MappedKinshipMatrix
 from lineagekit.core.pedigree import *
+from lineagekit.core.ploid_pedigree import PloidPedigree
+from lineagekit.core.updatable_kinship import UpdatableKinship
 
 accuracy_precision = 0.001
 
@@ -73,3 +83,713 @@ def test_kinship(parsed_pedigrees):
                     if abs(first - second) > accuracy_precision:
                         print(f"{proband} {other_proband}: {first} {second}")
                         assert False
+
+
+def test_kinship_packed_and_sparse_export(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        for mode in KinshipMode:
+            kinship_matrix = pedigree.calculate_probands_kinship(mode=mode)
+            vertices, packed = kinship_matrix.to_packed()
+            assert set(vertices) == set(pedigree.get_sink_vertices())
+            size = len(vertices)
+            assert packed.shape == (size * (size + 1) // 2,)
+            sparse_vertices, sparse_matrix = kinship_matrix.to_sparse(symmetric=True)
+            assert list(sparse_vertices) == list(vertices)
+            dense_matrix = sparse_matrix.toarray()
+            packed_index = 0
+            for i, first in enumerate(vertices):
+                for j in range(i, size):
+                    kinship_value = kinship_matrix.get_kinship(int(first), int(vertices[j]))
+                    assert abs(packed[packed_index] - kinship_value) <= accuracy_precision
+                    assert abs(dense_matrix[i, j] - kinship_value) <= accuracy_precision
+                    assert abs(dense_matrix[j, i] - kinship_value) <= accuracy_precision
+                    packed_index += 1
+            assert not (sparse_matrix.data == 0).any()
+
+
+def test_kinship_export_subset(kinship_test_2):
+    kinship_matrix = kinship_test_2.calculate_probands_kinship(probands={1, 2, 3})
+    vertices, packed = kinship_matrix.to_packed(vertices=[3, 1])
+    assert list(vertices) == [3, 1]
+    assert len(packed) == 3
+    assert abs(packed[1] - kinship_matrix.get_kinship(1, 3)) <= accuracy_precision
+    vertices, upper_triangle = kinship_matrix.to_sparse(vertices=[3, 1], sparse_format="coo", free=True)
+    assert upper_triangle.shape == (2, 2)
+    assert (upper_triangle.row <= upper_triangle.col).all()
+    with pytest.raises(IndexError):
+        kinship_matrix.get_kinship(1, 3)
+
+
+def test_kinship_batched_lookups(kinship_test_2):
+    probands = set(kinship_test_2.get_sink_vertices())
+    for mode in KinshipMode:
+        kinship_matrix = kinship_test_2.calculate_probands_kinship(probands=probands, mode=mode)
+        pairs = list(itertools.product(sorted(probands), repeat=2))
+        first_ids = np.array([first for first, _ in pairs])
+        second_ids = np.array([second for _, second in pairs])
+        kinships = kinship_matrix.get_kinships(first_ids, second_ids)
+        for (first, second), kinship_value in zip(pairs, kinships):
+            assert abs(kinship_matrix.get_kinship(first, second) - kinship_value) <= accuracy_precision
+        columns, rows = kinship_matrix.get_kinship_rows(first_ids[:2])
+        assert rows.shape == (2, len(probands))
+        for row_index, row_vertex in enumerate(first_ids[:2]):
+            for column_index, column_vertex in enumerate(columns):
+                assert abs(rows[row_index, column_index] -
+                           kinship_matrix.get_kinship(int(row_vertex), int(column_vertex))) <= accuracy_precision
+        iterated_pairs = dict()
+        for first_vertices, second_vertices, values in kinship_matrix.iter_pairs(chunk_size=3):
+            assert len(values) <= 3
+            for first, second, kinship_value in zip(first_vertices, second_vertices, values):
+                iterated_pairs[frozenset((int(first), int(second)))] = kinship_value
+        assert len(iterated_pairs) == len(probands) * (len(probands) + 1) // 2
+        for pair, kinship_value in iterated_pairs.items():
+            first, second = tuple(pair) if len(pair) == 2 else tuple(pair) * 2
+            assert abs(kinship_matrix.get_kinship(first, second) - kinship_value) <= accuracy_precision
+        with pytest.raises(IndexError):
+            kinship_matrix.get_kinships(np.array([first_ids[0]]), np.array([-1]))
+
+
+def test_kinship_pairs_writer(kinship_test_2, tmp_path):
+    probands = set(kinship_test_2.get_sink_vertices())
+    kinship_matrix = kinship_test_2.calculate_probands_kinship(probands=probands)
+    csv_path = tmp_path / "kinships.csv.gz"
+    pairs_number = kinship_matrix.write_pairs(str(csv_path))
+    assert pairs_number == len(probands) * (len(probands) - 1) // 2
+    with gzip.open(csv_path, "rt") as csv_file:
+        lines = csv_file.read().splitlines()
+    assert lines[0] == "id1,id2,kinship"
+    assert len(lines) == pairs_number + 1
+    for line in lines[1:]:
+        first, second, kinship_value = line.split(",")
+        assert int(first) < int(second)
+        assert abs(float(kinship_value) - kinship_matrix.get_kinship(int(first), int(second))) <= accuracy_precision
+    binary_path = tmp_path / "kinships.bin"
+    threshold = 0.1
+    pairs_number = kinship_matrix.write_pairs(str(binary_path), file_format="binary", threshold=threshold,
+                                              vertices=[1], include_self=True)
+    triplets = np.fromfile(binary_path, dtype=[("id1", "<i4"), ("id2", "<i4"), ("kinship", "<f4")])
+    assert len(triplets) == pairs_number
+    expected_pairs = {other for other in probands if kinship_matrix.get_kinship(1, other) >= threshold}
+    assert set(triplets["id2"]) == expected_pairs
+    assert (triplets["id1"] == 1).all()
+    separator = " <-> " * 8
+    text_path = tmp_path / "kinships.txt"
+    pairs_number = kinship_matrix.write_pairs(str(text_path), separator=separator, column_names=None)
+    with open(text_path) as text_file:
+        lines = text_file.read().splitlines()
+    assert len(lines) == pairs_number
+    for line in lines:
+        first, second, kinship_value = line.split(separator)
+        assert abs(float(kinship_value) - kinship_matrix.get_kinship(int(first), int(second))) <= accuracy_precision
+
+
+def test_compact_kinship(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        kinship_matrix = pedigree.calculate_probands_kinship()
+        for max_error in (1e-3, 1e-6):
+            compact_matrix = pedigree.calculate_probands_kinship(mode=KinshipMode.COMPACT, max_error=max_error)
+            error_bound = compact_matrix.get_error_bound()
+            assert error_bound <= max_error
+            for proband, other_proband in itertools.combinations_with_replacement(pedigree.get_sink_vertices(), 2):
+                assert (abs(compact_matrix.get_kinship(proband, other_proband) -
+                            kinship_matrix.get_kinship(proband, other_proband)) <= error_bound + 1e-6)
+        assert kinship_matrix.get_error_bound() == 0
+    with pytest.raises(ValueError):
+        next(iter(parsed_pedigrees.values())).calculate_probands_kinship(mode=KinshipMode.COMPACT, max_error=1e-12)
+
+
+def test_approximate_kinship(parsed_pedigrees, tmp_path):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        probands = sorted(pedigree.get_sink_vertices())
+        pairs = list(itertools.combinations_with_replacement(probands, 2))
+        first_ids = np.array([first for first, _ in pairs])
+        second_ids = np.array([second for _, second in pairs])
+        exact_kinships = pedigree.calculate_probands_kinship().get_kinships(first_ids, second_ids)
+        for epsilon in (1e-4, 1e-2):
+            approximate_matrix = pedigree.calculate_probands_kinship(epsilon=epsilon)
+            assert approximate_matrix.get_drop_threshold() == pytest.approx(epsilon)
+            error_bound = approximate_matrix.get_error_bound()
+            approximate_kinships = approximate_matrix.get_kinships(first_ids, second_ids)
+            assert np.all(np.abs(approximate_kinships - exact_kinships) <= error_bound + 1e-6)
+            # The dropped pairs are zeros in the saved matrices as well
+            matrix_path = tmp_path / "approximate.bin"
+            approximate_matrix.save(str(matrix_path))
+            for loaded_matrix in (type(approximate_matrix).load(str(matrix_path)),
+                                  MappedKinshipMatrix(str(matrix_path))):
+                assert loaded_matrix.get_error_bound() == pytest.approx(error_bound)
+                assert np.array_equal(loaded_matrix.get_kinships(first_ids, second_ids), approximate_kinships)
+    pedigree = next(iter(parsed_pedigrees.values()))
+    with pytest.raises(ValueError):
+        pedigree.calculate_probands_kinship(epsilon=-1)
+    with pytest.raises(ValueError):
+        pedigree.calculate_probands_kinship(mode=KinshipMode.MEMORY, epsilon=1e-3)
+
+
+def test_kinship_plan(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        plan = pedigree.plan_probands_kinship()
+        probands_number = len(pedigree.get_sink_vertices())
+        assert probands_number <= plan["peak_frontier"] <= plan["processed_vertices"]
+        assert plan["processed_vertices"] <= plan["pair_updates"]
+        memory_estimates = plan["memory_estimates"]
+        assert (memory_estimates[KinshipMode.COMPACT] < memory_estimates[KinshipMode.MEMORY] <
+                memory_estimates[KinshipMode.SPEED])
+        kinship_matrix = pedigree.calculate_probands_kinship(memory_budget=memory_estimates[KinshipMode.SPEED])
+        assert type(kinship_matrix).__name__ == "TimeSparseMatrix"
+        kinship_matrix = pedigree.calculate_probands_kinship(memory_budget=memory_estimates[KinshipMode.COMPACT])
+        assert type(kinship_matrix).__name__ == "Compact16SparseMatrix"
+        with pytest.raises(ValueError):
+            pedigree.calculate_probands_kinship(memory_budget=memory_estimates[KinshipMode.COMPACT] - 1)
+        # Only the row-column pairs are kept, so the rectangular calculation fits in a smaller budget
+        column_probands = set(sorted(pedigree.get_sink_vertices())[:2])
+        column_estimates = pedigree.plan_probands_kinship(column_probands=column_probands)["memory_estimates"]
+        assert column_estimates[KinshipMode.SPEED] < memory_estimates[KinshipMode.SPEED]
+        kinship_matrix = pedigree.calculate_probands_kinship(column_probands=column_probands,
+                                                             memory_budget=column_estimates[KinshipMode.SPEED])
+        assert type(kinship_matrix).__name__ == "TimeSparseMatrix"
+        for mode in (KinshipMode.SPEED, KinshipMode.MEMORY):
+            assert pedigree.calculate_probands_kinship(column_probands=column_probands,
+                                                       mode=mode).get_memory_usage() <= column_estimates[mode]
+        if len(pedigree) > 1000:
+            continue
+        # When all the vertices are probands, none of them is removed, and the final matrix has the peak size
+        plan = pedigree.plan_probands_kinship(probands=set(pedigree), prune=False)
+        assert plan["peak_frontier"] == len(pedigree)
+        for mode, memory_estimate in plan["memory_estimates"].items():
+            memory_usage = pedigree.calculate_probands_kinship(probands=set(pedigree), prune=False,
+                                                               mode=mode).get_memory_usage()
+            assert memory_usage <= memory_estimate <= 2 * memory_usage
+
+
+def test_kinship_ordering(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        probands = sorted(pedigree.get_sink_vertices())
+        pairs = list(itertools.combinations_with_replacement(probands, 2))
+        first_ids = np.array([first for first, _ in pairs])
+        second_ids = np.array([second for _, second in pairs])
+        expected_kinships = pedigree.calculate_probands_kinship().get_kinships(first_ids, second_ids)
+        top_down_order = [vertex for level in reversed(pedigree.get_levels()) for vertex in level]
+        orderings = [{"ordering": ordering} for ordering in KinshipOrdering] + [{"vertex_order": top_down_order}]
+        for ordering_arguments in orderings:
+            kinship_matrix = pedigree.calculate_probands_kinship(**ordering_arguments)
+            assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= \
+                   accuracy_precision
+            plan = pedigree.plan_probands_kinship(**ordering_arguments)
+            assert kinship_matrix.get_peak_frontier_size() == plan["peak_frontier"]
+        with pytest.raises(ValueError):
+            pedigree.calculate_probands_kinship(vertex_order=[x for x in top_down_order if x != probands[0]])
+
+
+def test_kinship_matrix_serialization(parsed_pedigrees, tmp_path):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        probands = sorted(pedigree.get_sink_vertices())
+        first_ids = np.repeat(probands, len(probands))
+        second_ids = np.tile(probands, len(probands))
+        for mode in KinshipMode:
+            kinship_matrix = pedigree.calculate_probands_kinship(mode=mode)
+            expected_kinships = kinship_matrix.get_kinships(first_ids, second_ids)
+            matrix_path = tmp_path / "kinships.bin"
+            kinship_matrix.save(str(matrix_path))
+            loaded_matrices = [type(kinship_matrix).load(str(matrix_path)),
+                               pickle.loads(pickle.dumps(kinship_matrix)), MappedKinshipMatrix(str(matrix_path))]
+            for loaded_matrix in loaded_matrices:
+                assert np.array_equal(loaded_matrix.get_kinships(first_ids, second_ids), expected_kinships)
+                assert loaded_matrix.get_peak_frontier_size() == kinship_matrix.get_peak_frontier_size()
+                assert loaded_matrix.get_error_bound() == pytest.approx(kinship_matrix.get_error_bound())
+    with pytest.raises(IndexError):
+        loaded_matrices[-1].get_kinship(probands[0], -1)
+
+
+def test_rectangular_kinship(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        founders = sorted(pedigree.get_top_level_vertices())
+        probands = sorted(pedigree.get_sink_vertices())
+        rows = set(founders + probands[:len(probands) // 2])
+        columns = set(probands[len(probands) // 3:])
+        square_matrix = pedigree.calculate_probands_kinship(probands=rows.union(columns))
+        first_ids = np.repeat(sorted(rows), len(columns))
+        second_ids = np.tile(sorted(columns), len(rows))
+        expected_kinships = square_matrix.get_kinships(first_ids, second_ids)
+        for mode in KinshipMode:
+            kinship_matrix = pedigree.calculate_probands_kinship(probands=rows, column_probands=columns, mode=mode)
+            for first, second in ((first_ids, second_ids), (second_ids, first_ids)):
+                assert np.abs(kinship_matrix.get_kinships(first, second) - expected_kinships).max() <= \
+                       accuracy_precision
+        # Only the row-column pairs are kept
+        kinship_matrix = pedigree.calculate_probands_kinship(probands=rows, column_probands=columns)
+        stored_pairs = sum(len(kinships) for _, _, kinships in kinship_matrix.iter_pairs())
+        assert stored_pairs == len({(min(x, y), max(x, y)) for x, y in zip(first_ids.tolist(), second_ids.tolist())})
+        if len(founders) > 1 and columns.isdisjoint(founders[:2]):
+            with pytest.raises(IndexError):
+                kinship_matrix.get_kinship(founders[0], founders[1])
+
+
+@pytest.mark.skipif(not hasattr(signal, "setitimer"), reason="Requires the interval timer signals")
+def test_kinship_checkpoint(parsed_pedigrees, tmp_path):
+    class CalculationInterrupted(Exception):
+        pass
+
+    def interrupt_calculation(signal_number, frame):
+        raise CalculationInterrupted()
+
+    pedigree = max(parsed_pedigrees.values(), key=len)
+    probands = sorted(pedigree.get_sink_vertices())
+    first_ids = np.repeat(probands, len(probands))
+    second_ids = np.tile(probands, len(probands))
+    checkpoint_path = tmp_path / "kinship.checkpoint"
+    previous_handler = signal.signal(signal.SIGALRM, interrupt_calculation)
+    try:
+        for mode in (KinshipMode.SPEED, KinshipMode.MEMORY):
+            expected_kinships = pedigree.calculate_probands_kinship(mode=mode).get_kinships(first_ids, second_ids)
+            # The interrupted calculation saves its state before raising the exception
+            signal.setitimer(signal.ITIMER_REAL, 0.2)
+            with pytest.raises(CalculationInterrupted):
+                pedigree.calculate_probands_kinship(mode=mode, checkpoint_path=checkpoint_path)
+            assert checkpoint_path.exists()
+            with pytest.raises(ValueError):
+                pedigree.calculate_probands_kinship(probands=set(probands[1:]), mode=mode,
+                                                    checkpoint_path=checkpoint_path)
+            kinship_matrix = pedigree.calculate_probands_kinship(mode=mode, checkpoint_path=checkpoint_path)
+            assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= \
+                   accuracy_precision
+            assert not checkpoint_path.exists()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def test_memory_kinship_storage(tmp_path):
+    class CalculationInterrupted(Exception):
+        pass
+
+    def interrupt_calculation(signal_number, frame):
+        raise CalculationInterrupted()
+
+    # A deep genealogy with a few probands, so that most of the vertices are removed from the matrix
+    # and the dead entries of the MEMORY mode are compacted many times
+    random.seed(7)
+    pedigree = Pedigree()
+    generation = list(range(100))
+    pedigree.add_nodes_from(generation)
+    for generation_size in [100] * 39 + [8]:
+        children = list(range(generation[-1] + 1, generation[-1] + 1 + generation_size))
+        for child in children:
+            pedigree.add_edges_from((parent, child) for parent in random.sample(generation, 2))
+        generation = children
+    probands = set(generation)
+    pairs = list(itertools.combinations_with_replacement(sorted(probands), 2))
+    first_ids = np.array([first for first, _ in pairs])
+    second_ids = np.array([second for _, second in pairs])
+    expected_kinships = pedigree.calculate_probands_kinship(probands=probands).get_kinships(first_ids, second_ids)
+    peak_memory_estimate = pedigree.plan_probands_kinship(probands=probands)["memory_estimates"][KinshipMode.MEMORY]
+    kinship_matrix = pedigree.calculate_probands_kinship(probands=probands, mode=KinshipMode.MEMORY)
+    assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= accuracy_precision
+    # Only the pairs of the probands are left after the ancestors are removed
+    assert kinship_matrix.get_memory_usage() * 10 < peak_memory_estimate
+    checkpoint_path = tmp_path / "kinship.checkpoint"
+    previous_handler = signal.signal(signal.SIGALRM, interrupt_calculation)
+    try:
+        # Saving the state after every step, so that the interrupted calculation is resumed from the middle
+        signal.setitimer(signal.ITIMER_REAL, 0.2)
+        with pytest.raises(CalculationInterrupted):
+            pedigree.calculate_probands_kinship(probands=probands, mode=KinshipMode.MEMORY,
+                                                checkpoint_path=checkpoint_path, checkpoint_interval=0)
+        assert checkpoint_path.exists()
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+    kinship_matrix = pedigree.calculate_probands_kinship(probands=probands, mode=KinshipMode.MEMORY,
+                                                         checkpoint_path=checkpoint_path)
+    assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= accuracy_precision
+    assert kinship_matrix.get_memory_usage() * 10 < peak_memory_estimate
+    matrix_path = tmp_path / "kinship.bin"
+    kinship_matrix.save(str(matrix_path))
+    loaded_matrix = type(kinship_matrix).load(str(matrix_path))
+    assert np.abs(loaded_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= accuracy_precision
+
+
+def test_group_mean_kinship(parsed_pedigrees, tmp_path):
+    random.seed(42)
+    for filepath, pedigree in parsed_pedigrees.items():
+        probands = sorted(set(pedigree.get_sink_vertices()).union(
+            random.sample(list(pedigree), min(10, len(pedigree)))))
+        proband_groups = {proband: random.choice(["first", "second", "third"]) for proband in probands}
+        labels = np.array([proband_groups[proband] for proband in probands])
+        kinships = get_dense_kinships(pedigree, probands)
+        for mode in (KinshipMode.SPEED, KinshipMode.MEMORY, KinshipMode.COMPACT):
+            for include_self in (False, True):
+                groups, mean_kinships = pedigree.calculate_group_mean_kinship(proband_groups, mode=mode,
+                                                                              include_self=include_self)
+                assert groups == sorted(set(labels))
+                for (first_index, first_group), (second_index, second_group) in itertools.product(
+                        enumerate(groups), repeat=2):
+                    block = kinships[np.ix_(labels == first_group, labels == second_group)]
+                    if first_group == second_group and not include_self:
+                        if len(block) == 1:
+                            assert np.isnan(mean_kinships[first_index, second_index])
+                            continue
+                        expected_mean = (block.sum() - np.trace(block)) / (len(block) * (len(block) - 1))
+                    else:
+                        expected_mean = block.mean()
+                    assert abs(mean_kinships[first_index, second_index] - expected_mean) <= accuracy_precision
+    # The sums of the interrupted calculation are saved in the checkpoint
+    pedigree = max(parsed_pedigrees.values(), key=len)
+    proband_groups = {proband: proband % 5 for proband in pedigree.get_sink_vertices()}
+    expected_groups, expected_mean_kinships = pedigree.calculate_group_mean_kinship(proband_groups)
+    checkpoint_path = tmp_path / "group_kinship.checkpoint"
+
+    class CalculationInterrupted(Exception):
+        pass
+
+    def interrupt_calculation(signal_number, frame):
+        raise CalculationInterrupted()
+
+    previous_handler = signal.signal(signal.SIGALRM, interrupt_calculation)
+    try:
+        # Saving the checkpoint after every vertex, so that the calculation is still running when it is interrupted
+        signal.setitimer(signal.ITIMER_REAL, 1.0)
+        with pytest.raises(CalculationInterrupted):
+            pedigree.calculate_group_mean_kinship(proband_groups, checkpoint_path=checkpoint_path,
+                                                  checkpoint_interval=0)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+    assert checkpoint_path.exists()
+    groups, mean_kinships = pedigree.calculate_group_mean_kinship(proband_groups, checkpoint_path=checkpoint_path)
+    assert groups == expected_groups
+    assert np.abs(mean_kinships - expected_mean_kinships).max() <= accuracy_precision
+
+
+def test_find_related_pairs(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        probands = np.array(sorted(pedigree.get_sink_vertices()))
+        first_indices, second_indices = np.triu_indices(len(probands), k=1)
+        kinships = pedigree.calculate_probands_kinship().get_kinships(probands[first_indices],
+                                                                      probands[second_indices])
+        # Taking all the generations into account makes the search exact
+        max_generations = len(pedigree.get_levels())
+        for threshold, batch_size in ((0.25, 1), (0.0625, 1_000_000)):
+            first_probands, second_probands, found_kinships = pedigree.find_related_pairs(
+                threshold=threshold, max_generations=max_generations, batch_size=batch_size)
+            is_related = kinships >= threshold
+            assert set(zip(first_probands.tolist(), second_probands.tolist())) == \
+                   set(zip(probands[first_indices][is_related].tolist(), probands[second_indices][is_related].tolist()))
+            assert np.all(first_probands < second_probands)
+            assert np.all(found_kinships >= threshold)
+    # The eight grandparents of 30 and 31 are full siblings, so 30 and 31 are related as much as half siblings,
+    # but their only common ancestors are three generations above them
+    pedigree = Pedigree()
+    pedigree.add_edges_from((parent, sibling) for parent in (1, 2) for sibling in range(3, 11))
+    pedigree.add_edges_from((grandparent, 20 + (grandparent - 3) // 2) for grandparent in range(3, 11))
+    pedigree.add_edges_from([(20, 30), (21, 30), (22, 31), (23, 31)])
+    first_probands, second_probands, found_kinships = pedigree.find_related_pairs(threshold=0.25, probands=[30, 31],
+                                                                                  max_generations=3)
+    assert first_probands.tolist() == [30] and second_probands.tolist() == [31]
+    assert found_kinships[0] == pytest.approx(0.25)
+    with pytest.raises(ValueError):
+        pedigree.find_related_pairs(threshold=0, max_generations=3)
+    with pytest.raises(ValueError):
+        pedigree.find_related_pairs(threshold=0.25, max_generations=-1)
+
+
+def test_generation_truncated_kinship(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        probands = sorted(pedigree.get_sink_vertices())
+        first_ids = np.repeat(probands, len(probands))
+        second_ids = np.tile(probands, len(probands))
+        full_kinships = pedigree.calculate_probands_kinship().get_kinships(first_ids, second_ids)
+        unlimited_kinships = pedigree.calculate_probands_kinship(
+            max_generations=len(pedigree.get_levels())).get_kinships(first_ids, second_ids)
+        assert np.abs(unlimited_kinships - full_kinships).max() <= accuracy_precision
+        # Without any generations, every proband is an unrelated founder
+        unrelated_kinships = pedigree.calculate_probands_kinship(max_generations=0).get_kinships(first_ids,
+                                                                                                 second_ids)
+        assert np.all(unrelated_kinships == np.where(first_ids == second_ids, 0.5, 0))
+        # The truncated calculation is the same as the calculation on the subgraph of the recent ancestors
+        truncated_pedigree = pedigree.copy()
+        truncated_pedigree.reduce_to_subgraph(pedigree.get_ascending_vertices_from_probands(probands, generations=2))
+        expected_kinships = truncated_pedigree.calculate_probands_kinship(probands=set(probands)).get_kinships(
+            first_ids, second_ids)
+        truncated_kinships = pedigree.calculate_probands_kinship(max_generations=2).get_kinships(first_ids,
+                                                                                                 second_ids)
+        assert np.abs(truncated_kinships - expected_kinships).max() <= accuracy_precision
+        for mode in (KinshipMode.MEMORY, KinshipMode.COMPACT):
+            kinship_matrix = pedigree.calculate_probands_kinship(mode=mode, max_generations=2)
+            assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= \
+                   accuracy_precision
+    # The cut is shared by the probands: the half cousins 4 and 5 are unrelated within one generation,
+    # unless their grandparent 1 is traversed as the parent of another proband
+    pedigree = Pedigree()
+    pedigree.add_edges_from([(1, 2), (1, 3), (2, 4), (3, 5), (1, 6)])
+    assert pedigree.calculate_probands_kinship(probands={4, 5}, max_generations=1).get_kinship(4, 5) == 0
+    assert pedigree.calculate_probands_kinship(probands={4, 5, 6}, max_generations=1).get_kinship(4, 5) == 1 / 32
+
+
+def test_kinship_frontier_cache(parsed_pedigrees):
+    random.seed(42)
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree = pedigree.copy()
+        probands = sorted(pedigree.get_sink_vertices())
+        frontier_cache = KinshipFrontierCache(pedigree, cut_level=2)
+        assert not frontier_cache.is_valid()
+        for mode in (KinshipMode.SPEED, KinshipMode.MEMORY):
+            proband_subset = sorted(random.sample(probands, max(1, len(probands) // 2)))
+            first_ids = np.repeat(proband_subset, len(proband_subset))
+            second_ids = np.tile(proband_subset, len(proband_subset))
+            expected_kinships = pedigree.calculate_probands_kinship(probands=set(proband_subset)).get_kinships(
+                first_ids, second_ids)
+            kinship_matrix = frontier_cache.calculate_probands_kinship(probands=proband_subset, mode=mode)
+            assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= \
+                   accuracy_precision
+        assert frontier_cache.is_valid()
+        # The frontier is recalculated after the pedigree has been modified
+        child = next(x for x in pedigree if pedigree.get_parents(x))
+        pedigree.remove_edge(pedigree.get_parents(child)[0], child)
+        frontier_cache.invalidate()
+        first_ids = np.repeat(probands, len(probands))
+        second_ids = np.tile(probands, len(probands))
+        expected_kinships = pedigree.calculate_probands_kinship(probands=set(probands)).get_kinships(first_ids,
+                                                                                                    second_ids)
+        kinship_matrix = frontier_cache.calculate_probands_kinship(probands=probands)
+        assert np.abs(kinship_matrix.get_kinships(first_ids, second_ids) - expected_kinships).max() <= \
+               accuracy_precision
+    pedigree = next(iter(parsed_pedigrees.values()))
+    with pytest.raises(ValueError):
+        KinshipFrontierCache(pedigree, cut_level=0)
+    with pytest.raises(ValueError):
+        KinshipFrontierCache(pedigree, cut_level=1).calculate_probands_kinship(mode=KinshipMode.COMPACT)
+
+
+def get_dense_x_kinships(pedigree: Pedigree, probands) -> np.ndarray:
+    # The straightforward X-linked recursion: a male only inherits the X chromosome from his mother
+    vertices = [vertex for level in reversed(pedigree.get_levels()) for vertex in level]
+    vertex_to_index = {vertex: index for index, vertex in enumerate(vertices)}
+    kinships = np.zeros((len(vertices), len(vertices)))
+    for index, vertex in enumerate(vertices):
+        parent_indices = [vertex_to_index[parent] for parent in pedigree.get_parents(vertex)]
+        if pedigree.get_vertex_sex(vertex) == Sex.MALE:
+            for parent_index in parent_indices:
+                if pedigree.get_vertex_sex(vertices[parent_index]) == Sex.FEMALE:
+                    kinships[index, :index] = kinships[parent_index, :index]
+            kinships[index, index] = 1
+        else:
+            for parent_index in parent_indices:
+                kinships[index, :index] += kinships[parent_index, :index] / 2
+            parents_kinship = kinships[parent_indices[0], parent_indices[1]] if len(parent_indices) == 2 else 0
+            kinships[index, index] = (1 + parents_kinship) / 2
+        kinships[:index, index] = kinships[index, :index]
+    proband_indices = [vertex_to_index[proband] for proband in probands]
+    return kinships[np.ix_(proband_indices, proband_indices)]
+
+
+def test_x_chromosome_kinship(parsed_pedigrees, tmp_path):
+    random.seed(42)
+    for filepath, pedigree in parsed_pedigrees.items():
+        if len(pedigree) > 1000:
+            continue
+        pedigree = pedigree.copy()
+        # The test pedigrees don't separate the fathers from the mothers, so the sexes are random. A male can't
+        # have two mothers
+        for vertex in (vertex for level in reversed(pedigree.get_levels()) for vertex in level):
+            parent_sexes = [pedigree.get_vertex_sex(parent) for parent in pedigree.get_parents(vertex)]
+            sex = random.choice((Sex.MALE, Sex.FEMALE))
+            pedigree.set_vertex_sex(vertex, Sex.FEMALE if parent_sexes == [Sex.FEMALE] * 2 else sex)
+        probands = sorted(pedigree.get_sink_vertices())
+        expected_kinships = get_dense_x_kinships(pedigree, probands)
+        first_ids, second_ids = np.meshgrid(probands, probands, indexing="ij")
+        for mode in (KinshipMode.SPEED, KinshipMode.MEMORY, KinshipMode.COMPACT):
+            for prune in (True, False):
+                kinship_matrix = pedigree.calculate_probands_kinship(mode=mode, prune=prune,
+                                                                     chromosome=KinshipChromosome.X)
+                kinships = kinship_matrix.get_kinships(first_ids.ravel(), second_ids.ravel())
+                assert np.abs(kinships.reshape(first_ids.shape) - expected_kinships).max() <= accuracy_precision
+    # The sex of vertex 1 is inferred from his partner, while the sex of vertex 6 can't be determined
+    pedigree_path = tmp_path / "x_linked.pedigree"
+    pedigree_path.write_text("# id father mother sex\n1 -1 -1 0\n2 -1 -1 F\n3 1 2 M\n4 1 2 2\n5 3 4 female\n"
+                             "6 3 4 0\n")
+    pedigree = Pedigree.get_pedigree_graph_from_file(filepath=pedigree_path, missing_parent_notation=["-1"],
+                                                     sex_column=3)
+    assert pedigree.get_vertex_sex(3) == Sex.MALE and pedigree.get_vertex_sex(5) == Sex.FEMALE
+    assert pedigree.get_vertex_sex(1) is None
+    with pytest.raises(ValueError):
+        pedigree.calculate_probands_kinship(chromosome=KinshipChromosome.X)
+    pedigree.set_vertex_sex(6, Sex.MALE)
+    kinship_matrix = pedigree.calculate_probands_kinship(probands={3, 4, 5, 6}, chromosome=KinshipChromosome.X)
+    assert kinship_matrix.get_kinship(3, 4) == pytest.approx(0.25)
+    assert kinship_matrix.get_kinship(6, 6) == pytest.approx(1)
+    assert kinship_matrix.get_kinship(5, 6) == pytest.approx(0.375)
+    pedigree.set_vertex_sex(1, Sex.MALE)
+    assert np.abs(kinship_matrix.get_kinships([3, 4, 5, 6] * 4, np.repeat([3, 4, 5, 6], 4)) -
+                  get_dense_x_kinships(pedigree, [3, 4, 5, 6]).ravel()).max() <= accuracy_precision
+
+
+def test_pairwise_kinship(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        vertices = sorted(pedigree)[:40]
+        kinship_matrix = pedigree.calculate_probands_kinship(probands=set(vertices))
+        pairs = list(itertools.product(vertices, repeat=2))
+        first_vertices = [first for first, _ in pairs]
+        second_vertices = [second for _, second in pairs]
+        # A tiny cache forces the values to be evicted and recalculated
+        for cache_size in (16, 10_000):
+            kinships = pedigree.calculate_pairs_kinship(first_vertices, second_vertices, cache_size=cache_size)
+            for (first, second), kinship_value in zip(pairs, kinships):
+                assert abs(kinship_matrix.get_kinship(first, second) - kinship_value) <= accuracy_precision
+    calculator = pedigree.get_pairwise_kinship_calculator(cache_size=10)
+    calculator.get_kinship(vertices[0], vertices[1])
+    assert calculator.get_cached_values_number() <= 10
+    with pytest.raises(IndexError):
+        calculator.get_kinship(vertices[0], -1)
+
+
+def test_inverse_relationship_matrix(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        if len(pedigree) > 1000:
+            # The dense inverse is only feasible for the small pedigrees
+            continue
+        vertices, inverse_matrix = pedigree.calculate_inverse_relationship_matrix()
+        assert sorted(vertices.tolist()) == sorted(pedigree)
+        kinship_matrix = pedigree.calculate_probands_kinship(probands=set(pedigree), prune=False)
+        kinships = kinship_matrix.get_kinships(np.repeat(vertices, len(vertices)), np.tile(vertices, len(vertices)))
+        relationship_matrix = 2 * kinships.reshape(len(vertices), len(vertices)).astype(np.float64)
+        assert np.abs(inverse_matrix.toarray() - np.linalg.inv(relationship_matrix)).max() <= accuracy_precision
+
+
+def verify_updatable_kinship(pedigree: Pedigree, recalculation_threshold: float):
+    probands = sorted(pedigree.get_sink_vertices())
+    pairs = list(itertools.combinations_with_replacement(probands, 2))
+    first_ids = np.array([first for first, _ in pairs])
+    second_ids = np.array([second for _, second in pairs])
+    updatable_kinship = UpdatableKinship(pedigree, recalculation_threshold=recalculation_threshold)
+    initial_kinships = updatable_kinship.get_kinships(first_ids, second_ids)
+    applied_errors = []
+    for error_rate in (0.01, 0.05):
+        errors = pedigree.introduce_and_record_errors(error_rate=error_rate, apply_errors=False)
+        updatable_kinship.apply_errors(errors)
+        applied_errors.append(errors)
+        expected_matrix = pedigree.calculate_probands_kinship()
+        expected_kinships = expected_matrix.get_kinships(first_ids, second_ids)
+        assert np.abs(updatable_kinship.get_kinships(first_ids, second_ids) - expected_kinships).max() <= \
+               accuracy_precision
+        for first, second in pairs[::max(1, len(pairs) // 50)]:
+            assert abs(updatable_kinship.get_kinship(first, second) -
+                       expected_matrix.get_kinship(first, second)) <= accuracy_precision
+    for errors in reversed(applied_errors):
+        assert updatable_kinship.reverse_errors() is errors
+    assert not updatable_kinship.get_updated_probands()
+    assert np.array_equal(updatable_kinship.get_kinships(first_ids, second_ids), initial_kinships)
+    assert np.array_equal(pedigree.calculate_probands_kinship().get_kinships(first_ids, second_ids),
+                          initial_kinships)
+    with pytest.raises(ValueError):
+        updatable_kinship.reverse_errors()
+
+
+def test_updatable_kinship(parsed_pedigrees, test_pedigrees):
+    random.seed(42)
+    for filepath, pedigree in parsed_pedigrees.items():
+        verify_updatable_kinship(pedigree, recalculation_threshold=0.1)
+    # Recalculating only the affected rows regardless of their number
+    pedigree = Pedigree.get_pedigree_graph_from_file(filepath=os.path.join(test_pedigrees, "100_6.pedigree"),
+                                                     separation_symbol=" ", missing_parent_notation=["-1"],
+                                                     skip_first_line=True)
+    verify_updatable_kinship(pedigree, recalculation_threshold=1.0)
+
+
+def test_kinship_pruning(parsed_pedigrees):
+    # The chain 10 -> 11 -> 12 -> 1 consists of single-child founder ancestors and can be removed entirely,
+    # making 1 a founder. The vertices 5, 14 and 15 are not ancestors of the probands
+    pedigree = Pedigree()
+    pedigree.add_edge(child=11, parent=10)
+    pedigree.add_edge(child=12, parent=11)
+    pedigree.add_edges_from([(12, 1), (13, 1), (1, 2), (1, 3), (2, 3), (3, 4), (14, 5), (15, 5)])
+    children_map = {x: pedigree.get_children(x) for x in pedigree}
+    parents_map = {x: pedigree.get_parents(x) for x in pedigree}
+    Pedigree._prune_kinship_genealogy(children_map=children_map, parents_map=parents_map, probands={2, 3, 4})
+    assert set(children_map) == {1, 2, 3, 4}
+    assert parents_map[1] == []
+    assert parents_map[3] == [1, 2]
+    for filepath, pedigree in itertools.chain(parsed_pedigrees.items(), [("handmade", pedigree)]):
+        probands = set(pedigree.get_sink_vertices()).union(list(pedigree)[::7])
+        full_matrix = pedigree.calculate_probands_kinship(probands=probands, prune=False)
+        pruned_matrix = pedigree.calculate_probands_kinship(probands=probands)
+        _, full_packed = full_matrix.to_packed(vertices=sorted(probands))
+        _, pruned_packed = pruned_matrix.to_packed(vertices=sorted(probands))
+        assert np.abs(full_packed - pruned_packed).max() <= accuracy_precision
+
+
+def test_inbreeding(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        pedigree: Pedigree
+        vertices, inbreeding_coefficients = pedigree.calculate_inbreeding()
+        assert set(vertices) == set(pedigree)
+        kinship_matrix = pedigree.calculate_probands_kinship(probands=set(pedigree))
+        self_kinships = kinship_matrix.get_kinships(vertices, vertices)
+        assert np.abs(2 * self_kinships - 1 - inbreeding_coefficients).max() <= accuracy_precision
+
+
+def get_dense_kinships(pedigree: Pedigree, probands) -> np.ndarray:
+    first_ids, second_ids = np.meshgrid(probands, probands, indexing="ij")
+    kinship_matrix = pedigree.calculate_probands_kinship(probands=set(probands))
+    return kinship_matrix.get_kinships(first_ids.ravel(), second_ids.ravel()).reshape(first_ids.shape)
+
+
+def test_gene_dropping(parsed_pedigrees, test_pedigrees):
+    # The simulated kinships are compared with the exact values, so the tolerance depends on the number of replicates
+    simulation_precision = 0.03
+    for filepath, pedigree in parsed_pedigrees.items():
+        if len(pedigree) > 1000:
+            continue
+        gene_dropping = GeneDropping(pedigree)
+        probands, estimated_kinships = gene_dropping.estimate_kinship(replicates=5000, seed=42)
+        exact_kinships = get_dense_kinships(pedigree, probands)
+        assert np.abs(estimated_kinships - exact_kinships).max() <= simulation_precision
+        proband_alleles = gene_dropping.simulate(replicates=2500, seed=42, batch_size=1000)
+        assert proband_alleles.shape == (len(probands), 2, 2500)
+        assert proband_alleles.max() < len(gene_dropping.get_founder_alleles())
+        assert np.array_equal(proband_alleles, gene_dropping.simulate(replicates=2500, seed=42, batch_size=1000,
+                                                                      processes=2))
+    # The kinship of two individuals is the average kinship of their ploids. The pedigrees don't contain
+    # selfing, which is represented differently in the ploid pedigree
+    for filename in ("kinship_test.pedigree", "kinship_test_2.pedigree"):
+        filepath = os.path.join(test_pedigrees, filename)
+        pedigree = parsed_pedigrees[filepath]
+        ploid_pedigree = PloidPedigree.get_ploid_pedigree_from_file(filepath=filepath, separation_symbol=" ",
+                                                                    missing_parent_notation=["-1"],
+                                                                    skip_first_line=True)
+        individuals = sorted(pedigree.get_sink_vertices())
+        gene_dropping = GeneDropping(ploid_pedigree, probands=PloidPedigree.get_ploids_from_individual_ids(individuals))
+        _, ploid_kinships = gene_dropping.estimate_kinship(replicates=5000, seed=42)
+        individuals_number = len(individuals)
+        estimated_kinships = ploid_kinships.reshape(individuals_number, 2, individuals_number, 2).mean(axis=(1, 3))
+        exact_kinships = get_dense_kinships(pedigree, individuals)
+        assert np.abs(estimated_kinships - exact_kinships).max() <= simulation_precision
+
+
+def test_carrier_importance_sampling(parsed_pedigrees):
+    for filepath, pedigree in parsed_pedigrees.items():
+        if len(pedigree) > 1000:
+            continue
+        carriers = sorted(pedigree.get_sink_vertices())[:2]
+        importance_sampling = CarrierImportanceSampling(pedigree, carriers=carriers)
+        founders, probabilities, effective_sample_sizes = importance_sampling.estimate_carrier_probabilities(
+            replicates=2000, seed=42)
+        assert np.all(effective_sample_sizes[probabilities > 0] > 100)
+        # Comparing with the fraction of the plain gene dropping replicates in which the carriers got the allele
+        gene_dropping = GeneDropping(pedigree, probands=carriers)
+        proband_alleles = gene_dropping.simulate(replicates=40000, seed=42)
+        founder_alleles = gene_dropping.get_founder_alleles()
+        for founder, probability in zip(founders.tolist(), probabilities.tolist()):
+            founder_allele = np.flatnonzero(founder_alleles == founder)[0]
+            simulated_probability = (proband_alleles == founder_allele).any(axis=1).all(axis=0).mean()
+            assert abs(probability - simulated_probability) <= 0.005 + 0.15 * simulated_probability
+        with pytest.raises(ValueError):
+            importance_sampling.estimate_carrier_probability(founder=max(pedigree) + 1, replicates=10)